@@ -0,0 +1,745 @@
+"""Asyncio MQTT client for Azure IoT, for CPython gateways that run many device sessions on one event loop.
+
+This shares the Azure specific logic with IoTMQTT and DeviceRegistration: SAS tokens, topics, the twin mirror,
+twin request tracking and direct method dispatch come from the same modules. Only the MQTT and HTTP transports
+are asyncio specific, so this module isn't for CircuitPython.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import ssl
+import struct
+import time
+
+from device_registration import DeviceRegistration
+from direct_methods import DirectMethodRegistry
+from iot_error import IoTError
+import iot_protocol
+from iot_protocol import IoTResponse
+from reconnect import ExponentialBackoff
+from topic_cache import TopicCache
+from topic_router import TopicRouter, get_properties
+from twin_mirror import TwinMirror
+from twin_requests import TwinRequestTracker
+
+_CONNACK_ERRORS = {
+    1: "Connection Refused - Incorrect Protocol Version",
+    2: "Connection Refused - ID Rejected",
+    3: "Connection Refused - Server unavailable",
+    4: "Connection Refused - Incorrect username/password",
+    5: "Connection Refused - Unauthorized",
+}
+
+# marks the end of the cloud to device messages when the client disconnects
+_CLOSED = object()
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_string(value: str) -> bytes:
+    value = value.encode("utf-8")
+    return struct.pack("!H", len(value)) + value
+
+
+def _to_bytes(data) -> bytes:
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return bytes(data)
+    return json.dumps(data).encode("utf-8")
+
+
+class _HTTPResponse:
+    """The parts of an HTTP response used by DeviceRegistration
+    """
+
+    def __init__(self, status_code: int, headers: dict, body: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self._body = body
+
+    def json(self):
+        """Gets the body parsed from JSON
+        """
+        return json.loads(self._body.decode("utf-8"))
+
+    def __str__(self):
+        return "{} {}".format(self.status_code, self._body.decode("utf-8", "replace"))
+
+
+async def https_request(method: str, url: str, headers: dict, body: dict = None, timeout: float = 30):
+    """Makes a single HTTPS request, closing the connection afterwards
+    :param str method: The HTTP method
+    :param str url: The https URL
+    :param dict headers: The request headers
+    :param dict body: The body to send as JSON, if any
+    :param float timeout: The number of seconds to wait for the response
+    :returns: The response, with status_code, headers with lower case names, and a json method
+    """
+    if not url.startswith("https://"):
+        raise ValueError("Only https URLs are supported")
+
+    host, _, path = url[8:].partition("/")
+    data = json.dumps(body).encode("utf-8") if body is not None else b""
+
+    lines = ["{} /{} HTTP/1.1".format(method, path), "Host: " + host, "Connection: close", "Content-Length: " + str(len(data))]
+    lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+    request = ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8") + data
+
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, 443, ssl=ssl.create_default_context()), timeout)
+    try:
+        writer.write(request)
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+
+    head, _, content = response.partition(b"\r\n\r\n")
+    head_lines = head.decode("iso-8859-1").split("\r\n")
+    status_code = int(head_lines[0].split(" ")[1])
+    response_headers = {}
+    for line in head_lines[1:]:
+        name, _, value = line.partition(":")
+        response_headers[name.strip().lower()] = value.strip()
+
+    if response_headers.get("transfer-encoding") == "chunked":
+        chunks = bytearray()
+        while True:
+            size_line, _, content = content.partition(b"\r\n")
+            size = int(size_line.split(b";")[0], 16)
+            if size == 0:
+                break
+            chunks += content[:size]
+            content = content[size + 2 :]
+        content = bytes(chunks)
+
+    return _HTTPResponse(status_code, response_headers, content)
+
+
+async def register_device(id_scope: str, device_id: str, key: str, token_expires: int = 21600, logger=None, request=None) -> str:
+    """Registers a device with the device provisioning service, using the same logic as IoTCentralDevice
+    :param str id_scope: The ID scope of the device
+    :param str device_id: The device ID of the device
+    :param str key: The primary or secondary key of the device
+    :param int token_expires: The number of seconds till the registration token expires
+    :param logger: The logger
+    :param request: The coroutine function that makes the HTTP requests, called like https_request, which is the default
+    :returns: The hostname of the IoT hub the device was assigned to
+    """
+    registration = DeviceRegistration(None, id_scope, device_id, key, logger if logger is not None else logging.getLogger("log"))
+    registration.start_registration(int(time.time() + token_expires))
+    request = request if request is not None else https_request
+
+    while True:
+        await asyncio.sleep(registration.step_delay)
+        url, body = registration.next_request()
+
+        try:
+            response = await request("PUT" if body is not None else "GET", url, registration.headers, body)
+        except (OSError, asyncio.TimeoutError) as request_error:
+            registration.request_failed(request_error)
+            continue
+
+        hostname = registration.handle_response(response)
+        if hostname is not None:
+            return hostname
+
+
+# pylint: disable=R0902
+class _MQTTConnection:
+    """An MQTT 3.1.1 connection over asyncio streams, publishing at QoS 0 or 1.
+    QoS 1 publishes are pipelined: each waits for its own PUBACK, so many can be in flight at once
+    """
+
+    def __init__(self, on_message, on_close):
+        self._on_message = on_message
+        self._on_close = on_close
+        self._reader = None
+        self._writer = None
+        self._waiting = {}
+        self._last_packet_id = 0
+        self._tasks = []
+        self._ping_answered = True
+        self.closed = True
+
+    # pylint: disable=R0913
+    async def open(
+        self, host: str, port: int, ssl_context, client_id: str, username: str, password: str, keep_alive: int, timeout: float
+    ) -> None:
+        """Connects to the broker and waits for the CONNACK
+        """
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=ssl_context), timeout)
+
+        body = _encode_string("MQTT") + bytes([4, 0xC2]) + struct.pack("!H", keep_alive)
+        body += _encode_string(client_id) + _encode_string(username) + _encode_string(password)
+        self._writer.write(b"\x10" + _encode_length(len(body)) + body)
+
+        try:
+            packet_type, body = await asyncio.wait_for(self._read_packet(), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            self._writer.close()
+            raise
+
+        if packet_type != 0x20 or len(body) < 2:
+            self._writer.close()
+            raise IoTError("Expected CONNACK from the hub")
+        if body[1] != 0:
+            self._writer.close()
+            raise IoTError(_CONNACK_ERRORS.get(body[1], "Connection Refused - " + str(body[1])))
+
+        self.closed = False
+        self._ping_answered = True
+        self._tasks = [asyncio.ensure_future(self._read_packets()), asyncio.ensure_future(self._keep_alive(keep_alive))]
+
+    def _next_packet_id(self) -> int:
+        while True:
+            self._last_packet_id = self._last_packet_id % 0xFFFF + 1
+            if self._last_packet_id not in self._waiting:
+                return self._last_packet_id
+
+    async def _acknowledged(self, packet_id: int, packet: bytes, timeout: float):
+        future = asyncio.get_event_loop().create_future()
+        self._waiting[packet_id] = future
+        try:
+            self._writer.write(packet)
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._waiting.pop(packet_id, None)
+
+    async def subscribe(self, topics: list, timeout: float) -> None:
+        """Subscribes to topics at QoS 0 in a single SUBSCRIBE, and waits for the SUBACK
+        """
+        packet_id = self._next_packet_id()
+        body = struct.pack("!H", packet_id) + b"".join(_encode_string(topic) + b"\x00" for topic in topics)
+        return_codes = await self._acknowledged(packet_id, b"\x82" + _encode_length(len(body)) + body, timeout)
+
+        if 0x80 in return_codes:
+            raise IoTError("The hub refused a subscription")
+
+    async def publish(self, topic: str, payload: bytes, qos: int, timeout: float) -> None:
+        """Publishes a message, waiting for its PUBACK at QoS 1
+        """
+        if self.closed:
+            raise IoTError("You are not connected to IoT Hub")
+
+        if qos == 0:
+            body = _encode_string(topic) + payload
+            self._writer.write(b"\x30" + _encode_length(len(body)) + body)
+            await self._writer.drain()
+            return
+
+        packet_id = self._next_packet_id()
+        body = _encode_string(topic) + struct.pack("!H", packet_id) + payload
+        await self._acknowledged(packet_id, b"\x32" + _encode_length(len(body)) + body, timeout)
+
+    async def close(self) -> None:
+        """Disconnects from the broker
+        """
+        if not self.closed:
+            self._writer.write(b"\xe0\x00")
+        self._closed()
+
+        tasks = [task for task in self._tasks if task is not asyncio.current_task()]
+        self._tasks = []
+        for task in tasks:
+            task.cancel()
+
+        # wait for the tasks to finish being cancelled, so none are left pending when the event loop closes
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _closed(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+        was_open = not self.closed
+        self.closed = True
+
+        for future in self._waiting.values():
+            if not future.done():
+                future.set_exception(IoTError("The connection to the hub was lost"))
+
+        if was_open:
+            self._on_close(self)
+
+    async def _read_packet(self) -> tuple:
+        header = await self._reader.readexactly(1)
+        length = 0
+        shift = 0
+        while True:
+            byte = (await self._reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = await self._reader.readexactly(length) if length else b""
+        return header[0], body
+
+    async def _read_packets(self) -> None:
+        try:
+            while True:
+                packet_type, body = await self._read_packet()
+                kind = packet_type & 0xF0
+
+                if kind == 0x30:
+                    topic_length = struct.unpack_from("!H", body)[0]
+                    topic = body[2 : 2 + topic_length].decode("utf-8")
+                    offset = 2 + topic_length
+                    if packet_type & 0x06:
+                        self._writer.write(b"\x40\x02" + body[offset : offset + 2])
+                        offset += 2
+                    self._on_message(topic, body[offset:])
+                elif kind in (0x40, 0x90):
+                    future = self._waiting.get(struct.unpack_from("!H", body)[0])
+                    if future is not None and not future.done():
+                        future.set_result(body[2:])
+                elif kind == 0xD0:
+                    self._ping_answered = True
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self._closed()
+
+    async def _keep_alive(self, keep_alive: int) -> None:
+        while not self.closed:
+            await asyncio.sleep(keep_alive / 2)
+
+            # the broker answers every ping, so no answer in half the keep alive period means the connection is dead
+            if not self._ping_answered:
+                self._closed()
+                return
+
+            self._ping_answered = False
+            self._writer.write(b"\xc0\x00")
+
+
+class AsyncIoTMQTT:
+    """Asyncio client for a single Azure IoT Hub device. Many clients can run on one event loop, each using
+    two tasks while connected.
+
+    Telemetry and reported property updates are awaitable, and complete when the hub has acknowledged them.
+    Cloud to device messages are read with ``async for``, and direct method handlers can be coroutines.
+    """
+
+    # How long to wait for the device twin after subscribing before finishing connecting without it
+    _twin_sync_timeout = 10
+
+    # The token is renewed once this fraction of its lifetime is left, plus a random extra fraction of up to
+    # _token_renewal_jitter so devices that connected together don't all reconnect at the same time
+    _token_renewal_margin = 0.1
+    _token_renewal_jitter = 0.1
+
+    # pylint: disable=R0913
+    def __init__(
+        self,
+        hostname: str,
+        device_id: str,
+        key: str,
+        token_expires: int = 21600,
+        logger=None,
+        port: int = 8883,
+        ssl_context=None,
+        keep_alive: int = 120,
+        timeout: float = 30,
+        queue_size: int = 16,
+        backoff: ExponentialBackoff = None,
+    ):
+        """Create the client
+        :param str hostname: The hostname of the IoT hub, get this by registering the device with register_device
+        :param str device_id: The device ID
+        :param str key: The primary or secondary key of the device
+        :param int token_expires: The number of seconds till the token expires, defaults to 6 hours
+        :param logger: The logger, defaults to the log logger
+        :param int port: The MQTT port of the hub
+        :param ssl_context: The SSL context, defaults to one that verifies the hub's certificate. Pass False to connect without TLS
+        :param int keep_alive: The MQTT keep alive period in seconds
+        :param float timeout: The number of seconds to wait for the hub to acknowledge a request
+        :param int queue_size: The number of cloud to device messages held for the reader before the oldest is dropped
+        :param ExponentialBackoff backoff: The delays between attempts to reconnect after the connection is lost or
+        reconnecting with a renewed token fails, defaults to 1 second doubling up to 5 minutes, with jitter
+        """
+        self._hostname = hostname
+        self._device_id = device_id
+        self._key = key
+        self._signer = None
+        self._token_expires = token_expires
+        self._logger = logger if logger is not None else logging.getLogger("log")
+        self._port = port
+        self._ssl_context = ssl_context if ssl_context is not None else ssl.create_default_context()
+        self._keep_alive = keep_alive
+        self._timeout = timeout
+        self._queue_size = queue_size
+        self._connection = None
+        self._renewal = None
+        self._reconnecting = None
+        self._backoff = backoff if backoff is not None else ExponentialBackoff()
+        self._messages = asyncio.Queue()
+        self._methods = DirectMethodRegistry()
+        self._method_tasks = set()
+        self._topics = TopicCache(device_id)
+        self._twin = TwinMirror()
+        self._twin_requests = TwinRequestTracker(max_in_flight=16, timeout=timeout)
+        self._twin_payloads = {}
+        self._twin_resync = None
+        self._c2d_prefix = iot_protocol.c2d_prefix(device_id)
+        self._router = TopicRouter()
+        self._router.add_route(iot_protocol.TWIN_DESIRED_PREFIX, self._handle_desired_patch)
+        self._router.add_route(iot_protocol.TWIN_RESPONSE_PREFIX, self._handle_twin_response)
+        self._router.add_route(iot_protocol.METHOD_PREFIX, self._handle_direct_method)
+        self._router.add_route(self._c2d_prefix, self._handle_cloud_to_device_message)
+
+        self.on_connection_status_changed = None
+        self.on_device_twin_desired_updated = None
+
+    @property
+    def device_id(self) -> str:
+        """The device ID
+        """
+        return self._device_id
+
+    @property
+    def twin(self) -> TwinMirror:
+        """The local copy of the device twin
+        """
+        return self._twin
+
+    def is_connected(self) -> bool:
+        """Gets if there is an open connection to the hub
+        """
+        return self._connection is not None and not self._connection.closed
+
+    async def connect(self) -> None:
+        """Connects to the hub, subscribes, and reads the device twin
+        """
+        self._logger.info("- async_iot_mqtt :: connect :: %s", self._hostname)
+
+        token_expiry = int(time.time() + self._token_expires)
+        renew_in = self._token_expires * (1 - self._token_renewal_margin - random.uniform(0, self._token_renewal_jitter))
+        if self._signer is None:
+            self._signer = iot_protocol.SasSigner(self._key, iot_protocol.device_resource_uri(self._hostname, self._device_id))
+        password = self._signer.sign(token_expiry)
+
+        # responses to requests made on an earlier connection will never arrive
+        self._twin_requests.expire(True)
+
+        connection = _MQTTConnection(self._on_message, self._on_close)
+        await connection.open(
+            self._hostname,
+            self._port,
+            self._ssl_context or None,
+            self._device_id,
+            iot_protocol.mqtt_username(self._hostname, self._device_id),
+            password,
+            self._keep_alive,
+            self._timeout,
+        )
+
+        try:
+            await connection.subscribe(iot_protocol.subscription_topics(self._device_id), self._timeout)
+        except (IoTError, asyncio.TimeoutError, asyncio.CancelledError):
+            await connection.close()
+            raise
+
+        # only set once subscribed, so a connection that fails part way through doesn't start reconnecting from _on_close
+        self._connection = connection
+
+        # a timer rather than a sleeping task, so idle sessions don't each hold a third task
+        if self._renewal is not None:
+            self._renewal.cancel()
+        self._renewal = asyncio.get_event_loop().call_later(renew_in, self._start_renewal)
+
+        self._status_changed(True)
+
+        try:
+            await asyncio.wait_for(self.get_twin(), self._twin_sync_timeout)
+        except (IoTError, asyncio.TimeoutError) as twin_error:
+            self._logger.error("Failed to read the device twin: %s", twin_error)
+
+    async def disconnect(self) -> None:
+        """Disconnects from the hub, and ends iterating over cloud to device messages
+        """
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+
+        if self._reconnecting is not None:
+            reconnecting = self._reconnecting
+            self._reconnecting = None
+            if reconnecting is not asyncio.current_task():
+                reconnecting.cancel()
+                await asyncio.gather(reconnecting, return_exceptions=True)
+
+        if self._connection is not None:
+            connection = self._connection
+            self._connection = None
+            await connection.close()
+
+        self._messages.put_nowait(_CLOSED)
+
+    def _start_renewal(self) -> None:
+        self._renewal = None
+        self._start_reconnecting(self._renew_token())
+
+    def _start_reconnecting(self, coroutine) -> None:
+        # the event loop only keeps a weak reference to tasks, so one that isn't held can be garbage collected part way
+        self._reconnecting = asyncio.ensure_future(coroutine)
+
+    def _is_reconnecting(self) -> bool:
+        return self._reconnecting is not None and not self._reconnecting.done()
+
+    async def _renew_token(self) -> None:
+        self._logger.info("- async_iot_mqtt :: _renew_token :: ")
+
+        # cleared first so closing it isn't taken for a lost connection
+        connection = self._connection
+        self._connection = None
+        if connection is not None:
+            await connection.close()
+
+        await self._reconnect(False)
+
+    async def _reconnect(self, wait: bool) -> None:
+        """Connects until it succeeds or disconnect is called, backing off between attempts
+        :param bool wait: True to wait before the first attempt, so clients that lost their connections together spread out
+        """
+        self._backoff.reset()
+        delay = self._backoff.next_delay() if wait else 0
+
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+            except (IoTError, OSError, asyncio.TimeoutError) as connect_error:
+                self._logger.error("Failed to reconnect: %s", connect_error)
+
+            if self.is_connected():
+                return
+
+            delay = self._backoff.next_delay()
+            self._logger.info("Reconnecting in %.1f seconds", delay)
+
+    def _status_changed(self, connected: bool) -> None:
+        if self.on_connection_status_changed is not None:
+            # pylint: disable=E1102
+            self.on_connection_status_changed(connected)
+
+    def _on_close(self, connection: _MQTTConnection) -> None:
+        self._logger.info("- async_iot_mqtt :: _on_close :: ")
+        self._twin_requests.expire(True)
+        self._status_changed(False)
+
+        # the connection was lost rather than closed by disconnect or to renew the token
+        if connection is self._connection and not self._is_reconnecting():
+            self._start_reconnecting(self._reconnect(True))
+
+    def _on_message(self, topic: str, payload: bytes) -> None:
+        self._logger.debug("- async_iot_mqtt :: _on_message :: topic(%s) payload(%s)", topic, payload)
+
+        if not self._router.dispatch(topic, payload):
+            self._logger.error("ERROR: (unknown message) - %s", payload)
+
+    async def _publish(self, topic: str, data, qos: int) -> None:
+        if not self.is_connected():
+            raise IoTError("You are not connected to IoT Hub")
+
+        await self._connection.publish(topic, _to_bytes(data), qos, self._timeout)
+
+    async def send_telemetry(
+        self, data, properties: dict = None, content_type: str = None, content_encoding: str = None, qos: int = 1
+    ) -> None:
+        """Sends a device to cloud message, and waits for the hub to acknowledge it at QoS 1
+        :param data: The message, as a dictionary sent as JSON, a str, or bytes
+        :param dict properties: The system and application properties of the message, these are percent-encoded
+        :param str content_type: The content type of the message, such as application/json
+        :param str content_encoding: The content encoding of the message, such as utf-8
+        :param int qos: 1 to wait for the hub to acknowledge the message, or 0 to return once it has been written
+        """
+        await self._publish(self._topics.get(properties, content_type, content_encoding), data, qos)
+
+    async def _twin_request(self, topic: str, data) -> tuple:
+        """Sends a twin request and waits for the response
+        :returns: A tuple of the status, 0 if the request timed out, the version and the payload from the response
+        """
+        future = asyncio.get_event_loop().create_future()
+
+        def completed(_, status, __, version):
+            if not future.done():
+                future.set_result((status, version))
+
+        request_id = self._twin_requests.start(completed)
+        try:
+            await self._publish(topic + request_id, data, 0)
+            status, version = await asyncio.wait_for(future, self._timeout)
+        except asyncio.TimeoutError:
+            status, version = TwinRequestTracker.STATUS_TIMEOUT, None
+        finally:
+            self._twin_requests.cancel(request_id)
+
+        return status, version, self._twin_payloads.pop(request_id, None)
+
+    async def update_twin(self, patch: dict) -> int:
+        """Updates reported properties of the device twin, and waits for the hub to respond
+        :param dict patch: The properties to update
+        :returns: The status code from the hub, 204 when the update was accepted, or 0 if it timed out
+        """
+        status, version, _ = await self._twin_request(iot_protocol.TWIN_PATCH_TOPIC, json.dumps(patch))
+
+        if 200 <= status < 300:
+            self._twin.apply_reported_patch(patch, version)
+        else:
+            self._logger.error("Reported properties patch failed with status %s", status)
+
+        return status
+
+    async def get_twin(self) -> dict:
+        """Reads the full device twin from the hub and updates the local copy,
+        calling on_device_twin_desired_updated for each desired property that changed
+        :returns: The twin, with desired and reported sections
+        """
+        status, _, twin = await self._twin_request(iot_protocol.TWIN_GET_TOPIC, " ")
+
+        if status != 200 or not twin:
+            raise IoTError("Twin GET request failed with status " + str(status))
+
+        twin = json.loads(twin)
+        desired_changes, _ = self._twin.apply_twin(twin)
+        for name, value in desired_changes.items():
+            self._desired_updated(name, value, self._twin.desired_version)
+
+        return twin
+
+    def get_desired(self, name: str, default=None):
+        """Gets the value of a desired property from the local copy of the device twin
+        :param str name: The name of the property
+        :param default: The value to return if the property isn't set
+        """
+        return self._twin.get_desired(name, default)
+
+    def get_reported(self, name: str, default=None):
+        """Gets the value of a reported property from the local copy of the device twin
+        :param str name: The name of the property
+        :param default: The value to return if the property isn't set
+        """
+        return self._twin.get_reported(name, default)
+
+    def _desired_updated(self, name: str, value, version: int) -> None:
+        if self.on_device_twin_desired_updated is not None:
+            # pylint: disable=E1102
+            self.on_device_twin_desired_updated(name, value, version)
+
+    def _handle_twin_response(self, topic: str, payload: bytes) -> None:
+        try:
+            status, request_id, version = iot_protocol.parse_twin_response(topic)
+        except ValueError:
+            self._logger.error("ERROR: Unexpected twin response topic %s", topic)
+            return
+
+        if payload and self._twin_requests.is_pending(request_id):
+            self._twin_payloads[request_id] = payload
+
+        if request_id is None or not self._twin_requests.complete(request_id, status, version):
+            self._logger.debug("Twin response for an unknown request %s", topic)
+
+    def _handle_desired_patch(self, topic: str, payload: bytes) -> None:
+        self._logger.debug("- async_iot_mqtt :: _handle_desired_patch :: %s", topic)
+
+        try:
+            patch = json.loads(payload)
+            version = patch.pop("$version")
+        except (ValueError, KeyError) as parse_error:
+            self._logger.error("ERROR: Unexpected payload for desired twin update => %s => %s", payload, parse_error)
+            return
+
+        result = self._twin.apply_desired_patch(patch, version)
+        if result == TwinMirror.STALE:
+            self._logger.debug("Dropping stale desired properties version %s", version)
+            return
+
+        for name, value in patch.items():
+            self._desired_updated(name, value, version)
+
+        if result == TwinMirror.GAP and (self._twin_resync is None or self._twin_resync.done()):
+            self._logger.info("Desired properties version %s skipped versions, requesting the full twin", version)
+            self._twin_resync = asyncio.ensure_future(self._resync_twin())
+
+    async def _resync_twin(self) -> None:
+        try:
+            await self.get_twin()
+        except IoTError as twin_error:
+            self._logger.error("Failed to resync the device twin: %s", twin_error)
+
+    def register_method(self, method_name: str, handler) -> None:
+        """Registers the handler for a direct method. The handler is called with a DirectMethodRequest and returns
+        an IoTResponse, and can be a coroutine function. Methods that have no handler get a 404 response
+        :param str method_name: The name of the method
+        :param handler: The function or coroutine function to call when the method is invoked
+        """
+        self._methods.register(method_name, handler)
+
+    def unregister_method(self, method_name: str) -> None:
+        """Removes the handler for a direct method
+        :param str method_name: The name of the method
+        """
+        self._methods.unregister(method_name)
+
+    def _handle_direct_method(self, topic: str, payload: bytes) -> None:
+        method_name, request_id = iot_protocol.parse_method_topic(topic)
+        if request_id is None:
+            self._logger.error("ERROR: C2D doesn't include topic id")
+            return
+
+        # run as a task so a slow handler doesn't hold up the connection
+        task = asyncio.ensure_future(self._run_method(method_name, request_id, payload.decode("utf-8")))
+        self._method_tasks.add(task)
+        task.add_done_callback(self._method_tasks.discard)
+
+    async def _run_method(self, method_name: str, request_id: str, payload: str) -> None:
+        try:
+            response = self._methods.dispatch(method_name, payload)
+            if response is not None and hasattr(response, "__await__"):
+                response = await response
+                if response is None:
+                    response = IoTResponse(200, None)
+        except Exception as method_error:  # pylint: disable=W0703
+            self._logger.error("Direct method %s failed: %s", method_name, method_error)
+            response = IoTResponse(500, str(method_error))
+
+        if response is None:
+            response = IoTResponse(404, "Method not found: " + method_name)
+
+        topic, message = iot_protocol.method_response(response, request_id)
+        try:
+            await self._publish(topic, message, 0)
+        except IoTError as send_error:
+            self._logger.error("Failed to send the response to direct method %s: %s", method_name, send_error)
+
+    def _handle_cloud_to_device_message(self, topic: str, payload: bytes) -> None:
+        if self._messages.qsize() >= self._queue_size:
+            self._logger.error("Dropping the oldest cloud to device message, the reader isn't keeping up")
+            self._messages.get_nowait()
+
+        self._messages.put_nowait((payload.decode("utf-8"), get_properties(topic, len(self._c2d_prefix))))
+
+    async def cloud_to_device_messages(self):
+        """Iterates over cloud to device messages as they arrive, until the client disconnects.
+        Each message is a tuple of the body as a str and a dictionary of its properties::
+
+            async for body, properties in client.cloud_to_device_messages():
+                print(body, properties)
+        """
+        while True:
+            message = await self._messages.get()
+            if message is _CLOSED:
+                return
+            yield message
@@ -0,0 +1,100 @@
+"""Compares TelemetryEncoder with json.dumps for the fixed schema telemetry sent by code.py:
+messages per second and the memory allocated per message, for encoding alone and for sending to a local broker.
+
+Run from the root of the repo with CPython, after installing the libraries in requirements.txt and adafruit-circuitpython-logging:
+
+    python benchmarks/bench_encoder.py [--messages 2000]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from host import shims  # pylint: disable=C0413
+
+shims.install()
+
+import adafruit_logging as logging  # pylint: disable=C0413
+from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager  # pylint: disable=C0413
+from gc_policy import NeverCollectPolicy  # pylint: disable=C0413
+from iot_mqtt import IoTMQTT, IoTMQTTCallback  # pylint: disable=C0413
+from telemetry_encoder import TelemetryEncoder  # pylint: disable=C0413
+
+KEY = "a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2U="
+KEYS = ("TestTelemetry", "Temperature")
+
+
+def _readings(count: int) -> list:
+    random.seed(1)
+    return [(random.randint(0, 1024), 32.0 + random.uniform(-20.0, 20.0)) for _ in range(count)]
+
+
+def _measure(function, readings: list) -> tuple:
+    """Gets the messages per second and the peak bytes allocated per message for a function called with each reading
+    """
+    start = time.perf_counter()
+    for reading in readings:
+        function(reading)
+    rate = len(readings) / (time.perf_counter() - start)
+
+    allocated = 0
+    tracemalloc.start()
+    for reading in readings:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function(reading)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return rate, allocated / len(readings)
+
+
+def main() -> None:
+    """Runs the benchmark and prints the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    readings = _readings(args.messages)
+    encoder = TelemetryEncoder(KEYS, precision=2)
+    values = [0, 0.0]
+
+    def encode_dumps(reading):
+        return json.dumps({"TestTelemetry": reading[0], "Temperature": reading[1]}).encode("utf-8")
+
+    def encode_encoder(reading):
+        values[0] = reading[0]
+        values[1] = reading[1]
+        return encoder.encode(values)
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.WARNING)
+    client = IoTMQTT(IoTMQTTCallback(), ESPSPI_WiFiManager(), "bench.azure-devices.net", "bench-device", KEY, logger=logger, gc_policy=NeverCollectPolicy())
+    client.connect()
+
+    def send_dumps(reading):
+        client.send_device_to_cloud_message(json.dumps({"TestTelemetry": reading[0], "Temperature": reading[1]}))
+
+    def send_encoder(reading):
+        client.send_device_to_cloud_message(encode_encoder(reading))
+
+    print("{:<22}{:>14}{:>20}".format("", "messages/s", "bytes/message"))
+    for name, function in (
+        ("encode json.dumps", encode_dumps),
+        ("encode encoder", encode_encoder),
+        ("send json.dumps", send_dumps),
+        ("send encoder", send_encoder),
+    ):
+        rate, allocated = _measure(function, readings)
+        print("{:<22}{:>14.0f}{:>20.1f}".format(name, rate, allocated))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Compares the garbage collection policies: the latency of each send and the time spent collecting.
+
+A heap full of live objects is built first, as a full collection costs more the more there is to mark.
+Run from the root of the repo with CPython, after installing the libraries in requirements.txt and adafruit-circuitpython-logging:
+
+    python benchmarks/bench_gc.py [--messages 300] [--live-objects 50000]
+
+On CPython the heap is never too fragmented to allocate, so compare the collection counts and times here,
+and check gc.mem_free() on a board to see the effect of collecting less often on the free heap.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from host import shims  # pylint: disable=C0413
+
+shims.install()
+
+import adafruit_logging as logging  # pylint: disable=C0413
+from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager  # pylint: disable=C0413
+from gc_policy import AlwaysCollectPolicy, EveryNCollectPolicy, LowMemoryCollectPolicy, NeverCollectPolicy  # pylint: disable=C0413
+from iot_mqtt import IoTMQTT, IoTMQTTCallback  # pylint: disable=C0413
+
+KEY = "a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2U="
+PAYLOAD = '{"temperature": 21.5, "humidity": 48.25, "pressure": 1013.2}'
+
+
+def run(policy, messages: int) -> dict:
+    """Connects to a local broker with the policy and sends messages, timing each send
+    """
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.WARNING)
+
+    client = IoTMQTT(IoTMQTTCallback(), ESPSPI_WiFiManager(), "bench.azure-devices.net", "bench-device", KEY, logger=logger, gc_policy=policy)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.connect()
+
+    policy.reset_counters()
+    latencies = []
+
+    for _ in range(messages):
+        start = time.perf_counter()
+        client.send_device_to_cloud_message(PAYLOAD)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+
+    return {
+        "mean ms": sum(latencies) * 1000 / messages,
+        "p99 ms": latencies[int(messages * 0.99) - 1] * 1000,
+        "collections": policy.collections,
+        "collect ms": policy.collect_time * 1000,
+        "max collect ms": policy.max_collect_time * 1000,
+    }
+
+
+def main() -> None:
+    """Runs the benchmark for each policy and prints the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--live-objects", type=int, default=50000)
+    args = parser.parse_args()
+
+    live = [{"index": index, "value": [index]} for index in range(args.live_objects)]  # pylint: disable=W0612
+
+    policies = [
+        ("always", AlwaysCollectPolicy()),
+        ("low memory", LowMemoryCollectPolicy()),
+        ("every 10", EveryNCollectPolicy(10)),
+        ("never", NeverCollectPolicy()),
+    ]
+
+    print("{:<12}{:>10}{:>10}{:>13}{:>12}{:>16}".format("policy", "mean ms", "p99 ms", "collections", "collect ms", "max collect ms"))
+    for name, policy in policies:
+        result = run(policy, args.messages)
+        print(
+            "{:<12}{:>10.3f}{:>10.3f}{:>13}{:>12.1f}{:>16.3f}".format(
+                name, result["mean ms"], result["p99 ms"], result["collections"], result["collect ms"], result["max collect ms"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
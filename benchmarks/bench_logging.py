@@ -0,0 +1,76 @@
+"""Measures the cost of logging on the send path: the memory allocated and the bytes written to stdout per message.
+
+Run from the root of the repo with CPython, after installing the libraries in requirements.txt and adafruit-circuitpython-logging:
+
+    python benchmarks/bench_logging.py [--messages 500] [--level INFO]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from host import shims  # pylint: disable=C0413
+
+shims.install()
+
+import adafruit_logging as logging  # pylint: disable=C0413
+from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager  # pylint: disable=C0413
+from iot_mqtt import IoTMQTT, IoTMQTTCallback  # pylint: disable=C0413
+
+KEY = "a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2U="
+PAYLOAD = '{"temperature": 21.5, "humidity": 48.25, "pressure": 1013.2}'
+
+
+def run(messages: int, level: str) -> dict:
+    """Connects to a local broker and sends messages, measuring each send
+    """
+    logger = logging.getLogger("bench")
+    logger.setLevel(getattr(logging, level))
+
+    client = IoTMQTT(IoTMQTTCallback(), ESPSPI_WiFiManager(), "bench.azure-devices.net", "bench-device", KEY, logger=logger)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.connect()
+
+    stdout = io.StringIO()
+    allocated = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    with contextlib.redirect_stdout(stdout):
+        for _ in range(messages):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            client.send_device_to_cloud_message(PAYLOAD)
+            allocated += tracemalloc.get_traced_memory()[1] - before
+
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+
+    return {
+        "peak bytes allocated per message": allocated / messages,
+        "stdout bytes per message": len(stdout.getvalue()) / messages,
+        "microseconds per message (traced)": elapsed * 1e6 / messages,
+    }
+
+
+def main() -> None:
+    """Runs the benchmark and prints the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+
+    for name, value in run(args.messages, args.level).items():
+        print("{:<40}{:>12.1f}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""Runs the standard benchmarks and writes the results as JSON, to track performance between releases:
+publish throughput and latency for device to cloud messages and twin patches, the cost of dispatching each kind
+of incoming message, SAS token generation and device key derivation, and registering with a stand-in for the device provisioning service.
+
+Everything runs in process against host.broker.LocalBroker and host.dps.LocalDPS, so no hardware or network is needed.
+Run from the root of the repo with CPython, after installing the libraries in requirements.txt and adafruit-circuitpython-logging:
+
+    python benchmarks/bench_suite.py [--output results.json] [--compare baseline.json] [--threshold 10]
+
+Metrics ending in _per_second are better when higher, all the others are times and are better when lower.
+With --compare the script exits with status 1 if any metric is more than the threshold percentage worse than the baseline.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from host import shims  # pylint: disable=C0413
+from host.broker import LocalBroker  # pylint: disable=C0413
+from host.dps import LocalDPS  # pylint: disable=C0413
+
+_dps = LocalDPS(retry_after=0)
+shims.install(LocalBroker(), dps=_dps)
+
+import adafruit_logging as logging  # pylint: disable=C0413
+import adafruit_minimqtt as minimqtt  # pylint: disable=C0413
+from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager  # pylint: disable=C0413
+from device_registration import DeviceRegistration  # pylint: disable=C0413
+from gc_policy import NeverCollectPolicy  # pylint: disable=C0413
+import iot_protocol  # pylint: disable=C0413
+from iot_mqtt import IoTMQTT, IoTMQTTCallback, IoTResponse  # pylint: disable=C0413
+
+KEY = "a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2U="
+HUB = "bench.azure-devices.net"
+DEVICE_ID = "bench-device"
+PAYLOAD = '{"temperature": 21.5, "humidity": 48.25, "pressure": 1013.2}'
+RESULTS_VERSION = 1
+
+
+class _Callback(IoTMQTTCallback):
+    """Answers every direct method so the dispatch benchmark includes sending the response
+    """
+
+    def direct_method_called(self, method_name: str, data) -> IoTResponse:
+        return IoTResponse(200, None)
+
+
+def _percentile(values: list, percent: float) -> float:
+    """Gets a percentile of sorted values using the nearest rank
+    """
+    if not values:
+        return 0
+    rank = max(1, -(-percent * len(values) // 100))
+    return values[min(int(rank), len(values)) - 1]
+
+
+def _latency_metrics(latencies: list, elapsed: float) -> dict:
+    latencies.sort()
+    return {
+        "throughput_per_second": len(latencies) / elapsed,
+        "p50_us": _percentile(latencies, 50) * 1e6,
+        "p90_us": _percentile(latencies, 90) * 1e6,
+        "p99_us": _percentile(latencies, 99) * 1e6,
+    }
+
+
+def _logger():
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.CRITICAL)
+    return logger
+
+
+def _connect() -> IoTMQTT:
+    client = IoTMQTT(_Callback(), ESPSPI_WiFiManager(), HUB, DEVICE_ID, KEY, logger=_logger(), gc_policy=NeverCollectPolicy())
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.connect()
+
+    return client
+
+
+def bench_device_to_cloud(messages: int) -> dict:
+    """Times send_device_to_cloud_message for each message
+    """
+    client = _connect()
+    latencies = []
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        sent = time.perf_counter()
+        client.send_device_to_cloud_message(PAYLOAD)
+        latencies.append(time.perf_counter() - sent)
+
+    return _latency_metrics(latencies, time.perf_counter() - start)
+
+
+def bench_twin_patch(messages: int) -> dict:
+    """Times each twin patch from send_twin_patch until its response has been handled
+    """
+    client = _connect()
+    client.set_twin_request_limits(max_in_flight=1)
+    completed = []
+    latencies = []
+
+    start = time.perf_counter()
+    for index in range(messages):
+        sent = time.perf_counter()
+        client.send_twin_patch(json.dumps({"counter": index}), lambda status, _: completed.append(status))
+        while len(completed) <= index:
+            client.loop()
+        latencies.append(time.perf_counter() - sent)
+
+    metrics = _latency_metrics(latencies, time.perf_counter() - start)
+    if any(status != 204 for status in completed):
+        raise RuntimeError("A twin patch failed")
+    return metrics
+
+
+def bench_dispatch(iterations: int) -> dict:
+    """Times _on_message for each kind of incoming message
+    """
+    client = _connect()
+    messages = {
+        "c2d": ("devices/{}/messages/devicebound/%24.mid=1&%24.to=%2Fdevices%2F{}&label=bench".format(DEVICE_ID, DEVICE_ID), PAYLOAD),
+        "desired": (iot_protocol.TWIN_DESIRED_PREFIX + "?$version={}", '{"setpoint": 20, "$version": {}}'),
+        "twin_response": (iot_protocol.TWIN_RESPONSE_PREFIX + "204/?$rid=999&$version=2", ""),
+        "method": (iot_protocol.METHOD_PREFIX + "reboot/?$rid=1", '{"delay": 5}'),
+        "unknown": ("devices/other/unknown", PAYLOAD),
+    }
+
+    metrics = {}
+    version = 1
+    for name, (topic, payload) in messages.items():
+        timings = []
+        for _ in range(iterations):
+            # desired patches must have increasing versions or they are dropped as stale
+            version += 1
+            message_topic = topic.format(version) if name == "desired" else topic
+            message_payload = payload.replace("{}", str(version)) if name == "desired" else payload
+
+            start = time.perf_counter()
+            client._on_message(None, message_topic, message_payload)  # pylint: disable=W0212
+            timings.append(time.perf_counter() - start)
+
+        timings.sort()
+        metrics[name + "_mean_us"] = sum(timings) * 1e6 / iterations
+        metrics[name + "_p99_us"] = _percentile(timings, 99) * 1e6
+
+    return metrics
+
+
+def bench_sas(iterations: int) -> dict:
+    """Times generating the device SAS token used as the MQTT password: once from scratch each time, as the device
+    provisioning request does, and again renewing it with the same SasSigner, as IoTMQTT does. Also times deriving
+    device keys from a group key with one signer, as fleet tools do
+    """
+    resource_uri = iot_protocol.device_resource_uri(HUB, DEVICE_ID)
+    expiry = int(time.time()) + 21600
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        iot_protocol.generate_sas_token(resource_uri, KEY, expiry)
+    elapsed = time.perf_counter() - start
+
+    signer = iot_protocol.SasSigner(KEY, resource_uri)
+    start = time.perf_counter()
+    for index in range(iterations):
+        signer.sign(expiry + index)
+    signer_elapsed = time.perf_counter() - start
+
+    group_signer = iot_protocol.SasSigner(KEY)
+    start = time.perf_counter()
+    for index in range(iterations):
+        group_signer.digest("device-" + str(index))
+    derive_elapsed = time.perf_counter() - start
+
+    return {
+        "tokens_per_second": iterations / elapsed,
+        "mean_us": elapsed * 1e6 / iterations,
+        "signer_tokens_per_second": iterations / signer_elapsed,
+        "signer_mean_us": signer_elapsed * 1e6 / iterations,
+        "derived_keys_per_second": iterations / derive_elapsed,
+    }
+
+
+def bench_registration(registrations: int) -> dict:
+    """Times registering with the device provisioning service stand-in, which assigns the device after one poll
+    """
+    timings = []
+    requests = _dps.requests
+
+    for index in range(registrations):
+        device_id = "bench-" + str(index)
+        registration = DeviceRegistration(ESPSPI_WiFiManager(), "0ne00000000", device_id, KEY, _logger(), gc_policy=NeverCollectPolicy())
+        start = time.perf_counter()
+        registration.register_device(int(time.time()) + 21600)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    return {
+        "mean_ms": sum(timings) * 1000 / registrations,
+        "p99_ms": _percentile(timings, 99) * 1000,
+        "requests_per_registration": (_dps.requests - requests) / registrations,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, timeout=10)
+        return output.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(messages: int, iterations: int, registrations: int) -> dict:
+    """Runs every benchmark
+    :returns: The results, with the environment they were measured in
+    """
+    return {
+        "version": RESULTS_VERSION,
+        "commit": _git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "minimqtt": getattr(minimqtt, "__version__", None),
+        "benchmarks": {
+            "device_to_cloud": bench_device_to_cloud(messages),
+            "twin_patch": bench_twin_patch(messages),
+            "dispatch": bench_dispatch(iterations),
+            "sas_token": bench_sas(iterations),
+            "dps_registration": bench_registration(registrations),
+        },
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Compares results with a baseline
+    :param dict results: The results from run
+    :param dict baseline: Earlier results from run
+    :param float threshold: The percentage a metric can get worse by before it counts as a regression
+    :returns: A list of lines describing each metric that got worse by more than the threshold
+    """
+    regressions = []
+
+    for benchmark, metrics in results["benchmarks"].items():
+        for name, value in metrics.items():
+            before = baseline.get("benchmarks", {}).get(benchmark, {}).get(name)
+            if not before or name.startswith("requests_"):
+                continue
+
+            change = (value - before) * 100 / before
+            worse = -change if name.endswith("_per_second") else change
+            if worse > threshold:
+                regressions.append("{}.{}: {:.4g} -> {:.4g} ({:+.1f}%)".format(benchmark, name, before, value, change))
+
+    return regressions
+
+
+def report(results: dict) -> str:
+    """Formats results as a table
+    """
+    lines = ["commit {}, python {}, minimqtt {}".format(results["commit"], results["python"], results["minimqtt"])]
+    for benchmark, metrics in results["benchmarks"].items():
+        lines.append(benchmark)
+        for name, value in metrics.items():
+            lines.append("    {:<30}{:>14.2f}".format(name, value))
+    return "\n".join(lines)
+
+
+def main() -> None:
+    """Runs the benchmarks, prints the results, and writes and compares them if asked to
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000, help="messages and twin patches to send")
+    parser.add_argument("--iterations", type=int, default=2000, help="incoming messages of each kind and SAS tokens")
+    parser.add_argument("--registrations", type=int, default=20, help="DPS registrations")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with this JSON file from an earlier run")
+    parser.add_argument("--threshold", type=float, default=10, help="the percentage a metric can get worse by with --compare")
+    args = parser.parse_args()
+
+    results = run(args.messages, args.iterations, args.registrations)
+    print(report(results))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+
+        if regressions:
+            print("Regressions of more than {}% from {}:".format(args.threshold, args.compare))
+            print("\n".join(regressions))
+            sys.exit(1)
+
+        print("No regressions of more than {}% from {}".format(args.threshold, args.compare))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Measures the time and heap each module of the library takes to import, to keep boot time and RAM use under control
+as the library grows. On the device, copy this file over and run it from the REPL:
+
+    import boot_profile
+    boot_profile.run()
+
+On a computer it uses the stand-ins for the CircuitPython modules in the host folder:
+
+    python boot_profile.py [module ...]
+
+The modules are imported in the order given, so each one is measured without the modules imported before it.
+Modules an import loads that aren't in the list are counted in its cost, and shown beside it.
+"""
+
+import gc
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# the library modules in the order the device classes import them, so each line is the module's own cost
+DEFAULT_MODULES = (
+    "adafruit_logging",
+    "adafruit_minimqtt",
+    "constants",
+    "iot_error",
+    "iot_protocol",
+    "gc_policy",
+    "memory_stats",
+    "metrics",
+    "offline_queue",
+    "publish_window",
+    "reported_properties",
+    "telemetry_batcher",
+    "topic_cache",
+    "topic_router",
+    "twin_mirror",
+    "twin_requests",
+    "direct_methods",
+    "reconnect",
+    "iot_mqtt",
+    "iot_device",
+    "iothub_device",
+    "iotcentral_device",
+    "device_registration",
+    "dps_cache",
+)
+
+
+def _used() -> int:
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return gc.mem_alloc()
+
+
+def profile(modules=DEFAULT_MODULES) -> list:
+    """Imports each module and measures it
+    :param modules: The names of the modules to import, in order
+    :returns: A list with a tuple for each module of its name, the milliseconds the import took,
+    the bytes of heap it left allocated, and the names of the other modules it loaded
+    """
+    if not hasattr(gc, "mem_alloc") and tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    results = []
+    for name in modules:
+        if name in sys.modules:
+            results.append((name, 0, 0, []))
+            continue
+
+        loaded = set(sys.modules)
+        gc.collect()
+        used = _used()
+        start = time.monotonic_ns()
+
+        __import__(name)
+
+        elapsed = (time.monotonic_ns() - start) / 1000000
+        gc.collect()
+        dependencies = sorted(module for module in sys.modules if module not in loaded and module != name)
+        results.append((name, elapsed, _used() - used, dependencies))
+
+    return results
+
+
+def run(modules=DEFAULT_MODULES) -> None:
+    """Imports each module and prints a table of how long it took and the heap it used
+    :param modules: The names of the modules to import, in order
+    """
+    results = profile(modules)
+
+    print("{:<24}{:>10}{:>10}  {}".format("module", "ms", "bytes", "also loaded"))
+    for name, elapsed, allocated, dependencies in results:
+        print("{:<24}{:>10.2f}{:>10}  {}".format(name, elapsed, allocated, ", ".join(dependencies)))
+
+    print("{:<24}{:>10.2f}{:>10}".format("total", sum(result[1] for result in results), sum(result[2] for result in results)))
+
+
+if __name__ == "__main__":
+    try:
+        from host import shims
+
+        shims.install()
+    except ImportError:
+        pass  # running on the device
+
+    run(sys.argv[1:] or DEFAULT_MODULES)
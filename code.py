@@ -41,7 +41,7 @@ if TO_TEST == TEST_IOT_HUB:
         return IoTResponse(200, "OK")
 
     def cloud_to_device_message_received(body: str, properties: dict):
-        print("Received cloud to device message: " + body + " => " + json.dumps(properties))
+        print("Received cloud to device message: " + body + " => " + json.dumps(properties.to_dict()))
 
     def device_twin_desired_updated(property_name: str, property_value, version: int) -> IoTResponse:
         print("Received device twin desired update: version " + str(version) + " => " + property_name + ":" + str(property_value))
@@ -65,10 +65,15 @@ if TO_TEST == TEST_IOT_HUB:
     current_buttons = pad.get_pressed()
     last_read = 0
 
+    # reconnect from loop if the connection drops, instead of ending the main loop
+    MY_DEVICE.enable_reconnect()
+    MY_DEVICE.on_reconnected = lambda outage, attempts: print("Reconnected after", outage, "seconds and", attempts, "attempts")
+
     MY_DEVICE.connect()
 
-    while MY_DEVICE.is_connected():
-        MY_DEVICE.loop()  # do the async work needed to be done for MQTT
+    while True:
+        MY_DEVICE.loop()  # do the async work needed to be done for MQTT, and reconnect if the connection drops
+        CONNECTION.sync_time()  # the clock may have been set from the last boot, so sync it with NTP
 
         # Do whatever
         if (last_read + 0.1) < time.monotonic():
@@ -79,9 +84,10 @@ if TO_TEST == TEST_IOT_HUB:
             current_buttons = buttons
 
         # sample of sending simulated telemetry
-        temp = 32.0 + random.uniform(-20.0, 20.0)
-        state = {"TestTelemetry": random.randint(0, 1024), "Temperature": temp}
-        MY_DEVICE.send_device_to_cloud_message(json.dumps(state))
+        if MY_DEVICE.is_connected():
+            temp = 32.0 + random.uniform(-20.0, 20.0)
+            state = {"TestTelemetry": random.randint(0, 1024), "Temperature": temp}
+            MY_DEVICE.send_device_to_cloud_message(json.dumps(state))
         time.sleep(1)
 
 elif TO_TEST == TEST_IOT_CENTRAL:
@@ -90,6 +96,8 @@ elif TO_TEST == TEST_IOT_CENTRAL:
     import json
     from adafruit_display_text import label
     from iotcentral_device import IoTCentralDevice
+    from dps_cache import DeviceRegistrationCache
+    from telemetry_encoder import TelemetryEncoder
 
     ID_SCOPE = secrets["id_scope"]
     DEVICE_ID = secrets["device_id"]
@@ -149,23 +157,25 @@ elif TO_TEST == TEST_IOT_CENTRAL:
         time.sleep(1)
         image_file.close()
 
-    MY_DEVICE = IoTCentralDevice(WIFI_MANAGER, ID_SCOPE, DEVICE_ID, PRIMARY_KEY)
-
-    def command_executed(command_name, data) -> IoTResponse:
-        print("Received command: " + command_name + " => " + str(data))
+    # Cache the hub assigned by the device provisioning service so the next boot can connect straight to it
+    MY_DEVICE = IoTCentralDevice(WIFI_MANAGER, ID_SCOPE, DEVICE_ID, PRIMARY_KEY, assignment_cache=DeviceRegistrationCache())
 
-        if command_name == "SayHi":
-            showText("Hi\nThere!")
-        if command_name == "SendImage":
-            showImage("smileyface.bmp")
+    def say_hi(request) -> IoTResponse:
+        print("Received command: " + request.name)
+        showText("Hi\nThere!")
+        return IoTResponse(200, "OK")
 
+    def send_image(request) -> IoTResponse:
+        print("Received command: " + request.name)
+        showImage("smileyface.bmp")
         return IoTResponse(200, "OK")
 
     def property_changed(property_name: str, property_value, version) -> IoTResponse:
         print("Received property update: version " + str(version) + " => " + property_name + ":" + str(property_value))
         return IoTResponse(200, "OK")
 
-    MY_DEVICE.on_command_executed = command_executed
+    MY_DEVICE.register_method("SayHi", say_hi)
+    MY_DEVICE.register_method("SendImage", send_image)
     MY_DEVICE.on_connection_status_changed = connection_status_changed
     MY_DEVICE.on_property_changed = property_changed
 
@@ -177,10 +187,23 @@ elif TO_TEST == TEST_IOT_CENTRAL:
     current_buttons = pad.get_pressed()
     last_read = 0
 
-    MY_DEVICE.connect()
+    # the telemetry always has the same keys, so encode it into a reusable buffer instead of with json.dumps
+    TELEMETRY_ENCODER = TelemetryEncoder(("TestTelemetry", "Temperature"), precision=2)
+    telemetry = [0, 0.0]
+
+    # reconnect from loop if the connection drops, instead of ending the main loop
+    MY_DEVICE.enable_reconnect()
+    MY_DEVICE.on_reconnected = lambda outage, attempts: print("Reconnected after", outage, "seconds and", attempts, "attempts")
+
+    # connect without blocking, so the device stays responsive while it is provisioned
+    MY_DEVICE.connect_start()
+    while not MY_DEVICE.connect_poll():
+        current_buttons = pad.get_pressed()
+        time.sleep(0.1)
 
-    while MY_DEVICE.is_connected():
-        MY_DEVICE.loop()  # do the async work needed to be done for MQTT
+    while True:
+        MY_DEVICE.loop()  # do the async work needed to be done for MQTT, and reconnect if the connection drops
+        CONNECTION.sync_time()
 
         if (last_read + 0.1) < time.monotonic():
             buttons = pad.get_pressed()
@@ -190,7 +213,8 @@ elif TO_TEST == TEST_IOT_CENTRAL:
             current_buttons = buttons
 
         # sample of sending simulated telemetry
-        temp = 32.0 + random.uniform(-20.0, 20.0)
-        state = {"TestTelemetry": random.randint(0, 1024), "Temperature": temp}
-        MY_DEVICE.send_telemetry(state)
+        if MY_DEVICE.is_connected():
+            telemetry[0] = random.randint(0, 1024)
+            telemetry[1] = 32.0 + random.uniform(-20.0, 20.0)
+            MY_DEVICE.send_telemetry(TELEMETRY_ENCODER.encode(telemetry))
         time.sleep(1)
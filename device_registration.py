@@ -6,17 +6,11 @@ Handles registration of IoT Central devices, and gets the hostname to use when c
 to IoT Central over MQTT
 """
 
-import gc
-import json
 import time
-import circuitpython_base64 as base64
-import circuitpython_hmac as hmac
-import circuitpython_parse as parse
-from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager
 import adafruit_logging as logging
 from adafruit_logging import Logger
-import adafruit_hashlib as hashlib
-from constants import constants
+from gc_policy import GCPolicy
+import iot_protocol
 
 
 AZURE_HTTP_ERROR_CODES = [400, 401, 404, 403, 412, 429, 500]  # Azure HTTP Status Codes
@@ -32,15 +26,34 @@ class DeviceRegistrationError(Exception):
         self.message = message
 
 
+# pylint: disable=R0902
 class DeviceRegistration:
     """
     Handles registration of IoT Central devices, and gets the hostname to use when connecting
-    to IoT Central over MQTT
+    to IoT Central over MQTT.
+
+    Registration can be run to completion with register_device, or driven from the application's main loop
+    by calling start_registration and then register_device_step until it returns the hostname. Each step makes
+    at most one HTTP request and never sleeps, so the application can keep working while the device provisioning
+    service assigns the device.
+
+    Callers that make their own HTTP requests, such as AsyncIoTMQTT, pass None for the WiFi manager and
+    call next_request, then handle_response or request_failed, once step_delay has passed.
     """
 
-    _dps_endpoint = constants["dpsEndPoint"]
-    _dps_api_version = constants["dpsAPIVersion"]
-    _loop_interval = 2
+    _dps_endpoint = iot_protocol.DPS_ENDPOINT
+
+    # Polling backs off exponentially from the minimum to the maximum interval, unless the service asks for a delay
+    _min_poll_interval = 1
+    _max_poll_interval = 30
+    _max_polls = 20
+    _max_request_retries = 10
+
+    _state_idle = 0
+    _state_register = 1
+    _state_poll = 2
+    _state_assigned = 3
+    _state_failed = 4
 
     @staticmethod
     def _parse_http_status(status_code, status_reason):
@@ -52,16 +65,28 @@ class DeviceRegistration:
             if error == status_code:
                 raise TypeError("Error {0}: {1}".format(status_code, status_reason))
 
-    def __init__(self, wifi_manager: ESPSPI_WiFiManager, id_scope: str, device_id: str, key: str, logger: Logger = None):
+    # pylint: disable=R0913
+    def __init__(
+        self,
+        wifi_manager,
+        id_scope: str,
+        device_id: str,
+        key: str,
+        logger: Logger = None,
+        gc_policy: GCPolicy = None,
+        memory_stats: "MemoryStats" = None,
+    ):
         """Creates an instance of the device registration
-        :param wifi_manager: WiFiManager object from ESPSPI_WiFiManager.
+        :param wifi_manager: WiFiManager object from ESPSPI_WiFiManager, or None if the caller makes the requests
         :param str id_scope: The ID scope of the device to register
         :param str device_id: The device ID of the device to register
         :param str key: The primary or secondary key of the device to register
         :param adafruit_logging.Logger key: The primary or secondary key of the device to register
+        :param GCPolicy gc_policy: When to run the garbage collector around requests, defaults to before and after every request
+        :param MemoryStats memory_stats: Where to record the heap used by each request and response, if anywhere
         """
         wifi_type = str(type(wifi_manager))
-        if "ESPSPI_WiFiManager" not in wifi_type:
+        if wifi_manager is not None and "ESPSPI_WiFiManager" not in wifi_type:
             raise TypeError("This library requires a WiFiManager object.")
 
         self._wifi_manager = wifi_manager
@@ -69,157 +94,279 @@ class DeviceRegistration:
         self._device_id = device_id
         self._key = key
         self._logger = logger if logger is not None else logging.getLogger("log")
+        self._gc_policy = gc_policy if gc_policy is not None else GCPolicy()
+        self._memory_stats = memory_stats
+
+        self._state = self._state_idle
+        self._headers = None
+        self._operation_id = None
+        self._hostname = None
+        self._next_step = 0
+        self._start = 0
+        self._end = 0
+        self._attempts = 0
+        self._polls = 0
+        self._request_retries = 0
 
     @staticmethod
     def compute_derived_symmetric_key(secret, reg_id):
         """Computes a derived symmetric key from a secret and a message
         """
-        secret = base64.b64decode(secret)
-        return base64.b64encode(hmac.new(secret, msg=reg_id.encode("utf8"), digestmod=hashlib.sha256).digest())
+        return iot_protocol.compute_derived_symmetric_key(secret, reg_id)
 
-    def _loop_assign(self, operation_id, headers) -> str:
-        uri = "https://%s/%s/registrations/%s/operations/%s?api-version=%s" % (
-            self._dps_endpoint,
-            self._id_scope,
-            self._device_id,
-            operation_id,
-            self._dps_api_version,
-        )
-        self._logger.info("- iotc :: _loop_assign :: " + uri)
-        target = parse.urlparse(uri)
+    @property
+    def attempts(self) -> int:
+        """The number of HTTP requests made to the device provisioning service by the current registration
+        """
+        return self._attempts
 
-        response = self.__run_get_request_with_retry(target.geturl(), headers)
+    @property
+    def elapsed(self) -> float:
+        """The time in seconds the current registration has taken
+        """
+        if self._state == self._state_idle:
+            return 0
+        if self._state in (self._state_assigned, self._state_failed):
+            return self._end - self._start
+        return time.monotonic() - self._start
+
+    @property
+    def is_registering(self) -> bool:
+        """Gets if a registration has been started and has not yet finished
+        """
+        return self._state in (self._state_register, self._state_poll)
 
-        try:
-            data = response.json()
-        except Exception as error:
-            err = "ERROR: " + str(error) + " => " + str(response)
-            self._logger.error(err)
-            raise DeviceRegistrationError(err)
-
-        loop_try = 0
-
-        if data is not None and "status" in data:
-            if data["status"] == "assigning":
-                time.sleep(self._loop_interval)
-                if loop_try < 20:
-                    loop_try = loop_try + 1
-                    return self._loop_assign(operation_id, headers)
-
-                err = "ERROR: Unable to provision the device."
-                self._logger.error(err)
-                raise DeviceRegistrationError(err)
-
-            if data["status"] == "assigned":
-                state = data["registrationState"]
-                return state["assignedHub"]
-        else:
-            data = str(data)
+    @property
+    def headers(self) -> dict:
+        """The headers to send with each request to the device provisioning service
+        """
+        return self._headers
 
-        err = "DPS L => " + str(data)
-        self._logger.error(err)
+    @property
+    def step_delay(self) -> float:
+        """The time in seconds until register_device_step will next contact the device provisioning service
+        """
+        return max(0, self._next_step - time.monotonic())
+
+    def _fail(self, err: str) -> None:
+        self._logger.error("%s", err)
+        self._state = self._state_failed
+        self._end = time.monotonic()
         raise DeviceRegistrationError(err)
 
-    def __run_put_request_with_retry(self, url, body, headers):
-        retry = 0
-        response = None
+    def _schedule(self, response, interval: float) -> None:
+        """Schedules the next step after the delay the service asked for, or after the given interval
+        """
+        retry_after = None
+        if response is not None and response.headers is not None:
+            retry_after = response.headers.get("retry-after")
 
-        while True:
-            gc.collect()
+        if retry_after is not None:
             try:
-                self._logger.debug("Trying to send...")
-                response = self._wifi_manager.put(url, json=body, headers=headers)
-                self._logger.debug("Sent!")
-                break
-            except RuntimeError as runtime_error:
-                self._logger.info("Could not send data, retrying after 0.5 seconds: " + str(runtime_error))
-                retry = retry + 1
-
-                if retry >= 10:
-                    self._logger.error("Failed to send data")
-                    raise
-
-                time.sleep(0.5)
-                continue
-
-        gc.collect()
-        return response
+                interval = int(retry_after)
+            except ValueError:
+                pass
 
-    def __run_get_request_with_retry(self, url, headers):
-        retry = 0
-        response = None
+        self._next_step = time.monotonic() + interval
 
-        while True:
-            gc.collect()
-            try:
-                self._logger.debug("Trying to send...")
-                response = self._wifi_manager.get(url, headers=headers)
-                self._logger.debug("Sent!")
-                break
-            except RuntimeError as runtime_error:
-                self._logger.info("Could not send data, retrying after 0.5 seconds: " + str(runtime_error))
-                retry = retry + 1
-
-                if retry >= 10:
-                    self._logger.error("Failed to send data")
-                    raise
-
-                time.sleep(0.5)
-                continue
-
-        gc.collect()
+    def _backoff(self, count: int) -> float:
+        return min(self._max_poll_interval, self._min_poll_interval * (2 ** count))
+
+    def _run_request(self, url: str, body=None):
+        """Makes a single request, a PUT if there is a body, otherwise a GET.
+        Returns the response, or None if the request failed and should be retried
+        """
+        self._gc_policy.collect()
+
+        try:
+            self._logger.debug("Trying to send...")
+            response = self._measure("registration", self._send_request, url, body)
+            self._logger.debug("Sent!")
+        except RuntimeError as runtime_error:
+            self.request_failed(runtime_error)
+            return None
+
+        self._gc_policy.collect()
         return response
 
-    def register_device(self, expiry: int) -> str:
+    def _send_request(self, url: str, body):
+        if body is None:
+            return self._wifi_manager.get(url, headers=self._headers)
+        return self._wifi_manager.put(url, json=body, headers=self._headers)
+
+    def _measure(self, operation: str, function, *args):
+        if self._memory_stats is None:
+            return function(*args)
+        return self._memory_stats.measure(operation, function, *args)
+
+    def request_failed(self, error) -> None:
+        """Records that a request returned by next_request could not be made. It is retried after half a second,
+        and the registration fails once too many requests in a row have failed
+        :param error: The exception, which is raised again once the registration has failed
         """
-        Registers the device with the IoT Central device registration service.
-        Returns the hostname of the IoT hub to use over MQTT
-        :param str expiry: The expiry time
+        self._request_retries = self._request_retries + 1
+
+        if self._request_retries >= self._max_request_retries:
+            self._logger.error("Failed to send data")
+            self._state = self._state_failed
+            self._end = time.monotonic()
+            raise error
+
+        self._logger.info("Could not send data, retrying: %s", error)
+        self._next_step = time.monotonic() + 0.5
+
+    def start_registration(self, expiry: int) -> None:
+        """
+        Starts registering the device with the IoT Central device registration service.
+        Call register_device_step until it returns the hostname of the IoT hub to use over MQTT
+        :param int expiry: The expiry time of the registration SAS token
         """
-        # pylint: disable=c0103
-        sr = self._id_scope + "%2Fregistrations%2F" + self._device_id
-        sig_no_encode = DeviceRegistration.compute_derived_symmetric_key(self._key, sr + "\n" + str(expiry))
-        sig_encoded = parse.quote(sig_no_encode, "~()*!.'")
-        auth_string = "SharedAccessSignature sr=" + sr + "&sig=" + sig_encoded + "&se=" + str(expiry) + "&skn=registration"
+        auth_string = iot_protocol.generate_sas_token(
+            iot_protocol.registration_resource_uri(self._id_scope, self._device_id), self._key, expiry, "registration"
+        )
 
-        headers = {
+        self._headers = {
             "content-type": "application/json; charset=utf-8",
             "user-agent": "iot-central-client/1.0",
             "Accept": "*/*",
+            "authorization": auth_string,
         }
 
-        if auth_string is not None:
-            headers["authorization"] = auth_string
+        self._state = self._state_register
+        self._operation_id = None
+        self._hostname = None
+        self._start = time.monotonic()
+        self._next_step = self._start
+        self._attempts = 0
+        self._polls = 0
+        self._request_retries = 0
 
-        body = {"registrationId": self._device_id}
+    def register_device_step(self) -> str:
+        """
+        Moves the registration started by start_registration on, if it is time to contact the service again.
+        Makes at most one HTTP request, and never sleeps
+        Returns the hostname of the IoT hub to use over MQTT once the device is assigned, otherwise None
+        """
+        if self._state == self._state_assigned:
+            return self._hostname
+        if self._state == self._state_idle:
+            raise DeviceRegistrationError("start_registration has not been called")
+        if self._state == self._state_failed:
+            raise DeviceRegistrationError("Unable to provision the device.")
+
+        if time.monotonic() < self._next_step:
+            return None
+
+        url, body = self.next_request()
+        response = self._run_request(url, body)
+        if response is None:
+            return None
+
+        return self._measure("registration", self.handle_response, response)
+
+    def next_request(self) -> tuple:
+        """Gets the next request to make to the device provisioning service, once step_delay has passed.
+        Send it with the headers, as a PUT with the body as JSON if there is a body, otherwise as a GET
+        :returns: A tuple of the URL and the body, which is None for a GET
+        """
+        if self._state not in (self._state_register, self._state_poll):
+            raise DeviceRegistrationError("No registration is in progress")
 
-        uri = "https://%s/%s/registrations/%s/register?api-version=%s" % (
-            self._dps_endpoint,
-            self._id_scope,
-            self._device_id,
-            self._dps_api_version,
-        )
-        target = parse.urlparse(uri)
+        self._attempts = self._attempts + 1
 
-        self._logger.info("Connecting...")
-        self._logger.info("URL: " + target.geturl())
-        self._logger.info("body: " + json.dumps(body))
-        print("headers: " + json.dumps(headers))
+        if self._state == self._state_register:
+            url = iot_protocol.dps_register_url(self._id_scope, self._device_id)
+            body = {"registrationId": self._device_id}
 
-        response = self.__run_put_request_with_retry(target.geturl(), body, headers)
+            self._logger.info("Connecting...")
+            self._logger.debug("URL: %s", url)
+            self._logger.debug("body: %s", body)
+            return url, body
+
+        url = iot_protocol.dps_operation_url(self._id_scope, self._device_id, self._operation_id)
+        self._logger.debug("- iotc :: _loop_assign :: %s", url)
+        return url, None
+
+    def handle_response(self, response) -> str:
+        """Moves the registration on with the response to the request from next_request
+        :param response: The response, with status_code, headers and a json method
+        :returns: The hostname of the IoT hub to use over MQTT once the device is assigned, otherwise None
+        """
+        self._request_retries = 0
+
+        if self._state == self._state_register:
+            self._register_response(response)
+        else:
+            self._poll_response(response)
+
+        if self._state == self._state_assigned:
+            self._end = time.monotonic()
+            self._logger.info("Device assigned after %ss and %s requests", self.elapsed, self._attempts)
+            return self._hostname
+
+        return None
+
+    def _register_response(self, response) -> None:
+        if response.status_code == 429:
+            # throttled, try again once the service says to
+            self._schedule(response, self._backoff(self._attempts - 1))
+            return
 
         data = None
         try:
             data = response.json()
         except Exception as e:
-            err = "ERROR: non JSON is received from " + self._dps_endpoint + " => " + str(response) + " .. message : " + str(e)
-            self._logger.error(err)
-            raise DeviceRegistrationError(err)
+            self._fail("ERROR: non JSON is received from " + self._dps_endpoint + " => " + str(response) + " .. message : " + str(e))
 
         if "errorCode" in data:
-            err = "DPS => " + str(data)
-            self._logger.error(err)
-            raise DeviceRegistrationError(err)
+            self._fail("DPS => " + str(data))
+
+        self._operation_id = data["operationId"]
+        self._state = self._state_poll
+        self._schedule(response, self._backoff(0))
+
+    def _poll_response(self, response) -> None:
+        if response.status_code == 429:
+            self._schedule(response, self._backoff(self._polls))
+            return
+
+        try:
+            data = response.json()
+        except Exception as error:
+            self._fail("ERROR: " + str(error) + " => " + str(response))
+
+        if data is None or "status" not in data:
+            self._fail("DPS L => " + str(data))
+
+        status = data["status"]
+
+        if status == "assigned":
+            self._hostname = data["registrationState"]["assignedHub"]
+            self._state = self._state_assigned
+            return
+
+        if status == "assigning":
+            self._polls = self._polls + 1
+            if self._polls >= self._max_polls:
+                self._fail("ERROR: Unable to provision the device.")
+
+            self._schedule(response, self._backoff(self._polls))
+            return
+
+        # failed, disabled or unassigned
+        self._fail("DPS L => " + str(data))
+
+    def register_device(self, expiry: int) -> str:
+        """
+        Registers the device with the IoT Central device registration service.
+        Returns the hostname of the IoT hub to use over MQTT
+        :param int expiry: The expiry time
+        """
+        self.start_registration(expiry)
+
+        while True:
+            hostname = self.register_device_step()
+            if hostname is not None:
+                return hostname
 
-        time.sleep(1)
-        return self._loop_assign(data["operationId"], headers)
+            time.sleep(self.step_delay)
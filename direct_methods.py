@@ -0,0 +1,76 @@
+"""Dispatch of direct methods to handlers registered by method name
+"""
+
+import json
+from iot_protocol import IoTResponse
+
+
+class DirectMethodRequest:
+    """A direct method invocation. The payload is only parsed from JSON the first time it is read
+    """
+
+    def __init__(self, name: str, raw: str):
+        self._name = name
+        self._raw = raw
+        self._payload = None
+        self._parsed = False
+
+    @property
+    def name(self) -> str:
+        """The name of the method
+        """
+        return self._name
+
+    @property
+    def raw(self) -> str:
+        """The payload as it was received
+        """
+        return self._raw
+
+    @property
+    def payload(self):
+        """The payload parsed from JSON, or None if there is no payload
+        """
+        if not self._parsed:
+            if self._raw and self._raw.strip():
+                self._payload = json.loads(self._raw)
+            self._parsed = True
+
+        return self._payload
+
+
+class DirectMethodRegistry:
+    """Looks up the handler for a direct method by name
+    """
+
+    def __init__(self):
+        self._handlers = {}
+
+    def register(self, method_name: str, handler) -> None:
+        """Registers the handler for a method, replacing any existing handler
+        :param str method_name: The name of the method
+        :param handler: The function to call with a DirectMethodRequest, returning an IoTResponse
+        """
+        self._handlers[method_name] = handler
+
+    def unregister(self, method_name: str) -> None:
+        """Removes the handler for a method
+        :param str method_name: The name of the method
+        """
+        self._handlers.pop(method_name, None)
+
+    def dispatch(self, method_name: str, data: str) -> IoTResponse:
+        """Calls the handler for a method
+        :param str method_name: The name of the method
+        :param str data: The payload of the method call
+        :returns: The handler's response, or None if no handler is registered for the method
+        """
+        handler = self._handlers.get(method_name)
+        if handler is None:
+            return None
+
+        response = handler(DirectMethodRequest(method_name, data))
+        if response is None:
+            response = IoTResponse(200, None)
+
+        return response
@@ -0,0 +1,69 @@
+"""Cache of the IoT Hub assigned to a device by the device provisioning service
+"""
+
+import json
+import os
+
+
+class DeviceRegistrationCache:
+    """Stores the IoT Hub hostname assigned to a device on the filesystem, so the device can connect
+    straight to its hub on the next boot instead of registering with the device provisioning service.
+
+    The entry is keyed by a hash of the ID scope, device ID and key, so changing any of them invalidates it.
+    The filesystem must be writable from code to store entries, on CircuitPython this means remounting
+    the CIRCUITPY drive in boot.py.
+    """
+
+    def __init__(self, path: str = "/dps_cache.json"):
+        """Create the cache
+        :param str path: The file to store the cached assignment in
+        """
+        self._path = path
+
+    @staticmethod
+    def _cache_key(id_scope: str, device_id: str, key: str) -> str:
+        import adafruit_hashlib as hashlib  # pylint: disable=C0415
+
+        return hashlib.sha256((id_scope + "\n" + device_id + "\n" + key).encode("utf-8")).hexdigest()
+
+    def get(self, id_scope: str, device_id: str, key: str) -> str:
+        """Gets the cached hub hostname for a device
+        :param str id_scope: The ID scope of the device
+        :param str device_id: The device ID of the device
+        :param str key: The primary or secondary key of the device
+        :returns: The hostname, or None if there is no valid cached assignment
+        """
+        try:
+            with open(self._path, "r") as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get("key") != self._cache_key(id_scope, device_id, key):
+            return None
+
+        return entry.get("hostname")
+
+    def set(self, id_scope: str, device_id: str, key: str, hostname: str) -> bool:
+        """Caches the hub hostname assigned to a device
+        :param str id_scope: The ID scope of the device
+        :param str device_id: The device ID of the device
+        :param str key: The primary or secondary key of the device
+        :param str hostname: The hostname of the assigned hub
+        :returns: True if the assignment was stored, False if the filesystem is read-only
+        """
+        try:
+            with open(self._path, "w") as cache_file:
+                json.dump({"key": self._cache_key(id_scope, device_id, key), "hostname": hostname}, cache_file)
+        except OSError:
+            return False
+
+        return True
+
+    def clear(self) -> None:
+        """Removes the cached assignment
+        """
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
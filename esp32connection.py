@@ -46,9 +46,12 @@ Implementation Notes
 __version__ = "0.0.0-auto.0"
 __repo__ = "https://github.com/jimbobbennett/CircuitPython_ESP32Connection.git"
 
+import json
 import time
 import board
+import rtc
 import busio
+import supervisor
 from digitalio import DigitalInOut
 import adafruit_minimqtt as MQTT
 import adafruit_esp32spi.adafruit_esp32spi_socket as socket
@@ -58,44 +61,48 @@ from adafruit_ntp import NTP
 import adafruit_logging as logging
 
 
-def __connect(cs_pin, ready_pin, reset_pin, secrets) -> ESPSPI_WiFiManager:
-    logger = logging.getLogger("log")
+# CircuitPython starts the clock at 2000-01-01 when the board powers up, so any earlier year means it hasn't been set
+_VALID_YEAR = 2020
 
-    spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
-    esp = adafruit_esp32spi.ESP_SPIcontrol(spi, cs_pin, ready_pin, reset_pin)
 
-    wifi = ESPSPI_WiFiManager(esp, secrets, attempts=5)
-
-    # MQTT.set_socket(socket, esp)
-
-    logger.debug("MAC addr: " + ", ".join([hex(i) for i in esp.MAC_address]))
-    logger.debug("Connecting to AP...")
-
-    wifi.connect()
-
-    logger.info("Connected to " + str(esp.ssid, "utf-8") + "\tRSSI: " + str(esp.rssi))
-    logger.debug("My IP address is " + esp.pretty_ip(esp.ip_address))
-
-    logger.debug("Setting time")
-
-    ntp = NTP(esp)
-    while not ntp.valid_time:
-        ntp.set_time()
-        logger.debug("Failed to obtain time, retrying in 1 second...")
-        time.sleep(1)
-
-    logger.info("Time: " + str(time.time()))
-
-    return wifi
+def _started_by_reload() -> bool:
+    """Gets if code.py was started by a reload, such as after saving a file or from the REPL, rather than by the
+    board starting up. Only a reload keeps the monotonic clock running from before
+    """
+    try:
+        return supervisor.runtime.run_reason != supervisor.RunReason.STARTUP
+    except AttributeError:
+        return False  # CircuitPython before 7.0 can't tell, so every start is treated as a power cycle
 
 
 class Connection:
     """
     A WiFi connection helper for ESP32-based boards
+
+    The access point, and the time from the last NTP sync, are stored on the filesystem so a reload
+    doesn't have to wait for NTP before it can sign a SAS token. The time is taken from the real time clock
+    if it survived the reset, otherwise from the stored time if code.py was started by a reload,
+    and NTP is synced again in the background by sync_time. After a power cycle or reset connecting waits for NTP.
     """
 
-    def __init__(self):
+    def __init__(self, cache_path: str = "/wifi_cache.json", max_drift: float = 300, sync_interval: float = 5):
+        """
+        Create the connection helper
+        :param str cache_path: The file to store the access point and time in
+        :param float max_drift: The seconds the clock can be corrected by when NTP syncs before a warning is logged
+        :param float sync_interval: The seconds between NTP attempts in sync_time
+        """
         self.wifi = None
+        self.timings = {}
+        self.time_source = None
+        self.drift = None
+        self._esp = None
+        self._ntp = None
+        self._cache_path = cache_path
+        self._cache = {}
+        self._max_drift = max_drift
+        self._sync_interval = sync_interval
+        self._next_sync = 0
 
     def connect(self, secrets) -> ESPSPI_WiFiManager:
         """
@@ -112,5 +119,133 @@ class Connection:
             esp32_ready = DigitalInOut(board.D11)
             esp32_reset = DigitalInOut(board.D12)
 
-        self.wifi = __connect(esp32_cs, esp32_ready, esp32_reset, secrets)
+        self.wifi = self._connect(esp32_cs, esp32_ready, esp32_reset, secrets)
         return self.wifi
+
+    def _connect(self, cs_pin, ready_pin, reset_pin, secrets) -> ESPSPI_WiFiManager:
+        logger = logging.getLogger("log")
+        self.timings = {}
+        started = time.monotonic()
+
+        spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
+        esp = adafruit_esp32spi.ESP_SPIcontrol(spi, cs_pin, ready_pin, reset_pin)
+        self._esp = esp
+        phase_started = self._end_phase("spi", started)
+
+        wifi = ESPSPI_WiFiManager(esp, secrets, attempts=5)
+
+        # MQTT.set_socket(socket, esp)
+
+        logger.debug("MAC addr: " + ", ".join([hex(i) for i in esp.MAC_address]))
+        logger.debug("Connecting to AP...")
+
+        self._cache = self._load_cache()
+
+        # the ESP32 firmware only reports being connected once DHCP has given it an address, so this covers both
+        wifi.connect()
+        phase_started = self._end_phase("association", phase_started)
+
+        bssid = self._bssid()
+        if self._cache.get("bssid") not in (None, bssid):
+            logger.info("Joined a different access point to last time")
+
+        logger.info("Connected to " + str(esp.ssid, "utf-8") + "\tRSSI: " + str(esp.rssi))
+        logger.debug("My IP address is " + esp.pretty_ip(esp.ip_address))
+
+        logger.debug("Setting time")
+
+        self._ntp = NTP(esp)
+        self._set_time(logger)
+        self._end_phase("time", phase_started)
+        self.timings["total"] = time.monotonic() - started
+
+        self._cache["ssid"] = secrets["ssid"]
+        self._cache["bssid"] = bssid
+        self._save_cache()
+
+        logger.info("Time: " + str(time.time()) + " from " + self.time_source)
+        logger.info("Connection timings: " + str(self.timings))
+
+        return wifi
+
+    def _end_phase(self, name: str, phase_started: float) -> float:
+        now = time.monotonic()
+        self.timings[name] = now - phase_started
+        return now
+
+    def _bssid(self) -> str:
+        try:
+            return ":".join(["%02x" % i for i in self._esp.bssid])
+        except AttributeError:
+            return None  # older ESP32SPI releases can't read the BSSID
+
+    def _set_time(self, logger) -> None:
+        if time.localtime().tm_year >= _VALID_YEAR:
+            # the real time clock kept its time over a soft reset
+            self.time_source = "rtc"
+        elif "time" in self._cache and _started_by_reload() and time.monotonic() >= self._cache.get("monotonic", time.monotonic() + 1):
+            # the monotonic clock carries on over a reload, so moving the stored time on by it gives the real time.
+            # After a power cycle or reset it starts again, and soon passes the stored value, so that can't tell the two
+            # apart. The stored time could then be any amount behind, and the hub refuses SAS tokens signed with it
+            elapsed = time.monotonic() - self._cache["monotonic"]
+            rtc.RTC().datetime = time.localtime(int(self._cache["time"] + elapsed))
+            self.time_source = "cache"
+        else:
+            while not self._ntp.valid_time:
+                self._ntp.set_time()
+                if not self._ntp.valid_time:
+                    logger.debug("Failed to obtain time, retrying in 1 second...")
+                    time.sleep(1)
+
+            self.time_source = "ntp"
+            self.drift = 0
+            self._store_time()
+
+    def _store_time(self) -> None:
+        self._cache["time"] = time.time()
+        self._cache["monotonic"] = time.monotonic()
+
+    def _load_cache(self) -> dict:
+        try:
+            with open(self._cache_path, "r") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self) -> None:
+        try:
+            with open(self._cache_path, "w") as cache_file:
+                json.dump(self._cache, cache_file)
+        except OSError:
+            pass  # the filesystem is read-only unless boot.py remounts it
+
+    def sync_time(self) -> bool:
+        """
+        Syncs the clock with NTP if it was set from the real time clock or the stored time when connecting.
+        Call this from the main loop, it makes one NTP request every sync_interval seconds until one succeeds.
+        Returns True once the clock has been synced. drift is then the number of seconds the clock was corrected by
+        """
+        if self.drift is not None:
+            return True
+
+        if self._ntp is None or time.monotonic() < self._next_sync:
+            return False
+
+        self._next_sync = time.monotonic() + self._sync_interval
+
+        estimate = time.time()
+        self._ntp.set_time()
+        if not self._ntp.valid_time:
+            return False
+
+        logger = logging.getLogger("log")
+        self.drift = time.time() - estimate
+        if abs(self.drift) > self._max_drift:
+            # the token is renewed when the corrected clock says so, so a token signed with a late clock is renewed early
+            logger.warning("The clock was " + str(self.drift) + " seconds out, it has been corrected by NTP")
+        else:
+            logger.info("Time synced, the clock was " + str(self.drift) + " seconds out")
+
+        self._store_time()
+        self._save_cache()
+        return True
@@ -0,0 +1,141 @@
+"""Policies for when to run the garbage collector around network requests
+"""
+
+import gc
+import time
+
+try:
+    from time import monotonic_ns as _monotonic_ns
+except ImportError:
+
+    def _monotonic_ns() -> int:
+        return int(time.monotonic() * 1000000000)
+
+
+class GCPolicy:
+    """Decides whether to run a full garbage collection before and after each network request, and counts
+    the collections made and the time spent in them.
+
+    This base class collects every time, which keeps the heap as unfragmented as possible but costs
+    milliseconds per request on a heap with many live objects. Subclass it and override should_collect
+    to make a different tradeoff.
+    """
+
+    def __init__(self):
+        self._collections = 0
+        self._skipped = 0
+        self._collect_time_ns = 0
+        self._max_collect_time_ns = 0
+
+    @property
+    def collections(self) -> int:
+        """The number of garbage collections run
+        """
+        return self._collections
+
+    @property
+    def skipped(self) -> int:
+        """The number of times the policy decided not to collect
+        """
+        return self._skipped
+
+    @property
+    def collect_time(self) -> float:
+        """The total time spent collecting, in seconds
+        """
+        return self._collect_time_ns / 1000000000
+
+    @property
+    def max_collect_time(self) -> float:
+        """The longest single collection, in seconds
+        """
+        return self._max_collect_time_ns / 1000000000
+
+    def reset_counters(self) -> None:
+        """Sets all the counters back to zero
+        """
+        self._collections = 0
+        self._skipped = 0
+        self._collect_time_ns = 0
+        self._max_collect_time_ns = 0
+
+    def should_collect(self) -> bool:
+        """Gets if a garbage collection should be run now
+        """
+        return True
+
+    def collect(self) -> None:
+        """Runs a garbage collection if the policy says to. Called before and after each network request
+        """
+        if not self.should_collect():
+            self._skipped += 1
+            return
+
+        start = _monotonic_ns()
+        gc.collect()
+        duration = _monotonic_ns() - start
+
+        self._collections += 1
+        self._collect_time_ns += duration
+        if duration > self._max_collect_time_ns:
+            self._max_collect_time_ns = duration
+
+
+class AlwaysCollectPolicy(GCPolicy):
+    """Collects before and after every network request, the default
+    """
+
+
+class LowMemoryCollectPolicy(GCPolicy):
+    """Only collects once the free heap drops below a threshold. Where gc.mem_free is not available,
+    such as on CPython, this always collects
+    """
+
+    def __init__(self, min_free: int = 16384):
+        """Create the policy
+        :param int min_free: The number of free bytes on the heap below which to collect
+        """
+        super().__init__()
+        self._min_free = min_free
+
+    def should_collect(self) -> bool:
+        """Gets if the free heap is below the threshold
+        """
+        mem_free = getattr(gc, "mem_free", None)
+        return mem_free is None or mem_free() < self._min_free
+
+
+class EveryNCollectPolicy(GCPolicy):
+    """Collects on every nth call, spreading the cost of collecting over several requests
+    """
+
+    def __init__(self, interval: int = 10):
+        """Create the policy
+        :param int interval: Collect on one call in this many
+        """
+        super().__init__()
+        if interval < 1:
+            raise ValueError("interval must be at least 1")
+
+        self._interval = interval
+        self._calls = 0
+
+    def should_collect(self) -> bool:
+        """Gets if this is the nth call since the last collection
+        """
+        self._calls += 1
+        if self._calls < self._interval:
+            return False
+
+        self._calls = 0
+        return True
+
+
+class NeverCollectPolicy(GCPolicy):
+    """Never collects, leaving it to the runtime to collect when an allocation fails
+    """
+
+    def should_collect(self) -> bool:
+        """Always False
+        """
+        return False
@@ -0,0 +1,3 @@
+"""Host side tools for running this library under CPython, without a board or a network connection.
+These are not needed on the device, so don't copy this folder to CIRCUITPY.
+"""
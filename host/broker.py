@@ -0,0 +1,210 @@
+"""A local stand-in for the IoT Hub MQTT broker, for running the library under CPython without a network.
+
+It speaks enough MQTT 3.1.1 for MiniMQTT: CONNECT, SUBSCRIBE, PUBLISH at QoS 0 and 1, PINGREQ and DISCONNECT,
+and answers device twin GET and reported property PATCH requests the way IoT Hub does.
+"""
+
+import json
+import struct
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length % 0x80
+        length //= 0x80
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def _encode_publish(topic: str, payload: bytes) -> bytes:
+    topic = topic.encode("utf-8")
+    body = struct.pack("!H", len(topic)) + topic + payload
+    return b"\x30" + _encode_length(len(body)) + body
+
+
+class BrokerConnection:
+    """The broker end of one client connection. Bytes the client sends are parsed as soon as a whole packet
+    has arrived, and any replies are buffered for the client to read
+    """
+
+    def __init__(self, broker):
+        self._broker = broker
+        self._incoming = bytearray()
+        self._outgoing = bytearray()
+        self.client_id = None
+        self.username = None
+        self.password = None
+        self.subscriptions = []
+        self.connected = False
+        self.closed = False
+
+    def receive(self, data) -> None:
+        """Takes bytes sent by the client
+        """
+        self._incoming += data
+        self._broker.bytes_in += len(data)
+
+        while self._process_packet():
+            pass
+
+    def read(self, size: int) -> bytes:
+        """Gets up to size bytes sent to the client, or no bytes if there is nothing waiting
+        """
+        data = bytes(self._outgoing[:size])
+        del self._outgoing[:size]
+        return data
+
+    @property
+    def pending(self) -> int:
+        """The number of bytes waiting to be read by the client
+        """
+        return len(self._outgoing)
+
+    def deliver(self, topic: str, payload) -> None:
+        """Sends a QoS 0 message to the client
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        packet = _encode_publish(topic, payload)
+        self._outgoing += packet
+        self._broker.bytes_out += len(packet)
+
+    def _send(self, packet: bytes) -> None:
+        self._outgoing += packet
+        self._broker.bytes_out += len(packet)
+
+    def _process_packet(self) -> bool:
+        if len(self._incoming) < 2:
+            return False
+
+        length = 0
+        shift = 0
+        index = 1
+        while True:
+            if index >= len(self._incoming):
+                return False
+            byte = self._incoming[index]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            index += 1
+            if not byte & 0x80:
+                break
+
+        if len(self._incoming) < index + length:
+            return False
+
+        packet_type = self._incoming[0]
+        body = bytes(self._incoming[index : index + length])
+        del self._incoming[: index + length]
+
+        handler = {0x10: self._on_connect, 0x80: self._on_subscribe, 0x30: self._on_publish, 0xC0: self._on_ping, 0xE0: self._on_disconnect}
+        handler.get(packet_type & 0xF0, self._on_unknown)(packet_type, body)
+        return True
+
+    @staticmethod
+    def _read_string(body: bytes, offset: int):
+        length = struct.unpack_from("!H", body, offset)[0]
+        return body[offset + 2 : offset + 2 + length].decode("utf-8"), offset + 2 + length
+
+    def _on_connect(self, _, body: bytes) -> None:
+        flags = body[7]
+        offset = 10
+        self.client_id, offset = self._read_string(body, offset)
+
+        if flags & 0x04:  # last will
+            _, offset = self._read_string(body, offset)
+            _, offset = self._read_string(body, offset)
+        if flags & 0x80:
+            self.username, offset = self._read_string(body, offset)
+        if flags & 0x40:
+            self.password, offset = self._read_string(body, offset)
+
+        return_code = self._broker.authenticate(self)
+        self.connected = return_code == 0
+        self._send(bytes([0x20, 0x02, 0x00, return_code]))
+
+    def _on_subscribe(self, _, body: bytes) -> None:
+        packet_id = body[:2]
+        offset = 2
+        return_codes = bytearray()
+
+        while offset < len(body):
+            topic, offset = self._read_string(body, offset)
+            qos = body[offset]
+            offset += 1
+            self.subscriptions.append(topic)
+            return_codes.append(min(qos, 1))
+
+        self._send(bytes([0x90, 2 + len(return_codes)]) + packet_id + bytes(return_codes))
+
+    def _on_publish(self, packet_type: int, body: bytes) -> None:
+        topic, offset = self._read_string(body, 0)
+        qos = (packet_type >> 1) & 0x03
+
+        if qos > 0:
+            packet_id = body[offset : offset + 2]
+            offset += 2
+            self._send(b"\x40\x02" + packet_id)
+
+        self._broker.on_publish(self, topic, body[offset:])
+
+    def _on_ping(self, *_) -> None:
+        self._send(b"\xd0\x00")
+
+    def _on_disconnect(self, *_) -> None:
+        self.connected = False
+        self.closed = True
+
+    def _on_unknown(self, packet_type: int, _) -> None:
+        raise ValueError("Unsupported MQTT packet type " + hex(packet_type))
+
+
+class LocalBroker:
+    """An in-process MQTT broker that behaves like IoT Hub for a single device or a whole simulated fleet
+    """
+
+    def __init__(self, twin: dict = None):
+        """Create the broker
+        :param dict twin: The device twin returned to every device, defaults to an empty twin
+        """
+        self.twin = twin if twin is not None else {"desired": {"$version": 1}, "reported": {"$version": 1}}
+        self.connections = []
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.on_message = None
+        self.refuse_code = 0
+        self._reported_version = self.twin.get("reported", {}).get("$version", 1)
+
+    def connect(self) -> BrokerConnection:
+        """Opens a new client connection
+        """
+        connection = BrokerConnection(self)
+        self.connections.append(connection)
+        return connection
+
+    # pylint: disable=W0613
+    def authenticate(self, connection: BrokerConnection) -> int:
+        """Gets the CONNACK return code for a connecting client, 0 unless refuse_code has been set
+        """
+        return self.refuse_code
+
+    def on_publish(self, connection: BrokerConnection, topic: str, payload: bytes) -> None:
+        """Handles a message published by a client
+        """
+        self.messages += 1
+
+        if topic.startswith("$iothub/twin/GET/"):
+            connection.deliver("$iothub/twin/res/200/?$rid=" + topic[topic.find("$rid=") + 5 :], json.dumps(self.twin))
+        elif topic.startswith("$iothub/twin/PATCH/properties/reported/"):
+            self._reported_version += 1
+            rid = topic[topic.find("$rid=") + 5 :]
+            connection.deliver("$iothub/twin/res/204/?$rid=" + rid + "&$version=" + str(self._reported_version), b"")
+
+        if self.on_message is not None:
+            self.on_message(connection, topic, payload)
@@ -0,0 +1,87 @@
+"""Precompiles the library to .mpy files with mpy-cross, ready to copy to the CIRCUITPY drive.
+
+CircuitPython compiles a .py file to bytecode every time it is imported, which takes time at boot and needs
+enough free heap for the compiler on top of the module. A .mpy file is already bytecode, so it loads faster
+and leaves more of the heap free. mpy-cross must be the version for the CircuitPython release on the board,
+download it from https://adafruit-circuit-python.s3.amazonaws.com/index.html?prefix=bin/mpy-cross/
+
+Run from the root of the repo:
+
+    python -m host.build_mpy [--mpy-cross path/to/mpy-cross] [--output build]
+
+The output folder then holds the compiled library in lib, and code.py, secrets.py and the sample image,
+which stay as they are so they can still be edited on the device.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# copied as they are, CircuitPython only runs code.py from source and secrets.py is edited on the device
+SOURCE_FILES = ("code.py", "secrets.py", "smileyface.bmp")
+
+# modules that don't run on CircuitPython
+EXCLUDED_MODULES = ("async_iot_mqtt.py",)
+
+
+def library_modules(root: str = _ROOT) -> list:
+    """Gets the file names of the library modules to compile
+    :param str root: The root of the repo
+    """
+    return sorted(
+        name for name in os.listdir(root) if name.endswith(".py") and name not in SOURCE_FILES and name not in EXCLUDED_MODULES
+    )
+
+
+def build(output: str, mpy_cross: str = "mpy-cross", root: str = _ROOT) -> list:
+    """Compiles the library modules and copies the source files to the output folder
+    :param str output: The folder to write to
+    :param str mpy_cross: The mpy-cross executable
+    :param str root: The root of the repo
+    :returns: A list with a tuple for each module of its name, the size of its source and the size of its .mpy file
+    """
+    lib = os.path.join(output, "lib")
+    os.makedirs(lib, exist_ok=True)
+
+    sizes = []
+    for name in library_modules(root):
+        source = os.path.join(root, name)
+        compiled = os.path.join(lib, name[:-3] + ".mpy")
+        subprocess.run([mpy_cross, "-s", name, "-o", compiled, source], check=True)
+        sizes.append((name, os.path.getsize(source), os.path.getsize(compiled)))
+
+    for name in SOURCE_FILES:
+        shutil.copy(os.path.join(root, name), os.path.join(output, name))
+
+    return sizes
+
+
+def main() -> None:
+    """Builds the library from the command line
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mpy-cross", default="mpy-cross", help="the mpy-cross executable for the board's CircuitPython version")
+    parser.add_argument("--output", default=os.path.join(_ROOT, "build"), help="the folder to write the compiled library to")
+    args = parser.parse_args()
+
+    try:
+        version = subprocess.run([args.mpy_cross, "--version"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError) as error:
+        print("Can't run {}: {}".format(args.mpy_cross, error))
+        sys.exit(1)
+
+    print(version)
+    sizes = build(args.output, args.mpy_cross)
+
+    for name, source_size, compiled_size in sizes:
+        print("{:<28}{:>8}{:>8}".format(name, source_size, compiled_size))
+    print("{:<28}{:>8}{:>8}".format("total", sum(size[1] for size in sizes), sum(size[2] for size in sizes)))
+    print("Copy the contents of {} to the CIRCUITPY drive".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""An in-process stand-in for the Azure IoT device provisioning service HTTP endpoint
+"""
+
+import json
+
+
+class Response:
+    """The parts of an adafruit_requests response used by DeviceRegistration
+    """
+
+    def __init__(self, status_code: int, body: dict, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers if headers is not None else {}
+        self._body = body
+
+    def json(self) -> dict:
+        """Gets the body parsed from JSON
+        """
+        return json.loads(json.dumps(self._body))
+
+
+class LocalDPS:
+    """Assigns every device that registers to the same hub. A registration reports assigning for a number of
+    polls before it is assigned, and every response asks the device to poll again after retry_after seconds
+    """
+
+    def __init__(self, assigned_hub: str = "sim-hub.azure-devices.net", polls_until_assigned: int = 1, retry_after: int = 0):
+        """Create the service
+        :param str assigned_hub: The hostname of the hub devices are assigned to
+        :param int polls_until_assigned: The number of polls that report assigning before the device is assigned
+        :param int retry_after: The retry-after header value sent with each response, in seconds
+        """
+        self.assigned_hub = assigned_hub
+        self.polls_until_assigned = polls_until_assigned
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttle = 0
+        self._operations = {}
+        self._next_operation = 0
+
+    def _headers(self) -> dict:
+        return {"retry-after": str(self.retry_after)}
+
+    def request(self, method: str, url: str, body: dict = None) -> Response:
+        """Handles a request to the service
+        :param str method: GET or PUT
+        :param str url: The URL of the request
+        :param dict body: The JSON body of a PUT
+        """
+        self.requests += 1
+
+        if self.throttle > 0:
+            self.throttle -= 1
+            return Response(429, {"errorCode": 429001, "message": "Throttled"}, self._headers())
+
+        path = url.split("?", 1)[0]
+        parts = path.split("/")
+
+        if method == "PUT" and parts[-1] == "register":
+            self._next_operation += 1
+            operation_id = "op-" + str(self._next_operation)
+            self._operations[operation_id] = [body["registrationId"], 0]
+            return Response(202, {"operationId": operation_id, "status": "assigning"}, self._headers())
+
+        if method == "GET" and len(parts) > 2 and parts[-2] == "operations":
+            operation = self._operations.get(parts[-1])
+            if operation is None:
+                return Response(404, {"errorCode": 404002, "message": "Operation not found"})
+
+            operation[1] += 1
+            if operation[1] <= self.polls_until_assigned:
+                return Response(202, {"operationId": parts[-1], "status": "assigning"}, self._headers())
+
+            del self._operations[parts[-1]]
+            registration_state = {"registrationId": operation[0], "assignedHub": self.assigned_hub, "deviceId": operation[0], "status": "assigned"}
+            return Response(200, {"operationId": parts[-1], "status": "assigned", "registrationState": registration_state})
+
+        return Response(404, {"errorCode": 404000, "message": "Not found"})
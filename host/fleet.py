@@ -0,0 +1,397 @@
+"""Simulates a fleet of devices in one CPython process, to load test a broker and size the backend.
+
+Each simulated device is a real IoTHubDevice or IoTCentralDevice running over the host stand-ins, so it
+connects, subscribes, reads its twin and sends telemetry exactly as it would on a board. By default every
+device connects to an in-process LocalBroker, and IoT Central devices are provisioned by a LocalDPS, so the
+simulator runs offline. Pass --broker to connect to a real MQTT broker over TCP instead.
+
+Run from the root of the repo, after installing the libraries in requirements.txt and adafruit-circuitpython-logging:
+
+    python -m host.fleet --devices 1000 --rate 0.5 --ramp 10 --duration 30
+
+Memory is measured with tracemalloc while the fleet connects, which slows connecting down,
+so pass --no-memory when the connect latency matters most.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from host import shims
+from host.broker import LocalBroker
+from host.dps import LocalDPS
+from host.tcp import TcpBroker
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+KEY = "a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2U="
+ID_SCOPE = "0neSIMFLEET"
+DEFAULT_TEMPLATE = os.path.join(_ROOT, "CircuitpythonSampleTemplate.json")
+
+RAMP_PROFILES = ("linear", "step", "immediate")
+
+
+def load_telemetry_schema(path: str) -> list:
+    """Gets the telemetry fields from a device capability model, such as CircuitpythonSampleTemplate.json
+    :param str path: The path of the capability model JSON file
+    :returns: A list of (name, schema) tuples
+    """
+    with open(path, "r") as model_file:
+        model = json.load(model_file)
+
+    fields = []
+    pending = [model]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, dict):
+            node_type = node.get("@type")
+            if (node_type == "Telemetry" or (isinstance(node_type, list) and "Telemetry" in node_type)) and "name" in node:
+                fields.append((node["name"], node.get("schema", "double")))
+            else:
+                pending.extend(reversed(list(node.values())))
+        elif isinstance(node, list):
+            pending.extend(reversed(node))
+
+    if not fields:
+        raise ValueError("No telemetry found in " + path)
+
+    return fields
+
+
+def make_payload(fields: list, rng: random.Random) -> dict:
+    """Makes a telemetry message with a random value for each field
+    :param list fields: The (name, schema) tuples from load_telemetry_schema
+    :param random.Random rng: The random number generator
+    """
+    payload = {}
+    for name, schema in fields:
+        if schema in ("integer", "long"):
+            payload[name] = rng.randint(0, 1024)
+        elif schema == "boolean":
+            payload[name] = rng.random() < 0.5
+        elif schema == "string":
+            payload[name] = "sim-" + str(rng.randint(0, 1024))
+        else:
+            payload[name] = round(rng.uniform(-20.0, 120.0), 2)
+    return payload
+
+
+def ramp_start_times(count: int, ramp: float, profile: str = "linear", steps: int = 4) -> list:
+    """Gets the time in seconds from the start of the run that each device starts connecting
+    :param int count: The number of devices
+    :param float ramp: The time in seconds over which devices start
+    :param str profile: linear spreads the starts evenly, step starts the devices in equal batches,
+    and immediate starts every device at once
+    :param int steps: The number of batches for the step profile
+    """
+    if profile not in RAMP_PROFILES:
+        raise ValueError("Unknown ramp profile " + profile)
+
+    if profile == "immediate" or ramp <= 0 or count <= 1:
+        return [0.0] * count
+
+    if profile == "linear":
+        return [ramp * index / (count - 1) for index in range(count)]
+
+    steps = max(1, min(steps, count))
+    batch = -(-count // steps)
+    interval = ramp / max(steps - 1, 1)
+    return [interval * (index // batch) for index in range(count)]
+
+
+def _percentile(values: list, percent: float) -> float:
+    """Gets a percentile of sorted values using the nearest rank
+    """
+    if not values:
+        return 0
+    rank = max(1, -(-percent * len(values) // 100))
+    return values[min(int(rank), len(values)) - 1]
+
+
+class SimulatedDevice:
+    """One device in the fleet, and what it has done so far
+    """
+
+    def __init__(self, device_id: str, device, start_at: float):
+        self.device_id = device_id
+        self.device = device
+        self.start_at = start_at
+        self.connect_started = 0
+        self.connect_latency = None
+        self.next_send = 0
+        self.sent = 0
+        self.failed = False
+
+
+# pylint: disable=R0902
+class FleetSimulator:
+    """Runs a fleet of simulated devices in a single thread, moving each one on a step at a time
+    """
+
+    # pylint: disable=R0913
+    def __init__(self, kind: str = "hub", devices: int = 100, rate: float = 1, fields: list = None, hub: str = "sim-hub.azure-devices.net", seed: int = 1):
+        """Create the simulator. Call host.shims.install before creating it
+        :param str kind: hub to simulate IoTHubDevice instances, or central to simulate IoTCentralDevice instances
+        :param int devices: The number of devices
+        :param float rate: The number of telemetry messages each device sends per second
+        :param list fields: The telemetry fields from load_telemetry_schema, defaults to those in CircuitpythonSampleTemplate.json
+        :param str hub: The hostname of the hub IoT Hub devices connect to
+        :param int seed: The seed for the random telemetry values and send times
+        """
+        if kind not in ("hub", "central"):
+            raise ValueError("kind must be hub or central")
+
+        self.kind = kind
+        self.count = devices
+        self.rate = rate
+        self.fields = fields if fields is not None else load_telemetry_schema(DEFAULT_TEMPLATE)
+        self.hub = hub
+        self._rng = random.Random(seed)
+        self._devices = []
+
+    def _create_device(self, device_id: str):
+        # imported here so host.shims.install has run first
+        import adafruit_logging as logging  # pylint: disable=C0415
+        from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager  # pylint: disable=C0415
+        from gc_policy import NeverCollectPolicy  # pylint: disable=C0415
+
+        logger = logging.getLogger("fleet")
+        if logger.getEffectiveLevel() == logging.NOTSET:
+            logger.setLevel(logging.WARNING)
+
+        # CPython manages its own heap, so skip the collections the library runs for CircuitPython
+        if self.kind == "hub":
+            from iothub_device import IoTHubDevice  # pylint: disable=C0415
+
+            connection_string = "HostName={};DeviceId={};SharedAccessKey={}".format(self.hub, device_id, KEY)
+            return IoTHubDevice(ESPSPI_WiFiManager(), connection_string, logger=logger, gc_policy=NeverCollectPolicy())
+
+        from iotcentral_device import IoTCentralDevice  # pylint: disable=C0415
+
+        return IoTCentralDevice(ESPSPI_WiFiManager(), ID_SCOPE, device_id, KEY, logger=logger, gc_policy=NeverCollectPolicy())
+
+    def _send(self, simulated: SimulatedDevice) -> None:
+        payload = make_payload(self.fields, self._rng)
+        if self.kind == "hub":
+            simulated.device.send_device_to_cloud_message(json.dumps(payload))
+        else:
+            simulated.device.send_telemetry(payload)
+        simulated.sent += 1
+
+    def _poll_connect(self, simulated: SimulatedDevice, now: float) -> bool:
+        """Moves a connecting device on a step, returns True once it has finished connecting
+        """
+        try:
+            done = simulated.device.connect_poll()
+        except Exception:  # pylint: disable=W0703
+            simulated.failed = True
+            return True
+
+        if not done:
+            return False
+
+        if simulated.device.is_connected():
+            simulated.connect_latency = time.monotonic() - simulated.connect_started
+            simulated.next_send = now + self._rng.uniform(0, 1 / self.rate) if self.rate > 0 else float("inf")
+        else:
+            simulated.failed = True
+        return True
+
+    # pylint: disable=R0912, R0914, R0915
+    def run(self, duration: float, start_times: list, measure_memory: bool = True) -> dict:
+        """Runs the fleet
+        :param float duration: How long to run for in seconds, counting the ramp up
+        :param list start_times: The time each device starts connecting, from ramp_start_times
+        :param bool measure_memory: Whether to measure the memory used per device with tracemalloc while the fleet connects
+        :returns: The results, see report
+        """
+        if len(start_times) != self.count:
+            raise ValueError("There must be a start time for each device")
+
+        if measure_memory:
+            tracemalloc.start()
+        memory_baseline = tracemalloc.get_traced_memory()[0] if measure_memory else 0
+        memory_per_device = None
+
+        self._devices = []
+        waiting = []
+        connecting = []
+        connected = []
+        for index, start_at in enumerate(start_times):
+            device_id = "sim-{:05d}".format(index)
+            waiting.append(SimulatedDevice(device_id, self._create_device(device_id), start_at))
+        self._devices = list(waiting)
+        waiting.reverse()
+
+        start = time.monotonic()
+        ramp_done_at = None
+        sent_at_ramp_done = 0
+        sent = 0
+        failed = 0
+
+        while True:
+            now = time.monotonic() - start
+            if now >= duration:
+                break
+
+            while waiting and waiting[-1].start_at <= now:
+                simulated = waiting.pop()
+                simulated.connect_started = time.monotonic()
+                try:
+                    simulated.device.connect_start()
+                except Exception:  # pylint: disable=W0703
+                    simulated.failed = True
+                    failed += 1
+                    continue
+                connecting.append(simulated)
+
+            still_connecting = []
+            for simulated in connecting:
+                if not self._poll_connect(simulated, now):
+                    still_connecting.append(simulated)
+                elif simulated.failed:
+                    failed += 1
+                else:
+                    connected.append(simulated)
+            connecting = still_connecting
+
+            for simulated in connected:
+                try:
+                    simulated.device.loop()
+                    if simulated.next_send <= now:
+                        self._send(simulated)
+                        sent += 1
+                        simulated.next_send += 1 / self.rate
+                except Exception:  # pylint: disable=W0703
+                    simulated.failed = True
+                    failed += 1
+            if failed and any(simulated.failed for simulated in connected):
+                connected = [simulated for simulated in connected if not simulated.failed]
+
+            if ramp_done_at is None and not waiting and not connecting:
+                ramp_done_at = time.monotonic() - start
+                sent_at_ramp_done = sent
+                if measure_memory:
+                    used = tracemalloc.get_traced_memory()[0] - memory_baseline
+                    memory_per_device = used / max(len(self._devices), 1)
+                    tracemalloc.stop()
+
+            if not connecting and not (waiting and waiting[-1].start_at <= now):
+                # nothing to do until the next device starts or sends, but keep the connections serviced
+                next_event = min([s.next_send for s in connected] + ([waiting[-1].start_at] if waiting else []) + [duration])
+                delay = next_event - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(min(delay, 0.01))
+
+        elapsed = time.monotonic() - start
+        if measure_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        for simulated in connected:
+            try:
+                simulated.device.disconnect()
+            except Exception:  # pylint: disable=W0703
+                pass
+
+        latencies = sorted(s.connect_latency for s in self._devices if s.connect_latency is not None)
+        steady = None
+        if ramp_done_at is not None and elapsed - ramp_done_at > 0:
+            steady = (sent - sent_at_ramp_done) / (elapsed - ramp_done_at)
+
+        return {
+            "kind": self.kind,
+            "devices": self.count,
+            "connected": len(latencies),
+            "failed": failed,
+            "duration": elapsed,
+            "ramp_duration": ramp_done_at,
+            "messages_sent": sent,
+            "throughput": sent / elapsed if elapsed > 0 else 0,
+            "steady_throughput": steady,
+            "connect_latency": {
+                "p50": _percentile(latencies, 50),
+                "p90": _percentile(latencies, 90),
+                "p99": _percentile(latencies, 99),
+                "max": latencies[-1] if latencies else 0,
+            },
+            "memory_per_device": memory_per_device,
+        }
+
+
+def report(results: dict) -> str:
+    """Formats the results of a run for reading
+    """
+    latency = results["connect_latency"]
+    lines = [
+        "{:<24}{} ({} connected, {} failed)".format(results["kind"] + " devices", results["devices"], results["connected"], results["failed"]),
+        "{:<24}p50 {:.1f} ms  p90 {:.1f} ms  p99 {:.1f} ms  max {:.1f} ms".format(
+            "connect latency", latency["p50"] * 1000, latency["p90"] * 1000, latency["p99"] * 1000, latency["max"] * 1000
+        ),
+        "{:<24}{} in {:.1f} s".format("messages sent", results["messages_sent"], results["duration"]),
+        "{:<24}{:.1f} messages/s".format("throughput", results["throughput"]),
+    ]
+
+    if results["steady_throughput"] is not None:
+        lines.append("{:<24}{:.1f} messages/s after {:.1f} s ramp up".format("steady throughput", results["steady_throughput"], results["ramp_duration"]))
+    if "messages_received" in results:
+        lines.append("{:<24}{}".format("messages received", results["messages_received"]))
+    if results["memory_per_device"] is not None:
+        lines.append("{:<24}{:.1f} KB".format("memory per device", results["memory_per_device"] / 1024))
+
+    return "\n".join(lines)
+
+
+def main() -> None:
+    """Runs the simulator from the command line
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kind", choices=("hub", "central"), default="hub", help="simulate IoTHubDevice or IoTCentralDevice instances")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1, help="telemetry messages per second per device")
+    parser.add_argument("--template", default=DEFAULT_TEMPLATE, help="device capability model to take the telemetry fields from")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which the devices start connecting")
+    parser.add_argument("--ramp-profile", choices=RAMP_PROFILES, default="linear")
+    parser.add_argument("--ramp-steps", type=int, default=4, help="number of batches for the step ramp profile")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run for, counting the ramp up")
+    parser.add_argument("--broker", help="HOST[:PORT] of a real MQTT broker to connect to instead of the local stand-in")
+    parser.add_argument("--no-tls", action="store_true", help="connect to --broker without TLS")
+    parser.add_argument("--hub", default="sim-hub.azure-devices.net", help="hub hostname for the devices to connect to")
+    parser.add_argument("--no-memory", action="store_true", help="don't measure memory, so connect latencies aren't slowed by tracemalloc")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    received = [0]
+    if args.broker is not None:
+        host, _, port = args.broker.partition(":")
+        broker = TcpBroker(host, int(port) if port else (1883 if args.no_tls else 8883), tls=not args.no_tls)
+    else:
+        broker = LocalBroker()
+
+        def count_telemetry(_, topic, __):
+            if "/messages/events/" in topic:
+                received[0] += 1
+
+        broker.on_message = count_telemetry
+
+    shims.install(broker, LocalDPS(assigned_hub=args.hub))
+
+    simulator = FleetSimulator(args.kind, args.devices, args.rate, load_telemetry_schema(args.template), args.hub, args.seed)
+    start_times = ramp_start_times(args.devices, args.ramp, args.ramp_profile, args.ramp_steps)
+    results = simulator.run(args.duration, start_times, not args.no_memory)
+
+    if args.broker is None:
+        results["messages_received"] = received[0]
+
+    print(json.dumps(results, indent=2) if args.json else report(results))
+
+    if results["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Stand-ins for the CircuitPython modules this library needs, so it can be imported and run under CPython.
+
+Call install() before importing any of the library modules. The ESP32 SPI socket module is replaced with one
+that connects every socket to a LocalBroker, or anything else with the same connect method such as a TcpBroker,
+and the Wi-Fi manager with one that is always connected and sends HTTP requests to a LocalDPS.
+Everything else, such as adafruit_minimqtt and adafruit_logging, is the real library installed from PyPI.
+"""
+
+import hmac
+import sys
+import types
+
+from host.broker import LocalBroker
+from host.dps import LocalDPS
+
+_broker = None
+_dps = None
+
+
+class _Interface:
+    """The parts of the ESP32 SPI interface used by MiniMQTT
+    """
+
+    TLS_MODE = 2
+    is_connected = True
+
+    def connect_AP(self, ssid, password) -> int:  # pylint: disable=C0103,W0613
+        """Joins the access point, which always works as the host is already on the network
+        """
+        self.is_connected = True
+        return 3  # WL_CONNECTED
+
+    @staticmethod
+    def unpretty_ip(ip):
+        """Converts an IP address string to bytes
+        """
+        return bytes(int(part) for part in ip.split("."))
+
+
+class ESPSPI_WiFiManager:  # pylint: disable=C0103
+    """A Wi-Fi manager that is always connected
+    """
+
+    def __init__(self, esp=None, secrets=None, *_, **__):
+        self.esp = esp if esp is not None else _Interface()
+        self.secrets = secrets
+        self.ssid = secrets["ssid"] if secrets else None
+        self.password = secrets.get("password") if secrets else None
+
+    def connect(self) -> None:
+        """Does nothing, the host is already on the network
+        """
+
+    def reset(self) -> None:
+        """Does nothing, the host is already on the network
+        """
+
+    @staticmethod
+    def get(url: str, **_):
+        """Sends a GET request to the installed LocalDPS
+        """
+        if _dps is None:
+            raise RuntimeError("host.shims.install() has not been called with a DPS")
+
+        return _dps.request("GET", url)
+
+    @staticmethod
+    def put(url: str, json: dict = None, **_):
+        """Sends a PUT request to the installed LocalDPS
+        """
+        if _dps is None:
+            raise RuntimeError("host.shims.install() has not been called with a DPS")
+
+        return _dps.request("PUT", url, json)
+
+
+class _Socket:
+    """A socket connected to the installed LocalBroker
+    """
+
+    def __init__(self, *_):
+        self._connection = None
+        self.connected = False
+
+    def settimeout(self, timeout) -> None:
+        """Ignored, reads never block
+        """
+
+    def connect(self, *_) -> None:
+        """Opens a connection to the broker
+        """
+        if _broker is None:
+            raise RuntimeError("host.shims.install() has not been called with a broker")
+
+        self._connection = _broker.connect()
+        self.connected = True
+
+    def send(self, data) -> None:
+        """Sends bytes to the broker
+        """
+        if self._connection is None or self._connection.closed:
+            raise RuntimeError("Socket is not connected")
+
+        self._connection.receive(bytes(data))
+
+    def recv(self, size: int) -> bytes:
+        """Reads up to size bytes from the broker, or no bytes if nothing is waiting
+        """
+        if self._connection is None:
+            raise RuntimeError("Socket is not connected")
+
+        return self._connection.read(size)
+
+    def close(self) -> None:
+        """Closes the connection
+        """
+        self.connected = False
+
+        if self._connection is not None and hasattr(self._connection, "close"):
+            self._connection.close()
+
+
+class _SubscribeTopic(str):
+    """A topic that MiniMQTT can append to its bytes SUBSCRIBE packet. CircuitPython allows bytes + str,
+    CPython does not
+    """
+
+    def __radd__(self, other):
+        return other + self.encode("utf-8")
+
+
+def _patch_minimqtt() -> None:
+    import adafruit_minimqtt  # pylint: disable=C0415
+
+    subscribe = adafruit_minimqtt.MQTT.subscribe
+    if getattr(subscribe, "_host_patched", False):
+        return
+
+    def host_subscribe(self, topic, qos=0):
+        if isinstance(topic, str):
+            topic = _SubscribeTopic(topic)
+        elif isinstance(topic, tuple):
+            topic = (_SubscribeTopic(topic[0]), topic[1])
+        elif isinstance(topic, list):
+            topic = [(_SubscribeTopic(t), q) for t, q in topic]
+        return subscribe(self, topic, qos)
+
+    host_subscribe._host_patched = True  # pylint: disable=W0212
+    adafruit_minimqtt.MQTT.subscribe = host_subscribe
+
+
+def _module(name: str, **attributes) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install(broker: LocalBroker = None, dps: LocalDPS = None) -> LocalBroker:
+    """Installs the stand-in modules
+    :param LocalBroker broker: The broker sockets connect to, a new one is created if this is None
+    :param LocalDPS dps: The device provisioning service HTTP requests go to, a new one is created if this is None
+    :returns: The broker
+    """
+    global _broker, _dps  # pylint: disable=W0603
+    _broker = broker if broker is not None else LocalBroker()
+    _dps = dps if dps is not None else LocalDPS()
+
+    if "micropython" not in sys.modules:
+        _module("micropython", const=lambda value: value)
+
+    # the CircuitPython HMAC port relies on name mangling that CPython applies differently
+    _module("circuitpython_hmac", new=hmac.new, HMAC=hmac.HMAC)
+
+    package = _module("adafruit_esp32spi")
+    package.__path__ = []
+    package.adafruit_esp32spi_socket = _module(
+        "adafruit_esp32spi.adafruit_esp32spi_socket",
+        AF_INET=2,
+        SOCK_STREAM=1,
+        set_interface=lambda interface: None,
+        getaddrinfo=lambda host, port, *_: [(2, 1, 0, "", (host, port))],
+        socket=_Socket,
+    )
+    package.adafruit_esp32spi_wifimanager = _module("adafruit_esp32spi.adafruit_esp32spi_wifimanager", ESPSPI_WiFiManager=ESPSPI_WiFiManager)
+
+    _patch_minimqtt()
+
+    return _broker
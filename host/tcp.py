@@ -0,0 +1,88 @@
+"""A transport that connects the host stand-in sockets to a real MQTT broker over TCP, optionally with TLS,
+instead of to a LocalBroker. Pass a TcpBroker to host.shims.install to load test a real broker or IoT hub
+"""
+
+import select
+import socket
+import ssl
+
+
+class TcpConnection:
+    """One client connection to the broker
+    """
+
+    def __init__(self, sock: socket.socket, timeout: float):
+        self._sock = sock
+        self._timeout = timeout
+        self.closed = False
+
+    def receive(self, data) -> None:
+        """Sends bytes from the client to the broker
+        """
+        try:
+            self._sock.sendall(data)
+        except OSError as error:
+            self.closed = True
+            raise RuntimeError("Send failed: " + str(error))
+
+    def read(self, size: int) -> bytes:
+        """Gets size bytes from the broker, or no bytes if nothing has arrived. Once the first byte has arrived
+        this waits for the rest, as MiniMQTT expects a read to return everything it asked for
+        """
+        if self.closed:
+            return b""
+
+        # TLS buffers decrypted bytes the socket no longer reports as readable
+        pending = self._sock.pending() if isinstance(self._sock, ssl.SSLSocket) else 0
+        if not pending and not select.select([self._sock], [], [], 0)[0]:
+            return b""
+
+        data = bytearray()
+        self._sock.settimeout(self._timeout)
+        try:
+            while len(data) < size:
+                chunk = self._sock.recv(size - len(data))
+                if not chunk:
+                    self.closed = True
+                    break
+                data += chunk
+        except OSError as error:
+            self.closed = True
+            raise RuntimeError("Receive failed: " + str(error))
+
+        return bytes(data)
+
+    def close(self) -> None:
+        """Closes the connection
+        """
+        self.closed = True
+        self._sock.close()
+
+
+class TcpBroker:
+    """Opens a TCP connection to a broker for each client
+    """
+
+    def __init__(self, host: str, port: int = 8883, tls: bool = True, timeout: float = 10):
+        """Create the transport
+        :param str host: The hostname of the broker
+        :param int port: The port of the broker
+        :param bool tls: Whether to connect with TLS, IoT Hub requires it
+        :param float timeout: The number of seconds to wait for a connection or for the rest of a packet
+        """
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.timeout = timeout
+        self.connections = []
+
+    def connect(self) -> TcpConnection:
+        """Opens a new client connection
+        """
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        if self.tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+
+        connection = TcpConnection(sock, self.timeout)
+        self.connections.append(connection)
+        return connection
@@ -0,0 +1,278 @@
+"""Tests for the asyncio client. A LocalBroker is served on a local TCP port, so the client runs over its real
+asyncio transport. Run from the root of the repo:
+
+    python -m unittest discover -s host -t .
+"""
+
+import asyncio
+import json
+import logging
+import unittest
+
+from host.broker import LocalBroker
+from async_iot_mqtt import AsyncIoTMQTT
+from iot_protocol import IoTResponse
+from reconnect import ExponentialBackoff
+
+_DEVICE_ID = "dev0"
+_KEY = "aGVsbG8="
+
+
+class _TcpBridge:
+    """Serves a LocalBroker on a local TCP port
+    """
+
+    def __init__(self, broker: LocalBroker):
+        self._broker = broker
+        self._server = None
+        self._clients = {}
+        self._handlers = set()
+        self.port = None
+
+    async def start(self) -> None:
+        """Starts listening on a free port
+        """
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        """Stops listening and closes the client connections
+        """
+        for _, writer in self._clients.values():
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+        # the handlers end once they read the end of their closed connections
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def deliver(self, client_id: str, topic: str, payload) -> None:
+        """Sends a message from the broker to a connected client
+        """
+        connection, writer = self._clients[client_id]
+        connection.deliver(topic, payload)
+        writer.write(connection.read(connection.pending))
+
+    def drop(self, client_id: str) -> None:
+        """Closes a client's connection from the broker's side, as if the network had failed
+        """
+        self._clients[client_id][1].close()
+
+    async def _handle(self, reader, writer) -> None:
+        connection = self._broker.connect()
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+
+                connection.receive(data)
+                if connection.pending:
+                    writer.write(connection.read(connection.pending))
+                if connection.client_id is not None:
+                    self._clients[connection.client_id] = (connection, writer)
+        except ConnectionError:
+            pass
+        finally:
+            connection.closed = True
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+
+# pylint: disable=W0201
+class AsyncIoTMQTTTests(unittest.IsolatedAsyncioTestCase):
+    """Connects an AsyncIoTMQTT client to the bridged broker
+    """
+
+    async def asyncSetUp(self):
+        """Starts the broker and connects a client to it
+        """
+        self.broker = LocalBroker(twin={"desired": {"$version": 1, "fan": 2}, "reported": {"$version": 1}})
+        self.published = []
+        self.broker.on_message = lambda _, topic, payload: self.published.append((topic, payload))
+
+        self.bridge = _TcpBridge(self.broker)
+        await self.bridge.start()
+
+        self.logger = logging.getLogger("test_async_iot_mqtt")
+        self.logger.setLevel(logging.CRITICAL)
+        self.client = self._client()
+        self.statuses = []
+        self.client.on_connection_status_changed = self.statuses.append
+        await self.client.connect()
+
+    def _client(self, token_expires: int = 21600) -> AsyncIoTMQTT:
+        return AsyncIoTMQTT(
+            "127.0.0.1",
+            _DEVICE_ID,
+            _KEY,
+            token_expires=token_expires,
+            logger=self.logger,
+            port=self.bridge.port,
+            ssl_context=False,
+            timeout=5,
+            backoff=ExponentialBackoff(0.01, 0.02),
+        )
+
+    async def asyncTearDown(self):
+        """Disconnects the client and stops the broker
+        """
+        await self.client.disconnect()
+        await self.bridge.stop()
+
+    async def _published_on(self, prefix: str) -> list:
+        for _ in range(200):
+            messages = [message for message in self.published if message[0].startswith(prefix)]
+            if messages:
+                return messages
+            await asyncio.sleep(0.01)
+
+        self.fail("Nothing was published on " + prefix)
+
+    async def test_connect_reads_the_twin(self):
+        """Connecting subscribes to every topic the client uses and reads the device twin
+        """
+        self.assertTrue(self.client.is_connected())
+        self.assertEqual(2, self.client.get_desired("fan"))
+        self.assertEqual(1, self.client.twin.desired_version)
+
+        subscriptions = self.broker.connections[-1].subscriptions
+        self.assertIn("$iothub/methods/#", subscriptions)
+        self.assertIn("devices/" + _DEVICE_ID + "/messages/devicebound/#", subscriptions)
+
+    async def test_get_twin(self):
+        """The full twin is read from the hub
+        """
+        twin = await self.client.get_twin()
+
+        self.assertEqual(2, twin["desired"]["fan"])
+
+    async def test_update_twin(self):
+        """A reported property patch is sent and applied to the local copy once the hub accepts it
+        """
+        status = await self.client.update_twin({"mode": "eco"})
+
+        self.assertEqual(204, status)
+        self.assertEqual("eco", self.client.get_reported("mode"))
+        patches = await self._published_on("$iothub/twin/PATCH/properties/reported/")
+        self.assertEqual({"mode": "eco"}, json.loads(patches[-1][1]))
+
+    async def test_send_telemetry(self):
+        """Telemetry is published on the device's events topic
+        """
+        await self.client.send_telemetry({"temperature": 21})
+
+        messages = await self._published_on("devices/" + _DEVICE_ID + "/messages/events/")
+        self.assertEqual({"temperature": 21}, json.loads(messages[-1][1]))
+
+    async def test_direct_method_response(self):
+        """A coroutine method handler's response is sent with the request's $rid
+        """
+        async def hello(request):
+            await asyncio.sleep(0)
+            return IoTResponse(201, "hi " + request.raw)
+
+        self.client.register_method("hello", hello)
+        self.bridge.deliver(_DEVICE_ID, "$iothub/methods/POST/hello/?$rid=7", "there")
+
+        responses = await self._published_on("$iothub/methods/res/")
+        self.assertEqual("$iothub/methods/res/201/?$rid=7", responses[-1][0])
+        self.assertIn(b"hi there", responses[-1][1])
+
+    async def test_unknown_direct_method(self):
+        """A method with no handler gets a 404 response
+        """
+        self.bridge.deliver(_DEVICE_ID, "$iothub/methods/POST/missing/?$rid=8", "{}")
+
+        responses = await self._published_on("$iothub/methods/res/")
+        self.assertEqual("$iothub/methods/res/404/?$rid=8", responses[-1][0])
+
+    async def test_cloud_to_device_message(self):
+        """Cloud to device messages are read with async for, with their properties decoded
+        """
+        self.bridge.deliver(_DEVICE_ID, "devices/" + _DEVICE_ID + "/messages/devicebound/a=1&b=x%20y", "hello")
+
+        messages = self.client.cloud_to_device_messages()
+        body, properties = await asyncio.wait_for(messages.__anext__(), 2)
+
+        self.assertEqual("hello", body)
+        self.assertEqual({"a": "1", "b": "x y"}, properties)
+
+    async def test_desired_patch(self):
+        """A desired property patch is applied and reported to the callback
+        """
+        changes = []
+        self.client.on_device_twin_desired_updated = lambda name, value, version: changes.append((name, value, version))
+
+        self.bridge.deliver(_DEVICE_ID, "$iothub/twin/PATCH/properties/desired/?$version=2", json.dumps({"fan": 3, "$version": 2}))
+
+        for _ in range(200):
+            if changes:
+                break
+            await asyncio.sleep(0.01)
+
+        self.assertEqual([("fan", 3, 2)], changes)
+        self.assertEqual(3, self.client.get_desired("fan"))
+        self.assertEqual(2, self.client.twin.desired_version)
+
+    async def _wait_until_reconnected(self) -> None:
+        for _ in range(200):
+            if self.client.is_connected():
+                return
+            await asyncio.sleep(0.01)
+
+        self.fail("The client didn't reconnect")
+
+    async def test_lost_connection_is_retried(self):
+        """A dropped connection is retried with backoff until the hub accepts it
+        """
+        self.broker.refuse_code = 3
+        self.bridge.drop(_DEVICE_ID)
+
+        # the first connection, and at least two attempts the hub refused
+        for _ in range(200):
+            if len(self.broker.connections) >= 3 and self.broker.connections[2].client_id is not None:
+                break
+            await asyncio.sleep(0.01)
+        self.assertFalse(self.client.is_connected())
+
+        self.broker.refuse_code = 0
+        await self._wait_until_reconnected()
+
+        self.assertEqual([True, False, True], self.statuses)
+        self.assertEqual(2, self.client.get_desired("fan"))
+
+    async def test_failed_renewal_is_retried(self):
+        """A reconnect with a renewed token that the hub refuses is retried
+        """
+        await self.client.disconnect()
+        self.client = self._client(token_expires=1)
+        await self.client.connect()
+        self.broker.refuse_code = 5
+
+        # the token is renewed at about 0.8 seconds, the hub refuses it, and the client keeps trying
+        await asyncio.sleep(1.2)
+        self.assertFalse(self.client.is_connected())
+
+        self.broker.refuse_code = 0
+        await self._wait_until_reconnected()
+
+    async def test_disconnect_stops_retrying(self):
+        """Disconnecting while reconnecting stops the attempts
+        """
+        self.broker.refuse_code = 3
+        self.bridge.drop(_DEVICE_ID)
+        await asyncio.sleep(0.1)
+
+        await self.client.disconnect()
+        connections = len(self.broker.connections)
+        self.broker.refuse_code = 0
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(connections, len(self.broker.connections))
+        self.assertFalse(self.client.is_connected())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""Tests for the metrics registry. Run from the root of the repo:
+
+    python -m unittest discover -s host -t .
+"""
+
+import unittest
+
+from metrics import LatencyHistogram, Metrics
+
+
+class LatencyHistogramTests(unittest.TestCase):
+    """Latencies in whole milliseconds are counted in buckets with the bounds 1, 5 and 10
+    """
+
+    def setUp(self):
+        self.histogram = LatencyHistogram((1, 5, 10))
+
+    def test_buckets_include_their_upper_bound(self):
+        for milliseconds in (0, 1, 2, 5, 10, 11, 250):
+            self.histogram.record(milliseconds)
+
+        self.assertEqual({"count": 7, "sum_ms": 279, "max_ms": 250, "buckets": [2, 2, 1, 2]}, self.histogram.snapshot())
+
+    def test_percentile(self):
+        for milliseconds in (1, 3, 4, 30):
+            self.histogram.record(milliseconds)
+
+        self.assertEqual(5, self.histogram.percentile(50))
+        self.assertEqual(30, self.histogram.percentile(99))
+
+    def test_reset(self):
+        self.histogram.record(3)
+        self.histogram.reset()
+
+        self.assertEqual({"count": 0, "sum_ms": 0, "max_ms": 0, "buckets": [0, 0, 0, 0]}, self.histogram.snapshot())
+
+
+class MetricsTests(unittest.TestCase):
+    """The snapshot holds the counters, and only the histograms that have recorded something
+    """
+
+    def test_snapshot(self):
+        metrics = Metrics((10,))
+        metrics.increment("messages_sent")
+        metrics.increment("bytes_out", 42)
+        metrics.record("publish", 12)
+
+        snapshot = metrics.snapshot()
+
+        self.assertEqual(1, snapshot["counters"]["messages_sent"])
+        self.assertEqual(42, snapshot["counters"]["bytes_out"])
+        self.assertEqual([10], snapshot["bounds_ms"])
+        self.assertEqual({"publish": {"count": 1, "sum_ms": 12, "max_ms": 12, "buckets": [0, 1]}}, snapshot["latency"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+"""Tests for the offline queue. Run from the root of the repo:
+
+    python -m unittest discover -s host -t .
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from offline_queue import OfflineQueue, _Filesystem
+
+
+class _ReadOnlyFilesystem:
+    """A filesystem that can't be written to, like the CIRCUITPY drive when it isn't remounted in boot.py
+    """
+
+    @staticmethod
+    def open(path: str, mode: str):
+        raise OSError(30, "Read-only filesystem")
+
+    @staticmethod
+    def remove(path: str) -> None:
+        raise OSError(30, "Read-only filesystem")
+
+    @staticmethod
+    def listdir(path: str) -> list:
+        raise OSError(2, "No such file or directory")
+
+    @staticmethod
+    def mkdir(path: str) -> None:
+        raise OSError(30, "Read-only filesystem")
+
+
+class _ReadOnlyAfterBoot(_Filesystem):
+    """A filesystem holding segments from a previous boot, which can be read but no longer written
+    """
+
+    @staticmethod
+    def open(path: str, mode: str):
+        if mode != "r":
+            raise OSError(30, "Read-only filesystem")
+        return open(path, mode)
+
+    @staticmethod
+    def remove(path: str) -> None:
+        raise OSError(30, "Read-only filesystem")
+
+
+def _drain(queue: OfflineQueue) -> list:
+    messages = []
+    while queue.depth:
+        messages.append(queue.peek()[1])
+        queue.pop()
+    return messages
+
+
+class ReadOnlyFilesystemTests(unittest.TestCase):
+    """A queue given a directory on a read-only filesystem falls back to RAM
+    """
+
+    def test_overwrites_the_oldest_message_in_ram(self):
+        queue = OfflineQueue(ram_size=2, directory="/queue", fs=_ReadOnlyFilesystem())
+
+        for message in range(3):
+            queue.put("topic", message)
+        queue.pop()
+        queue.pop()
+        for message in range(10, 15):
+            queue.put("topic", message)
+
+        self.assertEqual(2, queue.depth)
+        self.assertEqual(4, queue.dropped)
+        self.assertEqual(("topic", 13), queue.peek())
+        self.assertEqual([13, 14], _drain(queue))
+
+    def test_empty_queue(self):
+        queue = OfflineQueue(ram_size=2, directory="/queue", fs=_ReadOnlyFilesystem())
+
+        self.assertEqual(0, queue.depth)
+        self.assertIsNone(queue.peek())
+        queue.pop()
+        self.assertEqual(0, queue.depth)
+
+
+class SpillTests(unittest.TestCase):
+    """Messages spill from RAM to segment files in a temporary directory
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _queue(self) -> OfflineQueue:
+        return OfflineQueue(ram_size=2, directory=self.directory, segment_size=3, max_segments=2)
+
+    def test_replays_oldest_first(self):
+        queue = self._queue()
+
+        for message in range(6):
+            queue.put("topic", message)
+
+        self.assertEqual(6, queue.depth)
+        self.assertEqual(0, queue.dropped)
+        self.assertEqual(list(range(6)), _drain(queue))
+
+    def test_drops_the_oldest_segment_when_full(self):
+        queue = self._queue()
+
+        for message in range(10):
+            queue.put("topic", message)
+
+        # 0 and 1 are in RAM, 2 to 4 were in the segment that was deleted to make room for 8 and 9
+        self.assertEqual(3, queue.dropped)
+        self.assertEqual([0, 1, 5, 6, 7, 8, 9], _drain(queue))
+
+    def test_new_messages_go_after_spilled_ones(self):
+        queue = self._queue()
+
+        for message in range(4):
+            queue.put("topic", message)
+        queue.pop()
+        queue.put("topic", 4)
+
+        self.assertEqual([1, 2, 3, 4], _drain(queue))
+
+    def test_segments_are_replayed_after_a_restart(self):
+        queue = self._queue()
+        for message in range(6):
+            queue.put("topic", message)
+
+        # messages held in RAM are lost, the ones spilled to the filesystem are picked up again
+        restarted = self._queue()
+
+        self.assertEqual(4, restarted.depth)
+        self.assertEqual(("topic", 2), restarted.peek())
+        self.assertEqual([2, 3, 4, 5], _drain(restarted))
+
+    def test_partly_read_segment_carries_on_after_a_restart(self):
+        queue = self._queue()
+        for message in range(6):
+            queue.put("topic", message)
+
+        # 0 and 1 from RAM, and 2 from the first segment
+        for _ in range(3):
+            queue.pop()
+
+        restarted = self._queue()
+
+        self.assertEqual(3, restarted.depth)
+        self.assertEqual([3, 4, 5], _drain(restarted))
+
+        # the position is cleared with the segments, so new segments are read from the start
+        for message in range(6, 12):
+            restarted.put("topic", message)
+        self.assertEqual(list(range(8, 12)), _drain(self._queue()))
+
+    def test_new_messages_are_held_in_ram_when_leftover_segments_are_read_only(self):
+        queue = self._queue()
+        for message in range(6):
+            queue.put("topic", message)
+
+        restarted = OfflineQueue(ram_size=2, directory=self.directory, segment_size=3, max_segments=2, fs=_ReadOnlyAfterBoot())
+        for message in range(10, 13):
+            restarted.put("topic", message)
+
+        # the spilled messages go first, then the newest that fit in RAM
+        self.assertEqual(1, restarted.dropped)
+        self.assertEqual(6, restarted.depth)
+        self.assertEqual([2, 3, 4, 5, 11, 12], _drain(restarted))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Tests for sending device to cloud messages at QoS 1, using the stand-ins for the CircuitPython modules and
+a local broker. Run from the root of the repo:
+
+    python -m unittest discover -s host -t .
+"""
+
+import time
+import unittest
+
+from host import shims
+from host.broker import LocalBroker
+from host.dps import LocalDPS
+
+shims.install()
+
+# pylint: disable=C0413
+from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager
+import adafruit_logging as logging
+from iothub_device import IoTHubDevice
+from publish_window import PublishWindow
+from reconnect import ExponentialBackoff
+
+_KEY = "a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2U="
+_CONNECTION_STRING = "HostName=h.azure-devices.net;DeviceId=dev;SharedAccessKey=" + _KEY
+_EVENTS = "devices/dev/messages/events/"
+
+
+class QoS1Tests(unittest.TestCase):
+    """Sends messages through a publish window to a local broker, which acknowledges them with PUBACKs
+    """
+
+    def setUp(self):
+        self.broker = LocalBroker()
+        shims.install(self.broker, dps=LocalDPS(retry_after=0))
+        self.published = []
+        self.broker.on_message = lambda _, topic, payload: self.published.append((topic, payload))
+
+        logger = logging.getLogger("test_qos1")
+        logger.setLevel(logging.CRITICAL)
+
+        self.window = PublishWindow(size=4)
+        self.device = IoTHubDevice(ESPSPI_WiFiManager(), _CONNECTION_STRING, logger=logger)
+        self.device.enable_qos1(self.window)
+        self.sent = []
+        self.device.on_message_sent = self.sent.append
+        self.device.connect()
+
+    def tearDown(self):
+        self.device.disconnect()
+
+    def _events(self) -> list:
+        return [payload for topic, payload in self.published if topic.startswith(_EVENTS)]
+
+    def test_messages_are_pipelined(self):
+        for message in ("a", "b", "c"):
+            self.device.send_device_to_cloud_message(message)
+
+        # all three are written before any PUBACK has been read
+        self.assertEqual([b"a", b"b", b"c"], self._events())
+        self.assertEqual(3, self.window.in_flight)
+        self.assertEqual([], self.sent)
+
+        self.device.loop()
+
+        self.assertEqual(["a", "b", "c"], self.sent)
+        self.assertEqual(0, self.window.in_flight)
+        self.assertEqual(3, len(self.device.get_message_latencies()))
+
+    def test_qos0_packets_still_work_after_qos1(self):
+        self.device.send_device_to_cloud_message("a")
+        self.device.loop()
+
+        self.device.update_twin({"mode": "eco"})
+        self.device.flush_properties()
+        self.device.loop()
+
+        self.assertEqual(["a"], self.sent)
+        self.assertEqual("eco", self.device.get_reported("mode"))
+        self.assertIn(b'{"mode": "eco"}', [payload for topic, payload in self.published if topic.startswith("$iothub/twin/PATCH/")])
+
+    def test_unacknowledged_messages_are_sent_again_after_reconnecting(self):
+        self.device.enable_reconnect(ExponentialBackoff(0.01, 0.02))
+        reconnected = []
+        self.device.on_reconnected = lambda outage, attempts: reconnected.append(attempts)
+
+        self.device.send_device_to_cloud_message("a")
+        self.device.send_device_to_cloud_message("b")
+
+        # the connection drops before the PUBACKs are read
+        self.broker.connections[-1].closed = True
+        self.device._mqtt._mqtts.keep_alive = 0  # pylint: disable=W0212
+
+        start = time.monotonic()
+        while (not reconnected or len(self.window)) and time.monotonic() - start < 2:
+            self.device.loop()
+
+        self.assertEqual([1], reconnected)
+        self.assertEqual(["a", "b"], self.sent)
+        self.assertEqual([b"a", b"b", b"a", b"b"], self._events())
+
+
+if __name__ == "__main__":
+    unittest.main()
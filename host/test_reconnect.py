@@ -0,0 +1,96 @@
+"""Tests for reconnecting after the connection is lost, using the stand-ins for the CircuitPython modules and
+a local broker. Run from the root of the repo:
+
+    python -m unittest discover -s host -t .
+"""
+
+import time
+import unittest
+from unittest import mock
+
+from host import shims
+from host.broker import BrokerConnection, LocalBroker
+from host.dps import LocalDPS
+
+shims.install()
+
+# pylint: disable=C0413
+from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager
+import adafruit_logging as logging
+from iothub_device import IoTHubDevice
+from reconnect import ExponentialBackoff
+
+_KEY = "a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2V5a2U="
+_CONNECTION_STRING = "HostName=h.azure-devices.net;DeviceId=dev;SharedAccessKey=" + _KEY
+_SUBSCRIPTIONS = [
+    "devices/dev/messages/events/#",
+    "devices/dev/messages/devicebound/#",
+    "$iothub/twin/PATCH/properties/desired/#",
+    "$iothub/twin/res/#",
+    "$iothub/methods/#",
+]
+
+
+class ReconnectTests(unittest.TestCase):
+    """Drops the device's connection to the broker and lets the main loop reconnect it
+    """
+
+    def setUp(self):
+        self.broker = LocalBroker()
+        shims.install(self.broker, dps=LocalDPS(retry_after=0))
+
+        logger = logging.getLogger("test_reconnect")
+        logger.setLevel(logging.CRITICAL)
+
+        self.device = IoTHubDevice(ESPSPI_WiFiManager(), _CONNECTION_STRING, logger=logger)
+        self.device.enable_reconnect(ExponentialBackoff(0.01, 0.02))
+        self.device.enable_metrics()
+        self.reconnected = []
+        self.device.on_reconnected = self._on_reconnected
+        self.device.connect()
+
+    def tearDown(self):
+        self.device.disconnect()
+
+    def _on_reconnected(self, outage: float, attempts: int) -> None:
+        self.reconnected.append((attempts, self.device.is_connected(), list(self.broker.connections[-1].subscriptions)))
+
+    def _drop_connection(self) -> None:
+        self.broker.connections[-1].closed = True
+        # pings straight away, so the next loop finds the connection gone
+        self.device._mqtt._mqtts.keep_alive = 0  # pylint: disable=W0212
+
+    def _loop_until_reconnected(self) -> None:
+        start = time.monotonic()
+        while not self.reconnected and time.monotonic() - start < 2:
+            self.device.loop()
+
+    def test_reconnects(self):
+        self._drop_connection()
+        self._loop_until_reconnected()
+
+        self.assertEqual([(1, True, _SUBSCRIPTIONS)], self.reconnected)
+
+    def test_partial_connect_is_not_reported_as_restored(self):
+        subscribe = BrokerConnection._on_subscribe  # pylint: disable=W0212
+        failures = [2]
+
+        def fail_twice(connection, *args):
+            if failures[0]:
+                failures[0] -= 1
+                raise OSError(104, "Connection reset by peer")
+            return subscribe(connection, *args)
+
+        connect_failures = self.device.get_metrics()["counters"]["connect_failures"]
+
+        with mock.patch.object(BrokerConnection, "_on_subscribe", fail_twice):
+            self._drop_connection()
+            self._loop_until_reconnected()
+
+        # the two attempts that failed while subscribing are retried, and only the third one restores the connection
+        self.assertEqual([(3, True, _SUBSCRIPTIONS)], self.reconnected)
+        self.assertEqual(connect_failures + 2, self.device.get_metrics()["counters"]["connect_failures"])
+
+
+if __name__ == "__main__":
+    unittest.main()
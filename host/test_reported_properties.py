@@ -0,0 +1,93 @@
+"""Tests for coalescing reported property updates. Run from the root of the repo:
+
+    python -m unittest discover -s host -t .
+"""
+
+import unittest
+
+from reported_properties import ReportedPropertyCoalescer
+
+
+class ReportedPropertyCoalescerTests(unittest.TestCase):
+    """Updates are merged into one patch, with a window long enough that only flush sends it
+    """
+
+    def setUp(self):
+        self.sent = []
+        self.acknowledged = {}
+        self.coalescer = ReportedPropertyCoalescer(self.sent.append, window=60, acknowledged=self.acknowledged.get)
+
+    def test_later_values_replace_pending_ones(self):
+        self.coalescer.update({"fan": 1, "mode": "eco"})
+        self.coalescer.update({"fan": 2})
+        self.coalescer.flush()
+
+        self.assertEqual([{"fan": 2, "mode": "eco"}], self.sent)
+
+    def test_components_are_merged(self):
+        self.coalescer.update({"thermostat1": {"__t": "c", "targetTemperature": 20}})
+        self.coalescer.update({"thermostat1": {"maxTemp": 30}, "fan": 1})
+        self.coalescer.update({"thermostat1": {"targetTemperature": 21}})
+        self.coalescer.flush()
+
+        self.assertEqual([{"thermostat1": {"__t": "c", "targetTemperature": 21, "maxTemp": 30}, "fan": 1}], self.sent)
+
+    def test_nested_objects_are_merged(self):
+        self.coalescer.update({"component": {"settings": {"a": 1, "b": 2}}})
+        self.coalescer.update({"component": {"settings": {"b": 3}}})
+        self.coalescer.flush()
+
+        self.assertEqual([{"component": {"settings": {"a": 1, "b": 3}}}], self.sent)
+
+    def test_nulls_are_kept(self):
+        self.coalescer.update({"thermostat1": {"__t": "c", "old": 1}, "removed": 1})
+        self.coalescer.update({"thermostat1": {"old": None}, "removed": None})
+        self.coalescer.flush()
+
+        self.assertEqual([{"thermostat1": {"__t": "c", "old": None}, "removed": None}], self.sent)
+
+    def test_callers_dictionary_is_not_changed(self):
+        component = {"__t": "c", "targetTemperature": 20}
+
+        self.coalescer.update({"thermostat1": component})
+        self.coalescer.update({"thermostat1": {"maxTemp": 30}})
+
+        self.assertEqual({"__t": "c", "targetTemperature": 20}, component)
+
+    def test_acknowledged_values_are_dropped(self):
+        self.acknowledged["fan"] = 2
+
+        self.coalescer.update({"fan": 2, "mode": "eco"})
+        self.coalescer.flush()
+
+        self.assertEqual([{"mode": "eco"}], self.sent)
+
+    def test_acknowledged_component_keeps_pending_updates(self):
+        self.acknowledged["thermostat1"] = {"__t": "c", "targetTemperature": 20}
+
+        self.coalescer.update({"thermostat1": {"maxTemp": 30}})
+        self.coalescer.update({"thermostat1": {"__t": "c", "targetTemperature": 20}})
+        self.coalescer.flush()
+
+        self.assertEqual([{"thermostat1": {"maxTemp": 30, "__t": "c", "targetTemperature": 20}}], self.sent)
+
+    def test_retry_keeps_newer_updates(self):
+        self.coalescer.update({"thermostat1": {"__t": "c", "targetTemperature": 21}, "fan": 1})
+        self.coalescer.flush()
+        failed = self.sent.pop()
+
+        self.coalescer.update({"thermostat1": {"targetTemperature": 22}})
+        self.coalescer.retry(failed)
+        self.coalescer.flush()
+
+        self.assertEqual([{"thermostat1": {"targetTemperature": 22, "__t": "c"}, "fan": 1}], self.sent)
+
+    def test_flush_with_nothing_pending(self):
+        self.coalescer.flush()
+
+        self.assertEqual([], self.sent)
+        self.assertEqual(0, len(self.coalescer))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Tests for batching telemetry. Run from the root of the repo:
+
+    python -m unittest discover -s host -t .
+"""
+
+import json
+import unittest
+
+from telemetry_batcher import TelemetryBatcher
+
+
+class TelemetryBatcherTests(unittest.TestCase):
+    """Readings are batched with a fixed timestamp and an age long enough that only the count and size send them
+    """
+
+    def setUp(self):
+        self.sent = []
+        self.fail_sends = False
+        self.batcher = TelemetryBatcher(self._send, max_count=2, max_bytes=100, max_age=60)
+
+    def _send(self, payload: str) -> None:
+        if self.fail_sends:
+            raise OSError(104, "Connection reset by peer")
+        self.sent.append(json.loads(payload))
+
+    def test_full_batch_is_sent_from_poll(self):
+        self.batcher.add({"a": 1}, 1)
+        self.batcher.add({"a": 2}, 2)
+        self.assertEqual([], self.sent)
+
+        self.batcher.poll()
+
+        self.assertEqual([[{"timestamp": 1, "data": {"a": 1}}, {"timestamp": 2, "data": {"a": 2}}]], self.sent)
+        self.assertEqual(0, len(self.batcher))
+
+    def test_full_batch_is_sent_before_the_next_reading(self):
+        for value in range(3):
+            self.batcher.add({"a": value}, value)
+
+        self.assertEqual([[{"timestamp": 0, "data": {"a": 0}}, {"timestamp": 1, "data": {"a": 1}}]], self.sent)
+        self.assertEqual(1, len(self.batcher))
+
+    def test_reading_is_not_added_when_the_flush_before_it_fails(self):
+        self.batcher.add({"a": 1}, 1)
+        self.batcher.add({"a": 2}, 2)
+        self.fail_sends = True
+
+        with self.assertRaises(OSError):
+            self.batcher.add({"a": 3}, 3)
+        self.assertEqual(2, len(self.batcher))
+
+        self.fail_sends = False
+        self.batcher.add({"a": 3}, 3)
+
+        self.assertEqual([1, 2], [entry["timestamp"] for entry in self.sent[0]])
+        self.assertEqual(1, len(self.batcher))
+
+    def test_bytes_like_readings(self):
+        self.batcher.add(b'{"a": 1}', 1)
+        self.batcher.add(memoryview(bytearray(b'{"a": 2}')), 2)
+        self.batcher.flush()
+
+        self.assertEqual([[{"timestamp": 1, "data": {"a": 1}}, {"timestamp": 2, "data": {"a": 2}}]], self.sent)
+
+    def test_reading_larger_than_max_bytes(self):
+        with self.assertRaises(ValueError):
+            self.batcher.add({"a": "x" * 100}, 1)
+        self.assertEqual(0, len(self.batcher))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Tests for routing incoming messages and reading fields from their topics. Run from the root of the repo:
+
+    python -m unittest discover -s host -t .
+"""
+
+import unittest
+
+from topic_router import MessageProperties, TopicRouter, get_request_id
+
+_C2D_PREFIX = "devices/dev/messages/devicebound/"
+
+
+class TopicFieldTests(unittest.TestCase):
+    """Reads $rid and property bags from topics as str or bytes
+    """
+
+    def test_request_id(self):
+        self.assertEqual("7", get_request_id("$iothub/twin/res/204/?$rid=7&$version=3"))
+        self.assertEqual("7", get_request_id(b"$iothub/twin/res/200/?$rid=7"))
+        self.assertIsNone(get_request_id("$iothub/twin/PATCH/properties/desired/?$version=3"))
+
+    def test_properties_are_parsed_when_first_read(self):
+        properties = MessageProperties(_C2D_PREFIX + "a=1&b=x%20y", len(_C2D_PREFIX))
+
+        self.assertIsNone(properties._properties)  # pylint: disable=W0212
+        self.assertEqual("x y", properties["b"])
+        self.assertEqual({"a": "1", "b": "x y"}, properties._properties)  # pylint: disable=W0212
+
+    def test_properties_read_like_a_dictionary(self):
+        properties = MessageProperties((_C2D_PREFIX + "%24.mid=42&flag").encode("utf-8"), len(_C2D_PREFIX))
+
+        self.assertEqual({"$.mid": "42", "flag": ""}, properties)
+        self.assertIn("flag", properties)
+        self.assertEqual(2, len(properties))
+        self.assertEqual("42", properties.get("$.mid"))
+        self.assertIsNone(properties.get("missing"))
+        self.assertEqual(["$.mid", "flag"], sorted(properties))
+        self.assertEqual({"$.mid": "42", "flag": ""}, properties.to_dict())
+
+    def test_copy_is_independent(self):
+        properties = MessageProperties(_C2D_PREFIX + "a=1", len(_C2D_PREFIX))
+
+        copy = properties.to_dict()
+        copy["a"] = "2"
+
+        self.assertEqual("1", properties["a"])
+
+
+class TopicRouterTests(unittest.TestCase):
+    """Dispatches topics to the first route whose prefix matches
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.router = TopicRouter()
+        self.router.add_route("$iothub/methods/", lambda topic, payload: self.calls.append(("method", topic)))
+        self.router.add_route(b"$iothub/twin/", lambda topic, payload: self.calls.append(("twin", topic)))
+
+    def test_matches_str_and_bytes_topics(self):
+        self.assertTrue(self.router.dispatch(b"$iothub/methods/POST/x/?$rid=1", b""))
+        self.assertTrue(self.router.dispatch("$iothub/twin/res/200/?$rid=2", ""))
+        self.assertFalse(self.router.dispatch("devices/dev/other", ""))
+
+        self.assertEqual([("method", b"$iothub/methods/POST/x/?$rid=1"), ("twin", "$iothub/twin/res/200/?$rid=2")], self.calls)
+
+    def test_first_route_is_checked_before_the_others(self):
+        self.router.add_route("$iothub/methods/POST/x/", lambda topic, payload: self.calls.append(("x", topic)), first=True)
+
+        self.router.dispatch("$iothub/methods/POST/x/?$rid=1", "")
+
+        self.assertEqual([("x", "$iothub/methods/POST/x/?$rid=1")], self.calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
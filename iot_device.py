@@ -0,0 +1,360 @@
+"""The parts of the IoT Hub and IoT Central device clients that don't depend on how the device connects
+"""
+
+import json
+from direct_methods import DirectMethodRegistry
+from gc_policy import GCPolicy
+from iot_error import IoTError
+from iot_mqtt import IoTMQTTCallback, IoTResponse
+from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager
+import adafruit_logging as logging
+
+
+class IoTDeviceBase(IoTMQTTCallback):
+    """The base class for IoTHubDevice and IoTCentralDevice. It holds the settings for the optional features,
+    such as QoS 1, batching and the offline queue, and applies them to the MQTT client each time one is created,
+    so they are kept across reconnects. It also supervises the connection from loop once reconnecting is enabled.
+
+    Subclasses create the client in _create_mqtt, and call _configure_mqtt once it is created
+    """
+
+    # the error message when a method needs a connection, each subclass names its service
+    _not_connected_message = "You are not connected"
+
+    def connection_status_change(self, connected: bool) -> None:
+        """Called when the connection status changes
+        """
+        if self.on_connection_status_changed is not None:
+            # pylint: disable=E1102
+            self.on_connection_status_changed(connected)
+
+    def token_renewed(self, duration: float) -> None:
+        """Called when the SAS token has been renewed and the connection re-established
+        """
+        if self.on_token_renewed is not None:
+            # pylint: disable=E1102
+            self.on_token_renewed(duration)
+
+    def message_sent(self, data) -> None:
+        """Called when a message has been sent, or once the hub acknowledges it when QoS 1 is enabled
+        """
+        if self.on_message_sent is not None:
+            # pylint: disable=E1102
+            self.on_message_sent(data)
+
+    def twin_patch_completed(self, request_id: str, status: int, latency: float) -> None:
+        """Called when the hub responds to a reported properties patch, or it times out
+        """
+        if self.on_twin_patch_completed is not None:
+            # pylint: disable=E1102
+            self.on_twin_patch_completed(request_id, status, latency)
+
+    def direct_method_called(self, method_name: str, data) -> IoTResponse:
+        """Called when a direct method is invoked
+        """
+        response = self._methods.dispatch(method_name, data)
+        if response is not None:
+            return response
+
+        method_callback = self._method_callback()
+        if method_callback is not None:
+            return method_callback(method_name, data)
+
+        # nothing handles this method, so tell the hub straight away rather than letting it time out
+        return IoTResponse(404, "Method not found: " + method_name)
+
+    def _method_callback(self):
+        """Gets the application's callback for direct methods that have no registered handler
+        """
+        return None
+
+    def __init__(self, wifi_manager: ESPSPI_WiFiManager, token_expires: int = 21600, logger: logging = None, gc_policy: GCPolicy = None):
+        """Create the device client
+        :param wifi_manager: The WiFi manager
+        :param int token_expires: The number of seconds till the token expires, defaults to 6 hours
+        :param adafruit_logging logger: The logger
+        :param GCPolicy gc_policy: When to run the garbage collector around network requests, defaults to before and after every request
+        """
+        self._wifi_manager = wifi_manager
+        self._token_expires = token_expires
+        self._logger = logger if logger is not None else logging.getLogger("log")
+        self._gc_policy = gc_policy
+        self._mqtt = None
+        self._methods = DirectMethodRegistry()
+        self._batcher = None
+        self._offline_queue_settings = None
+        self._publish_window = None
+        self._memory_stats = None
+        self._metrics = None
+        self._metrics_settings = None
+        self._reconnect = None
+        self._reported_properties_window = None
+
+        self.on_connection_status_changed = None
+        self.on_reconnected = None
+        self.on_token_renewed = None
+        self.on_twin_patch_completed = None
+        self.on_message_sent = None
+
+    def _configure_mqtt(self):
+        if self._batcher is not None:
+            self._mqtt.use_batcher(self._batcher)
+
+        if self._offline_queue_settings is not None:
+            self._mqtt.enable_offline_queue(*self._offline_queue_settings)
+
+        if self._publish_window is not None:
+            self._mqtt.enable_qos1(self._publish_window)
+
+        if self._memory_stats is not None:
+            self._mqtt.enable_memory_stats(self._memory_stats)
+
+        # the same registry is used by every connection, so the counts carry on across reconnects
+        if self._metrics is not None:
+            self._mqtt.use_metrics(self._metrics)
+        if self._metrics_settings is not None:
+            self._mqtt.enable_metrics_reporting(*self._metrics_settings)
+
+        if self._reported_properties_window is not None:
+            self._mqtt.set_reported_properties_window(self._reported_properties_window)
+
+    def disconnect(self):
+        """Disconnects from the MQTT broker
+        """
+        if self._mqtt is None:
+            raise IoTError(self._not_connected_message)
+
+        self._mqtt.disconnect()
+
+    def is_connected(self) -> bool:
+        """Gets if there is an open connection to the MQTT broker
+        """
+        if self._mqtt is not None:
+            return self._mqtt.is_connected()
+
+        return False
+
+    def get_desired(self, name: str, default=None):
+        """Gets the value of a desired property from the local copy of the device twin, without asking the hub
+        :param str name: The name of the property
+        :param default: The value to return if the property isn't set
+        """
+        if self._mqtt is None:
+            raise IoTError(self._not_connected_message)
+
+        return self._mqtt.get_desired(name, default)
+
+    def get_reported(self, name: str, default=None):
+        """Gets the value of a reported property from the local copy of the device twin, without asking the hub
+        :param str name: The name of the property
+        :param default: The value to return if the property isn't set
+        """
+        if self._mqtt is None:
+            raise IoTError(self._not_connected_message)
+
+        return self._mqtt.get_reported(name, default)
+
+    def loop(self):
+        """Listens for MQTT messages
+        """
+        if self._mqtt is None:
+            raise IoTError(self._not_connected_message)
+
+        self._mqtt.loop()
+
+        if self._reconnect is not None:
+            self._supervise_connection()
+
+    def _supervise_connection(self):
+        restored = self._reconnect.poll(self._mqtt.is_connected, self._reconnect_start, self._mqtt.connect_poll)
+        if restored is None:
+            return
+
+        outage, attempts = restored
+        if self._metrics is not None:
+            self._metrics.record("outage", int(outage * 1000))
+
+        if self.on_reconnected is not None:
+            # pylint: disable=E1102
+            self.on_reconnected(outage, attempts)
+
+    def _reconnect_start(self):
+        # the access point may have dropped the device as well, so make one attempt to rejoin it. The Wi-Fi manager's
+        # connect keeps trying until the access point is back, which would stop the main loop for the whole outage
+        esp = self._wifi_manager.esp
+        if not esp.is_connected:
+            try:
+                esp.connect_AP(self._wifi_manager.ssid, self._wifi_manager.password)
+            except (RuntimeError, ConnectionError) as wifi_error:
+                # a failed reconnect attempt, so the supervisor backs off before trying again
+                raise IoTError("Could not rejoin the Wi-Fi access point: " + str(wifi_error))
+
+        # the existing client signs a new token and subscribes again, and keeps the twin and any unsent messages
+        self._mqtt.connect_start()
+
+    def register_method(self, method_name: str, handler):
+        """Registers the handler for a direct method. The handler is called with a DirectMethodRequest,
+        whose payload is parsed from JSON when it is read, and returns an IoTResponse.
+        Methods that have no handler, and aren't handled by on_direct_method_called or on_command_executed, get a 404 response
+        :param str method_name: The name of the method
+        :param handler: The function to call when the method is invoked
+        """
+        self._methods.register(method_name, handler)
+
+    def unregister_method(self, method_name: str):
+        """Removes the handler for a direct method
+        :param str method_name: The name of the method
+        """
+        self._methods.unregister(method_name)
+
+    def flush_properties(self):
+        """Sends any pending reported property updates straight away, instead of waiting for the reported properties window
+        """
+        if self._mqtt is None:
+            raise IoTError(self._not_connected_message)
+
+        self._mqtt.flush_reported_properties()
+
+    def set_reported_properties_window(self, window: float):
+        """Sets how long reported property updates are collected before they are sent as one twin patch.
+        Updates to the same property within the window replace each other, so only the last value is sent
+        :param float window: The time in seconds, 0 sends them on the next loop
+        """
+        self._reported_properties_window = window
+
+        if self._mqtt is not None:
+            self._mqtt.set_reported_properties_window(window)
+
+    def enable_batching(self, max_count: int = 10, max_bytes: int = 4096, max_age: float = 5):
+        """Coalesces messages queued with queue_device_to_cloud_message, or queue_telemetry for IoT Central,
+        into a single JSON array message. Queued messages are sent from loop once the batch reaches max_count messages
+        or the oldest message is max_age seconds old, when the next message wouldn't fit in max_bytes, and before disconnecting.
+        The batch is kept across reconnects
+        :param int max_count: The number of messages that triggers a send
+        :param int max_bytes: The payload size in bytes that triggers a send, this must be under the 256 KB IoT Hub limit
+        :param float max_age: The age in seconds of the oldest queued message that triggers a send
+        """
+        from telemetry_batcher import TelemetryBatcher  # pylint: disable=C0415
+
+        # sent by whichever client is connected, so messages queued before a reconnect are sent after it
+        batcher = TelemetryBatcher(None, max_count, max_bytes, max_age)
+
+        if self._mqtt is not None:
+            self._mqtt.use_batcher(batcher)
+
+        self._batcher = batcher
+
+    def enable_offline_queue(self, queue: "OfflineQueue", replay_rate: float = 5):
+        """Stores messages that can't be sent while disconnected in a queue, and sends them once connected.
+        The same queue is kept across reconnects, and its depth and dropped properties report the backlog
+        :param OfflineQueue queue: The queue to store messages in
+        :param float replay_rate: The maximum number of queued messages to send per second once connected
+        """
+        self._offline_queue_settings = (queue, replay_rate)
+
+        if self._mqtt is not None:
+            self._mqtt.enable_offline_queue(queue, replay_rate)
+
+    def enable_qos1(self, window: "PublishWindow" = None):
+        """Sends messages at QoS 1, so each one is held until the hub acknowledges it and is sent again after
+        reconnecting if it isn't. on_message_sent is called once the hub acknowledges each message
+        :param PublishWindow window: The window to hold unacknowledged messages in, defaults to one holding up to 4 messages.
+        The same window is kept across reconnects
+        """
+        if window is None:
+            from publish_window import PublishWindow  # pylint: disable=C0415
+
+            window = PublishWindow()
+
+        self._publish_window = window
+
+        if self._mqtt is not None:
+            self._mqtt.enable_qos1(self._publish_window)
+
+    def get_message_latencies(self, percentiles=(50, 90, 99)) -> dict:
+        """Gets percentiles of the recent times in seconds from sending a message to the hub acknowledging it,
+        empty if QoS 1 is not enabled or nothing has been acknowledged
+        """
+        if self._publish_window is None:
+            return {}
+
+        return self._publish_window.latency_percentiles(percentiles)
+
+    def enable_memory_stats(self, stats: "MemoryStats" = None):
+        """Measures the heap used by each kind of operation: connecting, registering with the device provisioning service
+        for IoT Central, publishing, handling the device twin, direct methods and cloud to device messages.
+        The same measurements are kept across reconnects
+        :param MemoryStats stats: Where to record the measurements, defaults to a new MemoryStats
+        """
+        if stats is None:
+            from memory_stats import MemoryStats  # pylint: disable=C0415
+
+            stats = MemoryStats()
+
+        self._memory_stats = stats
+
+        if self._mqtt is not None:
+            self._mqtt.enable_memory_stats(self._memory_stats)
+
+    def get_memory_stats(self) -> dict:
+        """Gets the heap measurements for each kind of operation, empty if memory stats are not enabled.
+        See MemoryStats.get_stats for what is measured
+        """
+        if self._memory_stats is None:
+            return {}
+
+        return self._memory_stats.get_stats()
+
+    def send_memory_stats(self):
+        """Sends the heap measurements as a device to cloud message, a JSON object with the measurements under memoryStats
+        """
+        if self._mqtt is None:
+            raise IoTError(self._not_connected_message)
+
+        self._mqtt.send_device_to_cloud_message(json.dumps({"memoryStats": self.get_memory_stats()}))
+
+    def enable_reconnect(self, backoff: "ExponentialBackoff" = None):
+        """Reconnects from loop when the connection is lost, waiting longer after each failed attempt.
+        Keep calling loop while is_connected is False, and on_reconnected is called with the length of the outage
+        in seconds and the number of attempts once the connection is restored
+        :param ExponentialBackoff backoff: The delays between attempts, defaults to 1 second doubling up to 5 minutes, with jitter
+        """
+        from reconnect import ReconnectSupervisor  # pylint: disable=C0415
+
+        self._reconnect = ReconnectSupervisor(backoff, self._logger)
+
+    def enable_metrics(self) -> None:
+        """Counts messages, connections and twin requests, and records their latencies, see get_metrics.
+        The metrics module is only imported once this is called
+        """
+        if self._metrics is not None:
+            return
+
+        from metrics import Metrics  # pylint: disable=C0415
+
+        self._metrics = Metrics()
+
+        if self._mqtt is not None:
+            self._mqtt.use_metrics(self._metrics)
+
+    def get_metrics(self) -> dict:
+        """Gets a snapshot of the client's counters and latency histograms, see Metrics.snapshot
+        :returns: The snapshot, or an empty dictionary if metrics are not enabled
+        """
+        if self._metrics is None:
+            return {}
+
+        return self._metrics.snapshot()
+
+    def enable_metrics_reporting(self, interval: float, reported_property: str = None):
+        """Sends a snapshot of the client's metrics every interval seconds from loop, enabling metrics if they aren't already.
+        By default this is a message with its content type set to application/vnd.client-metrics+json,
+        so the hub can route it apart from telemetry
+        :param float interval: The number of seconds between snapshots
+        :param str reported_property: The name of a reported property to send the snapshot as instead of a message
+        """
+        self.enable_metrics()
+        self._metrics_settings = (interval, reported_property)
+
+        if self._mqtt is not None:
+            self._mqtt.enable_metrics_reporting(interval, reported_property)
@@ -1,36 +1,60 @@
 """MQTT client for Azure IoT
 """
 
-import gc
 import json
+import random
 import time
 import adafruit_esp32spi.adafruit_esp32spi_socket as socket
 from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager
 import adafruit_minimqtt as minimqtt
 from adafruit_minimqtt import MQTT
-import circuitpython_parse as parse
-from constants import constants
-from device_registration import DeviceRegistration
+from gc_policy import GCPolicy
+from iot_error import IoTError
+import iot_protocol
+from iot_protocol import IoTResponse
+from topic_router import MessageProperties, TopicRouter, get_request_id
 import adafruit_logging as logging
 
+# the modules for optional features, such as metrics, batching and QoS 1, are imported when the feature is enabled,
+# and the ones for the device twin and sending messages when the client is created or first sends,
+# so importing a device class doesn't take up RAM for them
 
-class IoTResponse:
-    """A response from a direct method call
+# how many times a send is tried, half a second apart, before giving up
+_SEND_RETRIES = 10
+
+# the fixed header of a QoS 1 PUBLISH, and the packet type of a PUBACK
+_PUBLISH_QOS1 = 0x32
+_PUBACK = 0x40
+
+# publish and dispatch latencies are measured with time.monotonic_ns, and recorded in whole milliseconds
+_NS_PER_MS = 1000000
+
+
+class _NoMetrics:
+    """Stands in for the metrics registry until metrics are enabled, so recording costs nothing
     """
 
-    def __init__(self, code, message):
-        self._code = code
-        self._message = message
+    def increment(self, name: str, amount: int = 1) -> None:
+        """Does nothing
+        """
 
-    def get_response_code(self):
-        """Gets the method response code
+    def record(self, name: str, milliseconds: int) -> None:
+        """Does nothing
         """
-        return self._code
 
-    def get_response_message(self):
-        """Gets the method response message
+    def counter(self, name: str) -> int:  # pylint: disable=W0613
+        """Always 0
         """
-        return self._message
+        return 0
+
+
+_NO_METRICS = _NoMetrics()
+
+
+def _to_str(value) -> str:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return str(value, "utf-8")
+    return str(value)
 
 
 class IoTMQTTCallback:
@@ -38,7 +62,7 @@ class IoTMQTTCallback:
     """
 
     def message_sent(self, data) -> None:
-        """Called when a message is sent to the cloud
+        """Called when a message is sent to the cloud, or once the hub acknowledges it when QoS 1 is enabled
         """
 
     def connection_status_change(self, connected: bool) -> None:
@@ -52,8 +76,8 @@ class IoTMQTTCallback:
         return IoTResponse("", "")
 
     # pylint: disable=C0103
-    def cloud_to_device_message_received(self, body: str, properties: dict) -> None:
-        """Called when a cloud to device message is received
+    def cloud_to_device_message_received(self, body: str, properties: MessageProperties) -> None:
+        """Called when a cloud to device message is received, with its properties, which are parsed when first read
         """
 
     def device_twin_desired_updated(self, desired_property_name: str, desired_property_value, desired_version: int) -> None:
@@ -68,23 +92,42 @@ class IoTMQTTCallback:
         """Called when the settings are updated
         """
 
+    def token_renewed(self, duration: float) -> None:
+        """Called when the SAS token has been renewed and the connection re-established, with the time it took in seconds
+        """
+
+    def twin_patch_completed(self, request_id: str, status: int, latency: float) -> None:
+        """Called when the hub responds to a reported properties patch, or it times out, with the request ID,
+        the status code, 0 for a timeout, and the round trip time in seconds
+        """
+
 
 # pylint: disable=R0902
 class IoTMQTT:
     """MQTT client for Azure IoT
     """
 
-    _iotc_api_version = constants["iotcAPIVersion"]
+    _phase_connect = 0
+    _phase_subscribe = 1
+    _phase_twin = 2
+    _phase_done = 3
+
+    # How long to wait for the device twin after subscribing before finishing connecting without it
+    _twin_sync_timeout = 10
+
+    # The token is renewed once this fraction of its lifetime is left, plus a random extra fraction of up to
+    # _token_renewal_jitter so devices that connected together don't all reconnect at the same time
+    _token_renewal_margin = 0.1
+    _token_renewal_jitter = 0.1
 
     def _gen_sas_token(self):
         token_expiry = int(time.time() + self._token_expires)
-        uri = self._hostname + "%2Fdevices%2F" + self._device_id
-        signed_hmac_sha256 = DeviceRegistration.compute_derived_symmetric_key(self._key, uri + "\n" + str(token_expiry))
-        signature = parse.quote(signed_hmac_sha256, "~()*!.'")
-        if signature.endswith("\n"):  # somewhere along the crypto chain a newline is inserted
-            signature = signature[:-1]
-        token = "SharedAccessSignature sr={}&sig={}&se={}".format(uri, signature, token_expiry)
-        return token
+        lifetime = self._token_expires
+        self._token_renew_at = token_expiry - lifetime * (self._token_renewal_margin + random.uniform(0, self._token_renewal_jitter))
+        # the signer keeps the decoded key and keyed HMAC, so renewing the token only hashes the new expiry
+        if self._signer is None:
+            self._signer = iot_protocol.SasSigner(self._key, iot_protocol.device_resource_uri(self._hostname, self._device_id))
+        return self._signer.sign(token_expiry)
 
     # Workaround for https://github.com/adafruit/Adafruit_CircuitPython_MiniMQTT/issues/25
     def _try_create_mqtt_client(self, hostname):
@@ -98,10 +141,11 @@ class IoTMQTT:
             keep_alive=120,
             is_ssl=True,
             client_id=self._device_id,
-            log=True,
         )
 
-        self._mqtts.logger.setLevel(logging.INFO)
+        # MiniMQTT formats its log messages before checking the level, so only give it a logger when debugging
+        if self._logger.getEffectiveLevel() <= logging.DEBUG:
+            self._mqtts.logger = self._logger
 
         # set actions to take throughout connection lifecycle
         self._mqtts.on_connect = self._on_connect
@@ -123,21 +167,23 @@ class IoTMQTT:
 
     # pylint: disable=C0103, W0613
     def _on_connect(self, client, userdata, _, rc):
-        self._logger.info("- iot_mqtt :: _on_connect :: rc = " + str(rc) + ", userdata = " + str(userdata))
+        self._logger.info("- iot_mqtt :: _on_connect :: rc = %s, userdata = %s", rc, userdata)
+        was_connected = self._mqtt_connected
         if rc == 0:
             self._mqtt_connected = True
-        self._auth_response_received = True
-        self._callback.connection_status_change(True)
+
+        # renewing the token reconnects without the connection having been lost, so there is no change to report
+        if not was_connected:
+            self._callback.connection_status_change(True)
 
     # pylint: disable=C0103, W0613
     def _on_log(self, client, userdata, level, buf):
-        self._logger.info("mqtt-log : " + buf)
+        self._logger.info("mqtt-log : %s", buf)
         if level <= 8:
-            self._logger.error("mqtt-log : " + buf)
+            self._logger.error("mqtt-log : %s", buf)
 
     def _on_disconnect(self, client, userdata, rc):
-        self._logger.info("- iot_mqtt :: _on_disconnect :: rc = " + str(rc))
-        self._auth_response_received = True
+        self._logger.info("- iot_mqtt :: _on_disconnect :: rc = %s", rc)
 
         if rc == 5:
             self._logger.error("on(disconnect) : Not authorized")
@@ -150,160 +196,449 @@ class IoTMQTT:
             self._callback.connection_status_change(False)
 
     def _on_publish(self, client, data, topic, msg_id):
-        self._logger.info("- iot_mqtt :: _on_publish :: " + str(data) + " on topic " + str(topic))
+        self._logger.debug("- iot_mqtt :: _on_publish :: %s on topic %s", data, topic)
+
+    def _message_acknowledged(self, packet_id: int) -> None:
+        message = self._window.acknowledge(packet_id)
+        if message is not None:
+            self._logger.debug("- iot_mqtt :: _message_acknowledged :: %s", packet_id)
+            self._callback.message_sent(message[1])
+
+    def _build_router(self) -> TopicRouter:
+        router = TopicRouter()
+        router.add_route(iot_protocol.TWIN_DESIRED_PREFIX, self._handle_desired_patch)
+        router.add_route(iot_protocol.TWIN_RESPONSE_PREFIX + "200/", self._handle_twin_get_response)
+        router.add_route(iot_protocol.TWIN_RESPONSE_PREFIX, self._handle_twin_response)
+        router.add_route(iot_protocol.METHOD_PREFIX, self._handle_direct_method)
+        router.add_route(self._c2d_prefix, self._handle_cloud_to_device_message)
+        return router
+
+    def register_route(self, prefix, handler) -> None:
+        """Registers a handler for incoming messages whose topic starts with the prefix.
+        Registered routes are checked before the built in ones
+        :param prefix: The topic prefix, as a str or bytes
+        :param handler: The function to call with the topic and payload of matching messages
+        """
+        self._router.add_route(prefix, handler, first=True)
+
+    def _handle_desired_patch(self, topic, payload):
+        self._logger.debug("- iot_mqtt :: _handle_desired_patch :: %s", topic)
+        self._measure("twin", self._handle_device_twin_update, _to_str(payload))
+
+    def _handle_twin_get_response(self, topic, payload):
+        self._logger.debug("- iot_mqtt :: _handle_twin_get_response :: %s", topic)
+        self._complete_twin_request(topic)
+        self._twin_received = True
+        self._measure("twin", self._handle_device_twin_update, _to_str(payload))
+
+    def _handle_twin_response(self, topic, payload):
+        self._logger.debug("- iot_mqtt :: _handle_twin_response :: %s", topic)
+        self._complete_twin_request(topic)
+
+    def _complete_twin_request(self, topic) -> None:
+        # the topic is only parsed for a request that is waiting, so a late response to one that timed out costs nothing
+        if not self._twin_requests.in_flight:
+            self._logger.debug("Twin response with no request waiting %s", topic)
+            return
+
+        request_id = get_request_id(topic)
+        if request_id is None or not self._twin_requests.is_pending(request_id):
+            self._logger.debug("Twin response for an unknown request %s", topic)
+            return
+
+        try:
+            status, _, version = iot_protocol.parse_twin_response(_to_str(topic))
+        except ValueError:
+            self._logger.error("ERROR: Unexpected twin response topic %s", topic)
+            return
+
+        self._twin_requests.complete(request_id, status, version)
+
+    def _twin_get_completed(self, request_id: str, status: int, latency: float, _) -> None:
+        self._twin_request_pending = False
+        self._record_twin_response(status, latency)
+        if status != 200:
+            self._logger.error("Twin GET request %s failed with status %s after %ss", request_id, status, latency)
+
+    def _record_twin_response(self, status: int, latency: float) -> None:
+        if status != self._twin_requests.STATUS_TIMEOUT:
+            self._metrics.record("twin", int(latency * 1000))
+        if not 200 <= status < 300:
+            self._metrics.increment("twin_failures")
+
+    def _send_reported_patch(self, patch: dict) -> None:
+        self._send_twin_patch(json.dumps(patch), patch, None)
+
+    def _send_twin_patch(self, data, patch: dict, on_complete) -> str:
+        request_id = self._twin_requests.start(self._twin_patch_completed)
+        self._twin_patches[request_id] = (patch, on_complete)
+        self._metrics.increment("twin_requests")
+
+        try:
+            self._send_common(iot_protocol.TWIN_PATCH_TOPIC + request_id, data)
+        except (RuntimeError, minimqtt.MMQTTException):
+            self._twin_requests.cancel(request_id)
+            self._twin_patches.pop(request_id, None)
+            raise
+
+        return request_id
+
+    def _twin_patch_completed(self, request_id: str, status: int, latency: float, version: int) -> None:
+        patch, on_complete = self._twin_patches.pop(request_id, (None, None))
+        self._record_twin_response(status, latency)
+
+        if 200 <= status < 300:
+            if patch is not None:
+                self._twin.apply_reported_patch(patch, version)
+        else:
+            self._logger.error("Reported properties patch %s failed with status %s after %ss", request_id, status, latency)
+
+            # throttled or lost, so send the updates again with the next patch
+            if patch is not None and status in (self._twin_requests.STATUS_TIMEOUT, 429):
+                self._reported.retry(patch)
+
+        if on_complete is not None:
+            on_complete(status, latency)
+
+        self._callback.twin_patch_completed(request_id, status, latency)
 
     # pylint: disable=W0703
-    def _handle_device_twin_update(self, msg: str, topic: str):
-        self._logger.debug("- iot_mqtt :: _echo_desired :: " + topic)
+    def _handle_device_twin_update(self, msg: str):
         twin = None
-        desired = None
 
-        print(msg)
+        self._logger.debug("- iot_mqtt :: _handle_device_twin_update :: %s", msg)
 
         try:
             twin = json.loads(msg)
         except Exception as e:
-            self._logger.error("ERROR: JSON parse for Device Twin message object has failed. => " + msg + " => " + str(e))
+            self._logger.error("ERROR: JSON parse for Device Twin message object has failed. => %s => %s", msg, e)
             return
 
-        if "reported" in twin:
-            reported = twin["reported"]
-
-            if "$version" in reported:
-                reported_version = reported["$version"]
-                reported.pop("$version")
-            else:
-                self._logger.error("ERROR: Unexpected payload for reported twin update => " + msg)
+        # a full twin from a GET response, rather than a patch to the desired properties
+        if "desired" in twin:
+            if "$version" not in twin["desired"] or ("reported" in twin and "$version" not in twin["reported"]):
+                self._logger.error("ERROR: Unexpected payload for twin update => %s", msg)
                 return
 
-            for property_name, value in reported.items():
-                self._callback.device_twin_reported_updated(property_name, value, reported_version)
+            desired_changes, reported_changes = self._twin.apply_twin(twin)
+
+            # only the properties that differ from the mirror are passed on, which is all of them the first time
+            for property_name, value in reported_changes.items():
+                self._callback.device_twin_reported_updated(property_name, value, self._twin.reported_version)
+            for property_name, value in desired_changes.items():
+                self._callback.device_twin_desired_updated(property_name, value, self._twin.desired_version)
+            return
 
-        is_patch = "desired" not in twin
+        if "$version" not in twin:
+            self._logger.error("ERROR: Unexpected payload for desired twin update => %s", msg)
+            return
 
-        if is_patch:
-            desired = twin
-        else:
-            desired = twin["desired"]
+        desired_version = twin.pop("$version")
+        result = self._twin.apply_desired_patch(twin, desired_version)
 
-        if "$version" in desired:
-            desired_version = desired["$version"]
-            desired.pop("$version")
-        else:
-            self._logger.error("ERROR: Unexpected payload for desired twin update => " + msg)
+        if result == self._twin.STALE:
+            self._logger.debug("Dropping stale desired properties version %s", desired_version)
             return
 
-        for property_name, value in desired.items():
+        for property_name, value in twin.items():
             self._callback.device_twin_desired_updated(property_name, value, desired_version)
 
-    def _handle_direct_method(self, msg: str, topic: str):
-        index = topic.find("$rid=")
-        method_id = 1
-        method_name = "None"
-        if index == -1:
+        if result == self._twin.GAP and not self._twin_request_pending and self._twin_requests.available > 0:
+            self._logger.info("Desired properties version %s skipped versions, requesting the full twin", desired_version)
+            self._get_device_settings()
+
+    def get_desired(self, name: str, default=None):
+        """Gets the value of a desired property from the local copy of the device twin
+        :param str name: The name of the property
+        :param default: The value to return if the property isn't set
+        """
+        return self._twin.get_desired(name, default)
+
+    def get_reported(self, name: str, default=None):
+        """Gets the value of a reported property from the local copy of the device twin
+        :param str name: The name of the property
+        :param default: The value to return if the property isn't set
+        """
+        return self._twin.get_reported(name, default)
+
+    @property
+    def twin(self) -> "TwinMirror":
+        """The local copy of the device twin
+        """
+        return self._twin
+
+    def _handle_direct_method(self, topic, payload):
+        method_name, method_id = iot_protocol.parse_method_topic(_to_str(topic))
+        if method_id is None:
             self._logger.error("ERROR: C2D doesn't include topic id")
-        else:
-            method_id = topic[index + 5 :]
-            topic_template = "$iothub/methods/POST/"
-            len_temp = len(topic_template)
-            method_name = topic[len_temp : topic.find("/", len_temp + 1)]
-
-        ret = self._callback.direct_method_called(method_name, msg)
-
-        ret_code = 200
-        ret_message = "{}"
-        if ret.get_response_code() is not None:
-            ret_code = ret.get_response_code()
-        if ret.get_response_message() is not None:
-            ret_message = ret.get_response_message()
-
-            # ret message must be JSON
-            if not ret_message.startswith("{") or not ret_message.endswith("}"):
-                ret_json = {"Value": ret_message}
-                ret_message = json.dumps(ret_json)
-
-        next_topic = "$iothub/methods/res/{}/?$rid={}".format(ret_code, method_id)
-        self._logger.info("C2D: => " + next_topic + " with data " + ret_message + " and name => " + method_name)
-        self._send_common(next_topic, ret_message)
+            method_name = "None"
+            method_id = 1
 
-    def _handle_cloud_to_device_message(self, msg: str, topic: str):
-        parts = topic.split("&")[1:]
+        self._metrics.increment("methods")
+        ret = self._measure("method", self._callback.direct_method_called, method_name, _to_str(payload))
 
-        properties = {}
-        for part in parts:
-            key_value = part.split("=")
-            properties[key_value[0]] = key_value[1]
+        next_topic, ret_message = iot_protocol.method_response(ret, method_id)
+        self._logger.info("C2D: => %s with data %s and name => %s", next_topic, ret_message, method_name)
+        self._send_common(next_topic, ret_message)
 
-        self._callback.cloud_to_device_message_received(msg, properties)
+    def _handle_cloud_to_device_message(self, topic, payload):
+        self._metrics.increment("c2d_messages")
+        properties = MessageProperties(topic, len(self._c2d_prefix))
+        self._measure("c2d", self._callback.cloud_to_device_message_received, _to_str(payload), properties)
 
-    # pylint: disable=W0702, R0912
     def _on_message(self, client, msg_topic, payload):
-        topic = ""
-        msg = None
+        self._logger.debug("- iot_mqtt :: _on_message :: topic(%s) payload(%s)", msg_topic, payload)
+        start = time.monotonic_ns()
+        self._metrics.increment("messages_received")
+        self._metrics.increment("bytes_in", len(payload))
 
-        print("Topic: ", str(msg_topic))
-        self._logger.info("- iot_mqtt :: _on_message :: payload(" + str(payload) + ")")
+        if msg_topic is None or not self._router.dispatch(msg_topic, payload):
+            self._logger.error("ERROR: (unknown message) - %s", payload)
 
-        if payload is not None:
-            try:
-                msg = payload.decode("utf-8")
-            except:
-                msg = str(payload)
-
-        if msg_topic is not None:
-            try:
-                topic = msg_topic.decode("utf-8")
-            except:
-                topic = str(msg_topic)
-
-        if topic.startswith("$iothub/"):
-            if topic.startswith("$iothub/twin/PATCH/properties/desired/") or topic.startswith("$iothub/twin/res/200/?$rid="):
-                self._handle_device_twin_update(str(msg), topic)
-            elif topic.startswith("$iothub/methods"):
-                self._handle_direct_method(str(msg), topic)
-            else:
-                if not topic.startswith("$iothub/twin/res/"):  # not twin response
-                    self._logger.error("ERROR: unknown twin! - {}".format(msg))
-        elif topic.startswith("devices/{}/messages/devicebound".format(self._device_id)):
-            self._handle_cloud_to_device_message(str(msg), topic)
-        else:
-            self._logger.error("ERROR: (unknown message) - {}".format(msg))
+        self._metrics.record("dispatch", (time.monotonic_ns() - start) // _NS_PER_MS)
 
     def _send_common(self, topic, data) -> None:
-        self._logger.debug("Sending message on topic: " + topic)
-        self._logger.debug("Sending message: " + str(data))
+        self._logger.debug("Sending message on topic: %s", topic)
+        self._logger.debug("Sending message: %s", data)
 
         retry = 0
 
         while True:
-            gc.collect()
+            self._gc_policy.collect()
             try:
                 self._logger.debug("Trying to send...")
-                self._mqtts.publish(topic, data)
+                self._publish(topic, data)
                 self._logger.debug("Data sent")
                 break
             except RuntimeError as runtime_error:
-                self._logger.info("Could not send data, retrying after 0.5 seconds: " + str(runtime_error))
+                self._logger.info("Could not send data, retrying after 0.5 seconds: %s", runtime_error)
                 retry = retry + 1
 
-                if retry >= 10:
+                if retry >= self._send_retries:
                     self._logger.error("Failed to send data")
+                    self._connection_lost(runtime_error)
                     raise
 
                 time.sleep(0.5)
                 continue
 
-        print("finished _send_common")
-        gc.collect()
+        self._gc_policy.collect()
+
+    def _measure(self, operation: str, function, *args):
+        if self._memory_stats is None:
+            return function(*args)
+        return self._memory_stats.measure(operation, function, *args)
+
+    def _publish(self, topic: str, data, packet_id: int = None) -> None:
+        start = time.monotonic_ns()
+        try:
+            self._measure("publish", self._publish_message, topic, data, packet_id)
+        except (RuntimeError, minimqtt.MMQTTException):
+            self._metrics.increment("messages_failed")
+            raise
+
+        self._metrics.record("publish", (time.monotonic_ns() - start) // _NS_PER_MS)
+        self._metrics.increment("messages_sent")
+        self._metrics.increment("bytes_out", len(topic) + len(data))
+
+    def _publish_message(self, topic: str, data, packet_id: int) -> None:
+        if self._mqtts is None:
+            # the client from a failed connection has been closed, and reconnecting hasn't created a new one yet
+            raise RuntimeError("Not connected to the MQTT broker")
+
+        if packet_id is not None:
+            self._write_publish(topic, data, packet_id)
+            return
+
+        # MiniMQTT only takes bytes and bytearray payloads from version 3, so try passing them through once
+        # and decode them from then on if they are rejected. It never takes a memoryview, so that is copied to bytes
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            if self._bytes_payloads is None:
+                try:
+                    self._mqtts.publish(topic, bytes(data) if isinstance(data, memoryview) else data)
+                    self._bytes_payloads = True
+                    return
+                except minimqtt.MMQTTException as publish_error:
+                    if "data type" not in str(publish_error):
+                        raise
+                    self._bytes_payloads = False
+
+            if not self._bytes_payloads:
+                data = str(data, "utf-8")
+            elif isinstance(data, memoryview):
+                data = bytes(data)
+
+        self._mqtts.publish(topic, data)
+
+    def _write_publish(self, topic: str, data, packet_id: int) -> None:
+        """Writes a QoS 1 PUBLISH packet without waiting for its PUBACK, which loop reads later.
+        MiniMQTT's publish builds QoS 1 packets in a buffer shared by every publish, which breaks the packets
+        sent after it, and blocks until the PUBACK arrives, so the packet is built here instead
+        """
+        if isinstance(topic, str):
+            topic = topic.encode("utf-8")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif isinstance(data, memoryview):
+            data = bytes(data)
+
+        length = 4 + len(topic) + len(data)
+        header = bytearray([_PUBLISH_QOS1])
+        while length > 0x7F:
+            header.append((length & 0x7F) | 0x80)
+            length >>= 7
+        header.append(length)
+        header += len(topic).to_bytes(2, "big")
+
+        sock = self._mqtts._sock  # pylint: disable=W0212
+        sock.send(header)
+        sock.send(topic)
+        sock.send(packet_id.to_bytes(2, "big"))
+        sock.send(data)
+
+    def _next_packet_id(self) -> int:
+        # packet IDs are 1 to 65535, MiniMQTT's own only need to be unique while it waits for their SUBACK
+        self._packet_id = self._packet_id % 0xFFFF + 1
+        return self._packet_id
+
+    def _send_window(self) -> None:
+        """Sends the messages queued in the publish window at QoS 1 without waiting for their PUBACKs,
+        which loop reads as they arrive. Stops at the first failure
+        """
+        message = self._window.peek()
+
+        while message is not None and self.is_connected():
+            self._gc_policy.collect()
+
+            # in flight before it is written, so a failed write is sent again along with the rest of the window
+            self._window.sent(message, self._next_packet_id())
+
+            try:
+                self._publish(message[0], message[1], message[2])
+            except (RuntimeError, OSError, minimqtt.MMQTTException) as send_error:
+                # the socket has failed, so sending again on it would fail too, the messages are sent after reconnecting
+                self._logger.error("Failed to send data, sending it again after reconnecting: %s", send_error)
+                self._window.requeue()
+                self._connection_lost(send_error)
+                return
+
+            message = self._window.peek()
+
+        self._gc_policy.collect()
+
+    def _loop_client(self) -> None:
+        """Reads the packets waiting from the broker. MiniMQTT's loop handles messages and keep-alive pings,
+        and returns the type of any other packet without reading the rest of it, so PUBACKs are read here
+        """
+        # one read for each PUBACK that can be waiting, and one for anything else
+        reads = 1 + (self._window.in_flight if self._window is not None else 0)
+
+        for _ in range(reads):
+            packet_type = self._mqtts.loop()
+            if packet_type is None:
+                return
+
+            if packet_type & 0xF0 == _PUBACK:
+                self._read_puback()
+
+    def _read_puback(self) -> None:
+        receive = getattr(self._mqtts, "_sock_exact_recv", self._mqtts._sock.recv)  # pylint: disable=W0212
+        body = receive(3)
+        if len(body) != 3 or body[0] != 2:
+            raise minimqtt.MMQTTException("Malformed PUBACK")
+
+        packet_id = body[1] << 8 | body[2]
+        if self._window is not None:
+            self._message_acknowledged(packet_id)
+
+    def _subscription_topics(self) -> list:
+        return iot_protocol.subscription_topics(self._device_id)
+
+    def _subscribe(self) -> None:
+        for topic in self._subscription_topics():
+            self._mqtts.subscribe(topic)
+
+    def _renew_token(self) -> None:
+        """Signs a new SAS token and reconnects with it on a new MQTT client, the same way as reconnecting after
+        the connection is lost
+        """
+        self._logger.info("- iot_mqtt :: _renew_token :: ")
+        start = time.monotonic()
+        self._metrics.increment("reconnects")
+
+        self._passwd = self._gen_sas_token()
+
+        # the hub may have already closed the connection
+        self._close_client()
+
+        # PUBACKs for messages sent on the old connection will never arrive
+        if self._window is not None:
+            self._window.requeue()
+
+        try:
+            self._create_mqtt_client()
+            self._subscribe()
+        except (RuntimeError, OSError, minimqtt.MMQTTException) as connect_error:
+            self._logger.error("Failed to reconnect with the renewed token: %s", connect_error)
+            self._metrics.increment("connect_failures")
+            self._connection_lost(connect_error)
+            if self._mqtts is not None:
+                self._close_client()
+            return
+
+        self._callback.token_renewed(time.monotonic() - start)
+
+    def _connection_lost(self, error) -> None:
+        """Marks the connection as lost when the socket fails or the broker stops answering keep-alive pings,
+        so the application, or a device's reconnect supervisor, can see it from is_connected
+        """
+        if not self._mqtt_connected:
+            return
+
+        self._logger.error("Connection lost: %s", error)
+        self._mqtt_connected = False
+        self._callback.connection_status_change(False)
+
+    def _close_client(self) -> None:
+        """Closes the MQTT client from a lost connection, as each one holds a socket and the ESP32 only has a few
+        """
+        # this isn't a new disconnect to report, the lost connection has already been reported
+        self._mqtts.on_disconnect = None
+
+        try:
+            self._mqtts.disconnect()
+        except (RuntimeError, OSError, minimqtt.MMQTTException):
+            try:
+                self._mqtts._sock.close()  # pylint: disable=W0212
+            except (AttributeError, RuntimeError, OSError):
+                pass
+
+        self._mqtts = None
 
     def _get_device_settings(self) -> None:
         self._logger.info("- iot_mqtt :: _get_device_settings :: ")
-        self.loop()
-        self._send_common("$iothub/twin/GET/?$rid=0", " ")
+        request_id = self._twin_requests.start(self._twin_get_completed)
+        self._metrics.increment("twin_requests")
+
+        try:
+            self._send_common(iot_protocol.TWIN_GET_TOPIC + request_id, " ")
+        except (RuntimeError, minimqtt.MMQTTException):
+            self._twin_requests.cancel(request_id)
+            raise
+
+        self._twin_request_pending = True
 
     # pylint: disable=R0913
     def __init__(
-        self, callback: IoTMQTTCallback, wifi_manager: ESPSPI_WiFiManager, hostname: str, device_id: str, key: str, token_expires: int = 21600, logger: logging = None
+        self,
+        callback: IoTMQTTCallback,
+        wifi_manager: ESPSPI_WiFiManager,
+        hostname: str,
+        device_id: str,
+        key: str,
+        token_expires: int = 21600,
+        logger: logging = None,
+        gc_policy: GCPolicy = None,
     ):
         """Create the Azure IoT MQTT client
         :param wifi_manager: The WiFi manager
@@ -313,50 +648,186 @@ class IoTMQTT:
         :param str key: The primary or secondary key of the device to register
         :param int token_expires: The number of seconds till the token expires, defaults to 6 hours
         :param adafruit_logging logger: The logger
+        :param GCPolicy gc_policy: When to run the garbage collector around sending messages, defaults to before and after every send
         """
         self._wifi_manager = wifi_manager
         self._callback = callback
+        self._gc_policy = gc_policy if gc_policy is not None else GCPolicy()
         self._mqtt_connected = False
-        self._auth_response_received = False
         self._mqtts = None
         self._device_id = device_id
         self._hostname = hostname
         self._key = key
+        self._signer = None
         self._token_expires = token_expires
-        self._username = "{}/{}/api-version={}".format(self._hostname, device_id, self._iotc_api_version)
-        self._passwd = self._gen_sas_token()
+        self._username = iot_protocol.mqtt_username(self._hostname, device_id)
+        self._token_renew_at = 0
+        # signed when connecting, so the token is fresh and the crypto modules aren't loaded until they are needed
+        self._passwd = None
         self._logger = logger if logger is not None else logging.getLogger("log")
+        # an unconfigured logger outputs everything, so default to the INFO level MiniMQTT used to set on it
+        if self._logger.getEffectiveLevel() == logging.NOTSET:
+            self._logger.setLevel(logging.INFO)
+        self._connect_phase = self._phase_done
+        self._connect_timings = {}
+        self._connect_started = 0
+        self._phase_started = 0
+        self._pending_subscriptions = []
+        self._twin_received = False
+        # every connection reads the device twin, so these are imported with the client rather than with this module
+        from twin_mirror import TwinMirror  # pylint: disable=C0415
+        from twin_requests import TwinRequestTracker  # pylint: disable=C0415
+
+        self._twin = TwinMirror()
+        self._twin_request_pending = False
+        self._twin_requests = TwinRequestTracker()
+        self._twin_patches = {}
+        # created when the first reported property update is made
+        self._reported = None
+        self._reported_window = None
+        self._c2d_prefix = iot_protocol.c2d_prefix(device_id)
+        # created when the first device to cloud message is sent
+        self._topics = None
+        self._bytes_payloads = None
+        self._router = self._build_router()
+        self._batcher = None
+        self._offline_queue = None
+        self._window = None
+        self._packet_id = 0
+        self._memory_stats = None
+        self._metrics = _NO_METRICS
+        self._metrics_interval = 0
+        self._metrics_property = None
+        self._metrics_content_type = None
+        self._metrics_due = 0
+        self._replay_rate = 0
+        self._replay_allowance = 0
+        self._replay_time = 0
+        self._send_retries = _SEND_RETRIES
 
     def connect(self):
         """Connects to the MQTT broker
         """
-        self._logger.info("- iot_mqtt :: connect :: " + self._hostname)
-
-        self._create_mqtt_client()
+        self.connect_start()
 
-        self._logger.info(" - iot_mqtt :: connect :: created mqtt client. connecting..")
-        while self._auth_response_received is None:
-            self.loop()
+        while not self.connect_poll():
+            pass
 
-        self._logger.info(" - iot_mqtt :: connect :: on_connect must be fired. Connected ? " + str(self.is_connected()))
         if not self.is_connected():
             return 1
 
-        self._mqtt_connected = True
-        self._auth_response_received = True
+        return 0
 
-        self._mqtts.subscribe("devices/{}/messages/events/#".format(self._device_id))
-        self._mqtts.subscribe("devices/{}/messages/devicebound/#".format(self._device_id))
-        self._mqtts.subscribe("$iothub/twin/PATCH/properties/desired/#")  # twin desired property changes
-        self._mqtts.subscribe("$iothub/twin/res/#")  # twin properties response
-        self._mqtts.subscribe("$iothub/methods/#")
+    def connect_start(self) -> None:
+        """Starts connecting to the MQTT broker without blocking.
+        Call connect_poll from the main loop until it returns True
+        """
+        self._logger.info("- iot_mqtt :: connect_start :: %s", self._hostname)
+
+        self._connect_phase = self._phase_connect
+        self._connect_timings = {}
+        self._connect_started = time.monotonic()
+        self._phase_started = self._connect_started
+        self._pending_subscriptions = self._subscription_topics()
+        self._twin_received = False
+
+        # reconnecting, so close the client from the last connection
+        if self._mqtts is not None:
+            self._close_client()
+            self._mqtt_connected = False
 
-        if self._get_device_settings() == 0:
-            self._callback.settings_updated()
-        else:
-            return 1
+        self._passwd = self._gen_sas_token()
 
-        return 0
+        # a registry shared with an earlier client, such as a device's, has already counted its connections
+        if self._metrics.counter("connects"):
+            self._metrics.increment("reconnects")
+        self._metrics.increment("connects")
+
+        # responses to requests made on an earlier connection will never arrive
+        self._twin_requests.expire(True)
+        if self._window is not None:
+            self._window.requeue()
+
+    def connect_poll(self) -> bool:
+        """Moves the connection started by connect_start on by one step. Each step does a bounded amount of work:
+        opening the TLS connection and waiting for CONNACK, one subscription and its SUBACK, or reading the twin.
+        Returns True once connecting has finished, use is_connected to see if it succeeded
+        """
+        return self._measure("connect", self._connect_step)
+
+    def _connect_step(self) -> bool:
+        if self._connect_phase == self._phase_connect:
+            try:
+                self._create_mqtt_client()
+            except (RuntimeError, minimqtt.MMQTTException):
+                self._metrics.increment("connect_failures")
+                raise
+
+            self._logger.info(" - iot_mqtt :: connect :: on_connect must be fired. Connected ? %s", self.is_connected())
+            self._end_connect_phase("connect")
+
+            if not self.is_connected():
+                self._metrics.increment("connect_failures")
+                self._connect_phase = self._phase_done
+                self._connect_timings["total"] = time.monotonic() - self._connect_started
+                return True
+
+            self._connect_phase = self._phase_subscribe
+            return False
+
+        if self._connect_phase == self._phase_subscribe:
+            try:
+                self._mqtts.subscribe(self._pending_subscriptions.pop(0))
+
+                if not self._pending_subscriptions:
+                    self._end_connect_phase("subscribe")
+                    self._get_device_settings()
+                    self._connect_phase = self._phase_twin
+            except (RuntimeError, OSError, minimqtt.MMQTTException) as subscribe_error:
+                return self._connect_failed(subscribe_error)
+            return False
+
+        if self._connect_phase == self._phase_twin:
+            try:
+                self._loop_client()
+            except (RuntimeError, OSError, minimqtt.MMQTTException) as loop_error:
+                return self._connect_failed(loop_error)
+
+            if self._twin_received:
+                self._callback.settings_updated()
+            elif time.monotonic() - self._phase_started < self._twin_sync_timeout:
+                return False
+            else:
+                self._logger.error("Timed out waiting for the device twin")
+
+            self._end_connect_phase("twin")
+            self._connect_phase = self._phase_done
+            self._connect_timings["total"] = time.monotonic() - self._connect_started
+
+        return True
+
+    def _connect_failed(self, error) -> bool:
+        """Closes a connection that failed after the CONNACK, so it isn't left half set up without its subscriptions
+        """
+        self._metrics.increment("connect_failures")
+        self._connection_lost(error)
+        self._close_client()
+        self._connect_phase = self._phase_done
+        self._connect_timings["total"] = time.monotonic() - self._connect_started
+        return True
+
+    def _end_connect_phase(self, name: str) -> None:
+        now = time.monotonic()
+        self._connect_timings[name] = now - self._phase_started
+        self._metrics.record("twin_sync" if name == "twin" else name, int(self._connect_timings[name] * 1000))
+        self._phase_started = now
+
+    def get_connect_timings(self) -> dict:
+        """Gets how long each phase of the last connection took in seconds.
+        connect covers opening the TLS connection and the CONNACK, as MiniMQTT does both in one call,
+        subscribe covers all the SUBACKs, twin covers reading the device twin, and total covers everything
+        """
+        return self._connect_timings
 
     def disconnect(self):
         """Disconnects from the MQTT broker
@@ -365,6 +836,13 @@ class IoTMQTT:
             return
 
         self._logger.info("- iot_mqtt :: disconnect :: ")
+
+        if self._batcher is not None:
+            self._batcher.flush()
+
+        if self._reported is not None and self._twin_requests.available > 0:
+            self._reported.flush()
+
         self._mqtt_connected = False
         self._mqtts.disconnect()
 
@@ -376,35 +854,318 @@ class IoTMQTT:
     def loop(self):
         """Listens for MQTT messages
         """
-        if not self.is_connected():
+        # while connect_poll is still subscribing or reading the twin, the connection isn't ready to use
+        if not self.is_connected() or self._connect_phase != self._phase_done:
             return
 
-        self._mqtts.loop()
+        if time.time() >= self._token_renew_at:
+            self._renew_token()
+            if not self.is_connected():
+                return
 
-    def _send_common(self, topic, data):
-        self._mqtts.publish(topic, data)
+        # MiniMQTT pings the broker when the keep-alive period has passed, and raises if the socket has failed
+        try:
+            self._loop_client()
+        except (RuntimeError, OSError, minimqtt.MMQTTException) as loop_error:
+            self._connection_lost(loop_error)
+            return
+
+        # the main loop can't wait out the retries, so a send that fails here marks the connection lost straight away
+        self._send_retries = 1
+        try:
+            self._send_due()
+        except (RuntimeError, OSError, minimqtt.MMQTTException) as send_error:
+            self._connection_lost(send_error)
+        finally:
+            self._send_retries = _SEND_RETRIES
+
+    def _send_due(self) -> None:
+        self._twin_requests.expire()
+        if self._reported is not None and self._twin_requests.available > 0:
+            self._reported.poll()
+
+        if self._window is not None and self._window.queued:
+            self._send_window()
+
+        if self._batcher is not None:
+            self._batcher.poll()
+
+        if self._offline_queue is not None and self._offline_queue.depth > 0:
+            self._replay_offline_queue()
 
-    def send_device_to_cloud_message(self, data, system_properties=None) -> None:
+        if self._metrics_interval and time.monotonic() >= self._metrics_due:
+            self._metrics_due = time.monotonic() + self._metrics_interval
+            self.send_metrics()
+
+    def send_device_to_cloud_message(self, data, system_properties: dict = None, content_type: str = None, content_encoding: str = None) -> None:
         """Send a device to cloud message from this device to Azure IoT Hub
+        :param data: The message, as a str, or as bytes, a bytearray or a memoryview of UTF-8 encoded text
+        :param dict system_properties: The system and application properties of the message, these are percent-encoded
+        :param str content_type: The content type of the message, such as application/json
+        :param str content_encoding: The content encoding of the message, such as utf-8
         """
-        self._logger.info("- iot_mqtt :: send_device_to_cloud_message :: " + data)
-        topic = "devices/{}/messages/events/".format(self._device_id)
+        self._logger.debug("- iot_mqtt :: send_device_to_cloud_message :: %s", data)
+        if self._topics is None:
+            from topic_cache import TopicCache  # pylint: disable=C0415
+
+            self._topics = TopicCache(self._device_id)
+
+        topic = self._topics.get(system_properties, content_type, content_encoding)
+
+        if self._window is not None:
+            # message_sent is called once the hub acknowledges the message
+            if self._offline_queue is not None and (not self.is_connected() or self._offline_queue.depth > 0 or not self._window.available):
+                self._offline_queue.put(topic, _to_str(data))
+                return
+
+            self._window.add(topic, data)
+            self._send_window()
+            return
 
-        if system_properties is not None:
-            firstProp = True
-            for prop in system_properties:
-                if not firstProp:
-                    topic += "&"
-                else:
-                    firstProp = False
-                topic += prop + "=" + str(system_properties[prop])
+        if self._offline_queue is not None:
+            # queued messages go first, so anything sent while there is a backlog goes to the back of the queue
+            if not self.is_connected() or self._offline_queue.depth > 0:
+                self._offline_queue.put(topic, _to_str(data))
+                return
+
+            try:
+                self._send_common(topic, data)
+            except (RuntimeError, minimqtt.MMQTTException) as send_error:
+                self._logger.error("Failed to send data, queueing it to send later: %s", send_error)
+                self._offline_queue.put(topic, _to_str(data))
+                return
+        else:
+            self._send_common(topic, data)
 
-        self._send_common(topic, data)
         self._callback.message_sent(data)
 
-    def send_twin_patch(self, data):
-        """Send a patch for the reported properties of the device twin
+    def send_twin_patch(self, data, on_complete=None) -> str:
+        """Send a patch for the reported properties of the device twin straight away
+        :param data: The JSON patch
+        :param on_complete: A function called with the status code, 0 for a timeout, and the round trip time in seconds
+        when the hub responds or the request times out
+        :returns: The request ID of the patch
+        """
+        self._logger.debug("- iot_mqtt :: sendProperty :: %s", data)
+        return self._send_twin_patch(data, None, on_complete)
+
+    def set_twin_request_limits(self, max_in_flight: int = 4, timeout: float = 30) -> None:
+        """Sets the limits for device twin requests. Reported property patches wait while the limit is reached
+        :param int max_in_flight: The maximum number of twin requests waiting for a response
+        :param float timeout: The number of seconds to wait for a response before completing a request with status 0
         """
-        self._logger.info("- iot_mqtt :: sendProperty :: " + data)
-        topic = "$iothub/twin/PATCH/properties/reported/?$rid={}".format(int(time.time()))
-        return self._send_common(topic, data)
+        self._twin_requests.set_limits(max_in_flight, timeout)
+
+    def update_reported_properties(self, patch: dict) -> None:
+        """Updates reported properties of the device twin. Updates made within the reported properties window
+        are merged and sent as one patch, and properties set to the value the hub already has are skipped
+        :param dict patch: The properties to update
+        """
+        if self._reported is None:
+            from reported_properties import ReportedPropertyCoalescer  # pylint: disable=C0415
+
+            self._reported = ReportedPropertyCoalescer(self._send_reported_patch, acknowledged=self._twin.get_reported)
+            if self._reported_window is not None:
+                self._reported.window = self._reported_window
+
+        self._reported.update(patch)
+
+    def flush_reported_properties(self) -> None:
+        """Sends any pending reported property updates straight away
+        """
+        if self._reported is not None:
+            self._reported.flush()
+
+    def set_reported_properties_window(self, window: float) -> None:
+        """Sets how long reported property updates are collected before they are sent as one patch
+        :param float window: The time in seconds, 0 sends them on the next loop
+        """
+        self._reported_window = window
+        if self._reported is not None:
+            self._reported.window = window
+
+    def enable_batching(self, max_count: int = 10, max_bytes: int = 4096, max_age: float = 5) -> None:
+        """Coalesces messages queued with queue_device_to_cloud_message into a single JSON array message
+        :param int max_count: The number of messages that triggers a send
+        :param int max_bytes: The payload size in bytes that triggers a send, this must be under the 256 KB IoT Hub limit
+        :param float max_age: The age in seconds of the oldest queued message that triggers a send
+        """
+        from telemetry_batcher import TelemetryBatcher  # pylint: disable=C0415
+
+        self.use_batcher(TelemetryBatcher(self._send_batch, max_count, max_bytes, max_age))
+
+    def use_batcher(self, batcher: "TelemetryBatcher") -> None:
+        """Coalesces messages queued with queue_device_to_cloud_message in an existing batcher, such as the one
+        used by the client before a reconnect, so the messages it holds are sent by this client
+        :param TelemetryBatcher batcher: The batcher
+        """
+        if self._batcher is not None and self._batcher is not batcher:
+            self._batcher.flush()
+
+        batcher.send = self._send_batch
+        self._batcher = batcher
+
+    def queue_device_to_cloud_message(self, data, timestamp=None) -> None:
+        """Queues a device to cloud message to be sent as part of the next batch
+        :param data: The message, either a dictionary, or JSON as a str, bytes, a bytearray or a memoryview
+        :param timestamp: The time the message was created, defaults to the current time
+        """
+        if self._batcher is None:
+            raise IoTError("Batching is not enabled")
+
+        self._batcher.add(data, timestamp)
+
+    def flush_batch(self) -> None:
+        """Sends any messages queued for the next batch straight away
+        """
+        if self._batcher is not None:
+            self._batcher.flush()
+
+    def enable_offline_queue(self, queue: "OfflineQueue", replay_rate: float = 5) -> None:
+        """Stores device to cloud messages that can't be sent in a queue, and sends them once connected
+        :param OfflineQueue queue: The queue to store messages in
+        :param float replay_rate: The maximum number of queued messages to send per second once connected
+        """
+        self._offline_queue = queue
+        self._replay_rate = replay_rate
+        self._replay_allowance = 0
+        self._replay_time = time.monotonic()
+
+    def _replay_offline_queue(self) -> None:
+        now = time.monotonic()
+        self._replay_allowance = min(self._replay_allowance + (now - self._replay_time) * self._replay_rate, max(self._replay_rate, 1))
+        self._replay_time = now
+
+        while self._replay_allowance >= 1 and self._offline_queue.depth > 0:
+            topic, data = self._offline_queue.peek()
+
+            if self._window is not None:
+                if not self._window.available:
+                    return
+
+                self._window.add(topic, data)
+                self._offline_queue.pop()
+                self._replay_allowance -= 1
+                self._send_window()
+                continue
+
+            try:
+                self._send_common(topic, data)
+            except (RuntimeError, minimqtt.MMQTTException) as send_error:
+                self._logger.error("Failed to send queued data: %s", send_error)
+                return
+
+            self._offline_queue.pop()
+            self._replay_allowance -= 1
+            self._callback.message_sent(data)
+
+    def enable_qos1(self, window: "PublishWindow" = None) -> None:
+        """Sends device to cloud messages at QoS 1. Each message is held in the publish window until the hub
+        acknowledges it with a PUBACK, and is sent again after reconnecting if the PUBACK never arrives.
+        message_sent is called when the PUBACK arrives rather than when the message is written.
+        Messages are sent without waiting for the PUBACKs of the ones before them, up to the size of the window,
+        and loop reads the PUBACKs as they arrive
+        :param PublishWindow window: The window to hold the messages in, defaults to one holding up to 4 messages.
+        Pass the same window to a new client to send the messages the old one didn't get acknowledged
+        """
+        if window is None:
+            from publish_window import PublishWindow  # pylint: disable=C0415
+
+            window = PublishWindow()
+
+        self._window = window
+
+    def get_message_latencies(self, percentiles=(50, 90, 99)) -> dict:
+        """Gets percentiles of the recent times from sending a QoS 1 message to its PUBACK
+        :param percentiles: The percentiles to get
+        :returns: A dictionary of each percentile to the time in seconds, empty if QoS 1 is not enabled or nothing has been acknowledged
+        """
+        if self._window is None:
+            return {}
+
+        return self._window.latency_percentiles(percentiles)
+
+    def enable_memory_stats(self, stats: "MemoryStats" = None) -> None:
+        """Measures the heap used by connecting, publishing, handling the twin, direct methods and cloud to device messages
+        :param MemoryStats stats: Where to record the measurements, defaults to a new MemoryStats.
+        Pass the same one to a new client to keep the measurements from before
+        """
+        if stats is None:
+            from memory_stats import MemoryStats  # pylint: disable=C0415
+
+            stats = MemoryStats()
+
+        self._memory_stats = stats
+
+    def get_memory_stats(self) -> dict:
+        """Gets the heap measurements for each kind of operation, empty if memory stats are not enabled.
+        See MemoryStats.get_stats for what is measured
+        """
+        if self._memory_stats is None:
+            return {}
+
+        return self._memory_stats.get_stats()
+
+    @property
+    def metrics(self) -> "Metrics":
+        """The counters and latency histograms for this client, or None if metrics are not enabled
+        """
+        return self._metrics if self._metrics is not _NO_METRICS else None
+
+    def enable_metrics(self, metrics_registry: "Metrics" = None) -> None:
+        """Counts messages, connections and twin requests, and records their latencies
+        :param Metrics metrics_registry: The registry to record into, defaults to a new Metrics.
+        Pass the one used by the client before a reconnect to carry on from its counts
+        """
+        if metrics_registry is None:
+            from metrics import Metrics  # pylint: disable=C0415
+
+            metrics_registry = Metrics()
+
+        self._metrics = metrics_registry
+
+    def use_metrics(self, metrics_registry: "Metrics") -> None:
+        """Records metrics into an existing registry, such as the one used by the client before a reconnect
+        :param Metrics metrics_registry: The registry
+        """
+        self.enable_metrics(metrics_registry)
+
+    def enable_metrics_reporting(self, interval: float, reported_property: str = None, content_type: str = None) -> None:
+        """Sends a snapshot of the metrics every interval seconds from loop, as a device to cloud message
+        or as a reported property of the device twin. Metrics are enabled if they aren't already
+        :param float interval: The number of seconds between snapshots
+        :param str reported_property: The name of the reported property to send the snapshot as, or None to send it as a message
+        :param str content_type: The content type of the messages, so the hub can route them apart from telemetry,
+        defaults to application/vnd.client-metrics+json
+        """
+        if interval <= 0:
+            raise ValueError("interval must be greater than 0")
+
+        if self._metrics is _NO_METRICS:
+            self.enable_metrics()
+
+        self._metrics_interval = interval
+        self._metrics_property = reported_property
+        self._metrics_content_type = content_type
+        self._metrics_due = time.monotonic() + interval
+
+    def send_metrics(self) -> None:
+        """Sends a snapshot of the metrics straight away, in the way set by enable_metrics_reporting,
+        or as a device to cloud message if reporting is not enabled
+        """
+        if self._metrics is _NO_METRICS:
+            raise IoTError("Metrics are not enabled")
+
+        snapshot = self._metrics.snapshot()
+
+        if self._metrics_property is not None:
+            self.update_reported_properties({self._metrics_property: snapshot})
+            return
+
+        content_type = self._metrics_content_type
+        if content_type is None:
+            from metrics import CONTENT_TYPE as content_type  # pylint: disable=C0415
+        self.send_device_to_cloud_message(json.dumps(snapshot), content_type=content_type, content_encoding="utf-8")
+
+    def _send_batch(self, payload):
+        self.send_device_to_cloud_message(payload, content_type="application/json", content_encoding="utf-8")
@@ -0,0 +1,237 @@
+"""The parts of the Azure IoT MQTT and device provisioning protocols that don't depend on how the device talks
+to the network, shared by IoTMQTT, DeviceRegistration and AsyncIoTMQTT
+"""
+
+import json
+from constants import constants
+
+MQTT_API_VERSION = constants["iotcAPIVersion"]
+DPS_API_VERSION = constants["dpsAPIVersion"]
+DPS_ENDPOINT = constants["dpsEndPoint"]
+
+TWIN_PATCH_TOPIC = "$iothub/twin/PATCH/properties/reported/?$rid="
+TWIN_GET_TOPIC = "$iothub/twin/GET/?$rid="
+TWIN_RESPONSE_PREFIX = "$iothub/twin/res/"
+TWIN_DESIRED_PREFIX = "$iothub/twin/PATCH/properties/desired/"
+METHOD_PREFIX = "$iothub/methods/POST/"
+
+
+class IoTResponse:
+    """A response from a direct method call
+    """
+
+    def __init__(self, code, message):
+        self._code = code
+        self._message = message
+
+    def get_response_code(self):
+        """Gets the method response code
+        """
+        return self._code
+
+    def get_response_message(self):
+        """Gets the method response message
+        """
+        return self._message
+
+
+# The base64 and HMAC modules are only needed to sign tokens, so they are imported the first time a token is signed
+# rather than when the library is imported
+_crypto = None
+
+
+def _import_crypto() -> tuple:
+    global _crypto  # pylint: disable=W0603
+    if _crypto is None:
+        # pylint: disable=C0415
+        import circuitpython_base64 as base64
+
+        try:
+            # CPython, the CircuitPython HMAC port doesn't run there
+            import hmac
+            import hashlib
+        except ImportError:
+            import circuitpython_hmac as hmac
+            import adafruit_hashlib as hashlib
+
+        _crypto = (base64, hmac, hashlib)
+
+    return _crypto
+
+
+def _quote_signature(signature) -> str:
+    # a base64 signature only has these three characters that need quoting, which is much quicker than parse.quote
+    return str(signature, "utf-8").replace("+", "%2B").replace("/", "%2F").replace("=", "%3D")
+
+
+class SasSigner:
+    """Signs with one key over and over, for renewing a device's SAS token or deriving many device keys from a group key.
+    The key is decoded and the HMAC keyed once, so each signature only hashes the message, and the start of the
+    token is built once, so signing returns a token ready to use
+    """
+
+    def __init__(self, key: str, resource_uri: str = None, key_name: str = None):
+        """Create the signer
+        :param str key: The base64 encoded key to sign with
+        :param str resource_uri: The URL encoded resource the tokens grant access to, only needed for sign
+        :param str key_name: The name of the key or policy, if the service needs it
+        """
+        self._base64, hmac, hashlib = _import_crypto()
+        self._hmac = hmac.new(self._base64.b64decode(key), digestmod=hashlib.sha256)
+        self._string_to_sign = None if resource_uri is None else resource_uri + "\n"
+        self._token_start = "SharedAccessSignature sr=" + str(resource_uri) + "&sig="
+        self._token_end = "" if key_name is None else "&skn=" + key_name
+
+    def digest(self, message: str) -> bytes:
+        """Signs a message with HMAC-SHA256
+        :param str message: The message to sign
+        :returns: The base64 encoded signature
+        """
+        # copying the keyed HMAC copies its inner and outer hashes with the padded key already hashed
+        hmac = self._hmac.copy()
+        hmac.update(message.encode("utf-8"))
+        return self._base64.b64encode(hmac.digest())
+
+    def sign(self, expiry: int) -> str:
+        """Generates a shared access signature token for the resource
+        :param int expiry: The time the token expires, in seconds since the epoch
+        """
+        expiry = str(expiry)
+        signature = _quote_signature(self.digest(self._string_to_sign + expiry))
+        return self._token_start + signature + "&se=" + expiry + self._token_end
+
+
+def compute_derived_symmetric_key(secret, msg: str) -> bytes:
+    """Signs a message with HMAC-SHA256 using a base64 encoded key, use a SasSigner to sign many messages with the same key
+    :param secret: The base64 encoded key
+    :param str msg: The message to sign
+    :returns: The base64 encoded signature
+    """
+    return SasSigner(secret).digest(msg)
+
+
+def generate_sas_token(resource_uri: str, key: str, expiry: int, key_name: str = None) -> str:
+    """Generates a shared access signature token, use a SasSigner to sign many tokens for the same resource
+    :param str resource_uri: The URL encoded resource the token grants access to
+    :param str key: The base64 encoded key to sign the token with
+    :param int expiry: The time the token expires, in seconds since the epoch
+    :param str key_name: The name of the key or policy, if the service needs it
+    """
+    return SasSigner(key, resource_uri, key_name).sign(expiry)
+
+
+def device_resource_uri(hostname: str, device_id: str) -> str:
+    """Gets the resource a device's MQTT SAS token is signed for
+    """
+    return hostname + "%2Fdevices%2F" + device_id
+
+
+def registration_resource_uri(id_scope: str, device_id: str) -> str:
+    """Gets the resource a device's provisioning SAS token is signed for
+    """
+    return id_scope + "%2Fregistrations%2F" + device_id
+
+
+def mqtt_username(hostname: str, device_id: str) -> str:
+    """Gets the MQTT username for a device
+    """
+    return "{}/{}/api-version={}".format(hostname, device_id, MQTT_API_VERSION)
+
+
+def d2c_topic(device_id: str) -> str:
+    """Gets the topic for device to cloud messages without any properties
+    """
+    return "devices/{}/messages/events/".format(device_id)
+
+
+def c2d_prefix(device_id: str) -> str:
+    """Gets the topic prefix of cloud to device messages, the message properties follow it
+    """
+    return "devices/{}/messages/devicebound/".format(device_id)
+
+
+def subscription_topics(device_id: str) -> list:
+    """Gets the topics a device subscribes to
+    """
+    return [
+        "devices/{}/messages/events/#".format(device_id),
+        c2d_prefix(device_id) + "#",
+        TWIN_DESIRED_PREFIX + "#",  # twin desired property changes
+        TWIN_RESPONSE_PREFIX + "#",  # twin properties response
+        "$iothub/methods/#",
+    ]
+
+
+def parse_twin_response(topic: str) -> tuple:
+    """Parses a twin response topic, $iothub/twin/res/{status}/?$rid={request id} with &$version={version} for patches
+    :param str topic: The topic
+    :returns: A tuple of the status, the request ID and the version, which is None if the topic doesn't have one
+    :raises ValueError: If the topic doesn't have a status
+    """
+    start = len(TWIN_RESPONSE_PREFIX)
+    status = int(topic[start : topic.find("/", start)])
+
+    request_id = None
+    version = None
+    for part in topic[topic.find("?") + 1 :].split("&"):
+        if part.startswith("$rid="):
+            request_id = part[5:]
+        elif part.startswith("$version="):
+            version = int(part[9:])
+
+    return status, request_id, version
+
+
+def parse_method_topic(topic: str) -> tuple:
+    """Parses a direct method topic, $iothub/methods/POST/{method name}/?$rid={request id}
+    :param str topic: The topic
+    :returns: A tuple of the method name and the request ID, which is None if the topic doesn't have one
+    """
+    start = len(METHOD_PREFIX)
+    method_name = topic[start : topic.find("/", start + 1)]
+
+    request_id = None
+    index = topic.find("$rid=")
+    if index != -1:
+        end = topic.find("&", index)
+        request_id = topic[index + 5 :] if end == -1 else topic[index + 5 : end]
+
+    return method_name, request_id
+
+
+def method_response(response: IoTResponse, request_id) -> tuple:
+    """Gets the topic and payload to send the response to a direct method on
+    :param IoTResponse response: The response from the method handler
+    :param request_id: The request ID from the method topic
+    :returns: A tuple of the topic and the JSON payload
+    """
+    code = 200
+    message = "{}"
+    if response.get_response_code() is not None:
+        code = response.get_response_code()
+    if response.get_response_message() is not None:
+        message = response.get_response_message()
+
+        # the message must be JSON
+        if not message.startswith("{") or not message.endswith("}"):
+            message = json.dumps({"Value": message})
+
+    return "$iothub/methods/res/{}/?$rid={}".format(code, request_id), message
+
+
+def dps_register_url(id_scope: str, device_id: str) -> str:
+    """Gets the URL to register a device with the device provisioning service
+    """
+    return "https://%s/%s/registrations/%s/register?api-version=%s" % (DPS_ENDPOINT, id_scope, device_id, DPS_API_VERSION)
+
+
+def dps_operation_url(id_scope: str, device_id: str, operation_id: str) -> str:
+    """Gets the URL to poll the status of a device provisioning service registration
+    """
+    return "https://%s/%s/registrations/%s/operations/%s?api-version=%s" % (
+        DPS_ENDPOINT,
+        id_scope,
+        device_id,
+        operation_id,
+        DPS_API_VERSION,
+    )
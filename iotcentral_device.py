@@ -4,32 +4,46 @@
 import json
 import time
 from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager
-from device_registration import DeviceRegistration
+from adafruit_minimqtt import CONNACK_ERRORS, MMQTTException
+from gc_policy import GCPolicy
+from iot_device import IoTDeviceBase
 from iot_error import IoTError
-from iot_mqtt import IoTMQTT, IoTMQTTCallback, IoTResponse
+from iot_mqtt import IoTMQTT
 import adafruit_logging as logging
 
 
-class IoTCentralDevice(IoTMQTTCallback):
-    """A device client for the Azure IoT Central service
+# the CONNACK return codes for an ID rejected, a bad username or password, and not authorized
+_REFUSED_CODES = (0x02, 0x04, 0x05)
+
+
+def _connack_code(error) -> int:
+    """Gets the CONNACK return code the broker refused a connection with, or None if the connection failed for another reason
     """
+    code = getattr(error, "code", None)
+    if code is None and isinstance(error, MMQTTException) and error.args:
+        # MiniMQTT releases without the code on the exception raise it with the description of the code
+        for return_code, description in CONNACK_ERRORS.items():
+            if error.args[0] == description:
+                return return_code
 
-    def connection_status_change(self, connected: bool) -> None:
-        """Called when the connection status changes
-        """
-        if self.on_connection_status_changed is not None:
-            # pylint: disable=E1102
-            self.on_connection_status_changed(connected)
+    return code
 
-    # pylint: disable=W0613, R0201
-    def direct_method_called(self, method_name: str, data) -> IoTResponse:
-        """Called when a direct method is invoked
-        """
-        if self.on_command_executed is not None:
-            # pylint: disable=E1102
-            return self.on_command_executed(method_name, data)
 
-        raise IoTError("on_command_executed not set")
+def _is_assignment_refused(error) -> bool:
+    """Gets if an error connecting to a cached hub means the device is no longer assigned to it
+    """
+    # the hub refused the device, or the hub hostname no longer resolves
+    return _connack_code(error) in _REFUSED_CODES or (isinstance(error, RuntimeError) and str(error) == "Failed to request hostname")
+
+
+class IoTCentralDevice(IoTDeviceBase):
+    """A device client for the Azure IoT Central service
+    """
+
+    _not_connected_message = "You are not connected to IoT Central"
+
+    def _method_callback(self):
+        return self.on_command_executed
 
     def device_twin_desired_updated(self, desired_property_name: str, desired_property_value, desired_version: int) -> None:
         """Called when the device twin is updated
@@ -50,73 +64,156 @@ class IoTCentralDevice(IoTMQTTCallback):
 
     # pylint: disable=R0913
     def __init__(
-        self, wifi_manager: ESPSPI_WiFiManager, id_scope: str, device_id: str, key: str, token_expires: int = 21600, logger: logging = None
+        self,
+        wifi_manager: ESPSPI_WiFiManager,
+        id_scope: str,
+        device_id: str,
+        key: str,
+        token_expires: int = 21600,
+        logger: logging = None,
+        assignment_cache: "DeviceRegistrationCache" = None,
+        gc_policy: GCPolicy = None,
     ):
-        self._wifi_manager = wifi_manager
+        """Create the IoT Central device client
+        :param wifi_manager: The WiFi manager
+        :param str id_scope: The ID scope of the device
+        :param str device_id: The device ID of the device
+        :param str key: The primary or secondary key of the device
+        :param int token_expires: The number of seconds till the token expires, defaults to 6 hours
+        :param adafruit_logging logger: The logger
+        :param DeviceRegistrationCache assignment_cache: A cache of the assigned hub, used to skip provisioning on the next boot
+        :param GCPolicy gc_policy: When to run the garbage collector around network requests, defaults to before and after every request
+        """
+        super().__init__(wifi_manager, token_expires, logger, gc_policy)
+
         self._id_scope = id_scope
         self._device_id = device_id
         self._key = key
-        self._token_expires = token_expires
-        self._logger = logger
+        self._assignment_cache = assignment_cache
+        self._cached_hostname = None
+        self._connecting = False
         self._device_registration = None
-        self._mqtt = None
 
-        self.on_connection_status_changed = None
         self.on_command_executed = None
         self.on_property_changed = None
 
     def connect(self):
         """Connects to Azure IoT Central
         """
-        self._device_registration = DeviceRegistration(self._wifi_manager, self._id_scope, self._device_id, self._key, self._logger)
-
-        token_expiry = int(time.time() + self._token_expires)
-        hostname = self._device_registration.register_device(token_expiry)
-        self._mqtt = IoTMQTT(self, self._wifi_manager, hostname, self._device_id, self._key, self._token_expires, self._logger)
+        self.connect_start()
 
-        self._mqtt.connect()
+        while not self.connect_poll():
+            if self._mqtt is None:
+                time.sleep(self._device_registration.step_delay)
 
-    def disconnect(self):
-        """Disconnects from the MQTT broker
+    def connect_start(self):
+        """Starts connecting to Azure IoT Central without blocking while the device is provisioned and connects.
+        Call connect_poll from the main loop until it returns True
         """
-        if self._mqtt is None:
-            raise IoTError("You are not connected to IoT Central")
+        self._mqtt = None
+        self._connecting = True
+        self._cached_hostname = None
 
-        self._mqtt.disconnect()
+        if self._assignment_cache is not None:
+            self._cached_hostname = self._assignment_cache.get(self._id_scope, self._device_id, self._key)
 
-    def is_connected(self) -> bool:
-        """Gets if there is an open connection to the MQTT broker
-        """
-        if self._mqtt is not None:
-            return self._mqtt.is_connected()
+        if self._cached_hostname is None:
+            self._start_registration()
 
-        return False
+    def connect_poll(self) -> bool:
+        """Moves the connection started by connect_start on by one step. Each call makes at most one
+        provisioning request, or does a bounded amount of work connecting to the hub, and returns straight away
+        Returns True once connecting has finished, use is_connected to see if it succeeded
+        """
+        if not self._connecting:
+            return True
 
-    def loop(self):
-        """Listens for MQTT messages
+        if self._mqtt is None:
+            if self._cached_hostname is not None:
+                hostname = self._cached_hostname
+                self._logger.info("Connecting to cached hub %s", hostname)
+            else:
+                hostname = self._device_registration.register_device_step()
+                if hostname is None:
+                    return False
+
+                if self._assignment_cache is not None:
+                    self._assignment_cache.set(self._id_scope, self._device_id, self._key, hostname)
+
+            self._create_mqtt(hostname)
+            self._mqtt.connect_start()
+
+        try:
+            done = self._mqtt.connect_poll()
+        except (MMQTTException, RuntimeError) as connect_error:
+            self._mqtt = None
+
+            if self._cached_hostname is None or not _is_assignment_refused(connect_error):
+                self._connecting = False
+                raise
+
+            self._logger.info("Cached hub refused the connection, registering the device again: %s", connect_error)
+            self._cached_hostname = None
+            self._assignment_cache.clear()
+            self._start_registration()
+            return False
+
+        if done:
+            self._connecting = False
+
+        return done
+
+    def get_connect_timings(self) -> dict:
+        """Gets how long each phase of the last connection to the hub took in seconds.
+        The time taken to provision the device is reported as provisioning
         """
         if self._mqtt is None:
-            raise IoTError("You are not connected to IoT Central")
+            return {}
+
+        timings = self._mqtt.get_connect_timings()
+        if self._cached_hostname is None and self._device_registration is not None:
+            timings["provisioning"] = self._device_registration.elapsed
 
-        self._mqtt.loop()
+        return timings
+
+    def _start_registration(self):
+        # only imported when the device has to be provisioned, which a device with a cached assignment skips
+        from device_registration import DeviceRegistration  # pylint: disable=C0415
+
+        self._device_registration = DeviceRegistration(
+            self._wifi_manager, self._id_scope, self._device_id, self._key, self._logger, self._gc_policy, self._memory_stats
+        )
+        self._device_registration.start_registration(int(time.time() + self._token_expires))
+
+    def _create_mqtt(self, hostname: str):
+        self._mqtt = IoTMQTT(self, self._wifi_manager, hostname, self._device_id, self._key, self._token_expires, self._logger, self._gc_policy)
+        self._configure_mqtt()
 
     def send_property(self, property_name, data):
-        """Updates the value of a writable property
+        """Updates the value of a writable property. Updates made within the reported properties window are sent
+        together as one twin patch, call flush_properties to send them straight away
         """
         if self._mqtt is None:
-            raise IoTError("You are not connected to IoT Central")
+            raise IoTError(self._not_connected_message)
 
-        patch_json = {property_name: data}
-        patch = json.dumps(patch_json)
-        self._mqtt.send_twin_patch(patch)
+        self._mqtt.update_reported_properties({property_name: data})
 
     def send_telemetry(self, data):
         """Sends telemetry to the IoT Central app
+        :param data: The telemetry, as a dictionary, a JSON str, or JSON as bytes, a bytearray or a memoryview
         """
         if self._mqtt is None:
-            raise IoTError("You are not connected to IoT Central")
+            raise IoTError(self._not_connected_message)
 
         if isinstance(data, dict):
             data = json.dumps(data)
 
         self._mqtt.send_device_to_cloud_message(data)
+
+    def queue_telemetry(self, data, timestamp=None):
+        """Queues telemetry to be sent to the IoT Central app as part of the next batch
+        """
+        if self._mqtt is None:
+            raise IoTError(self._not_connected_message)
+
+        self._mqtt.queue_device_to_cloud_message(data, timestamp)
@@ -2,8 +2,10 @@
 """
 
 import json
+from gc_policy import GCPolicy
+from iot_device import IoTDeviceBase
 from iot_error import IoTError
-from iot_mqtt import IoTMQTT, IoTMQTTCallback, IoTResponse
+from iot_mqtt import IoTMQTT
 from adafruit_esp32spi.adafruit_esp32spi_wifimanager import ESPSPI_WiFiManager
 import adafruit_logging as logging
 
@@ -46,30 +48,19 @@ VALID_KEYS = [
 ]
 
 
-class IoTHubDevice(IoTMQTTCallback):
+class IoTHubDevice(IoTDeviceBase):
     """A device client for the Azure IoT Hub service
     """
 
-    def connection_status_change(self, connected: bool) -> None:
-        """Called when the connection status changes
-        """
-        if self.on_connection_status_changed is not None:
-            # pylint: disable=E1102
-            self.on_connection_status_changed(connected)
-
-    # pylint: disable=W0613, R0201
-    def direct_method_called(self, method_name: str, data) -> IoTResponse:
-        """Called when a direct method is invoked
-        """
-        if self.on_direct_method_called is not None:
-            # pylint: disable=E1102
-            return self.on_direct_method_called(method_name, data)
+    _not_connected_message = "You are not connected to IoT Hub"
 
-        raise IoTError("on_direct_method_called not set")
+    def _method_callback(self):
+        return self.on_direct_method_called
 
     # pylint: disable=C0103
-    def cloud_to_device_message_received(self, body: str, properties: dict):
-        """Called when a cloud to device message is received
+    def cloud_to_device_message_received(self, body: str, properties: "MessageProperties"):
+        """Called when a cloud to device message is received. The properties are read like a dictionary,
+        and are only parsed from the topic once one of them is read
         """
         if self.on_cloud_to_device_message_received is not None:
             # pylint: disable=E1102
@@ -89,10 +80,10 @@ class IoTHubDevice(IoTMQTTCallback):
             # pylint: disable=E1102
             self.on_device_twin_reported_updated(reported_property_name, reported_property_value, reported_version)
 
-    def __init__(self, wifi_manager: ESPSPI_WiFiManager, device_connection_string: str, token_expires: int = 21600, logger: logging = None):
-        self._token_expires = token_expires
-        self._logger = logger if logger is not None else logging.getLogger("log")
-        self._wifi_manager = wifi_manager
+    def __init__(
+        self, wifi_manager: ESPSPI_WiFiManager, device_connection_string: str, token_expires: int = 21600, logger: logging = None, gc_policy: GCPolicy = None
+    ):
+        super().__init__(wifi_manager, token_expires, logger, gc_policy)
 
         connection_string_values = {}
 
@@ -111,63 +102,79 @@ class IoTHubDevice(IoTMQTTCallback):
         self._device_id = connection_string_values[DEVICE_ID]
         self._shared_access_key = connection_string_values[SHARED_ACCESS_KEY]
 
-        self._logger.debug("Hostname: " + self._hostname)
-        self._logger.debug("Device Id: " + self._device_id)
-        self._logger.debug("Shared Access Key: " + self._shared_access_key)
+        self._logger.debug("Hostname: %s", self._hostname)
+        self._logger.debug("Device Id: %s", self._device_id)
 
-        self.on_connection_status_changed = None
         self.on_direct_method_called = None
         self.on_cloud_to_device_message_received = None
         self.on_device_twin_desired_updated = None
         self.on_device_twin_reported_updated = None
 
-        self._mqtt = None
-
     def connect(self):
         """Connects to Azure IoT Central
         """
-        self._mqtt = IoTMQTT(self, self._wifi_manager, self._hostname, self._device_id, self._shared_access_key, self._token_expires, self._logger)
+        self._create_mqtt()
         self._mqtt.connect()
 
-    def disconnect(self):
-        """Disconnects from the MQTT broker
+    def connect_start(self):
+        """Starts connecting to Azure IoT Hub without blocking. Call connect_poll from the main loop until it returns True
+        """
+        self._create_mqtt()
+        self._mqtt.connect_start()
+
+    def connect_poll(self) -> bool:
+        """Moves the connection started by connect_start on by one step, doing a bounded amount of work.
+        Returns True once connecting has finished, use is_connected to see if it succeeded
         """
         if self._mqtt is None:
-            raise IoTError("You are not connected to IoT Central")
+            raise IoTError("connect_start has not been called")
 
-        self._mqtt.disconnect()
+        return self._mqtt.connect_poll()
 
-    def is_connected(self) -> bool:
-        """Gets if there is an open connection to the MQTT broker
+    def get_connect_timings(self) -> dict:
+        """Gets how long each phase of the last connection took in seconds
         """
-        if self._mqtt is not None:
-            return self._mqtt.is_connected()
+        if self._mqtt is None:
+            return {}
 
-        return False
+        return self._mqtt.get_connect_timings()
 
-    def loop(self):
-        """Listens for MQTT messages
+    def _create_mqtt(self):
+        self._mqtt = IoTMQTT(
+            self, self._wifi_manager, self._hostname, self._device_id, self._shared_access_key, self._token_expires, self._logger, self._gc_policy
+        )
+        self._configure_mqtt()
+
+    def send_device_to_cloud_message(self, message, system_properties: dict = None, content_type: str = None, content_encoding: str = None):
+        """Sends a device to cloud message to the IoT Hub
+        :param message: The message, as a str, or as bytes, a bytearray or a memoryview of UTF-8 encoded text
+        :param dict system_properties: The system and application properties of the message, these are percent-encoded
+        :param str content_type: The content type of the message, such as application/json
+        :param str content_encoding: The content encoding of the message, such as utf-8
         """
         if self._mqtt is None:
-            raise IoTError("You are not connected to IoT Central")
+            raise IoTError(self._not_connected_message)
 
-        self._mqtt.loop()
+        self._mqtt.send_device_to_cloud_message(message, system_properties, content_type, content_encoding)
 
-    def send_device_to_cloud_message(self, message, system_properties=None):
-        """Sends a device to cloud message to the IoT Hub
+    def queue_device_to_cloud_message(self, message, timestamp=None):
+        """Queues a device to cloud message to be sent to the IoT Hub as part of the next batch
         """
         if self._mqtt is None:
-            raise IoTError("You are not connected to IoT Central")
+            raise IoTError(self._not_connected_message)
 
-        self._mqtt.send_device_to_cloud_message(message, system_properties)
+        self._mqtt.queue_device_to_cloud_message(message, timestamp)
 
     def update_twin(self, patch):
         """Updates the reported properties in the devices device twin
+        Updates made within the reported properties window are sent together as one twin patch,
+        call flush_properties to send them straight away
+        :param patch: The patch, as a dictionary, a JSON str, or JSON as bytes, a bytearray or a memoryview
         """
         if self._mqtt is None:
-            raise IoTError("You are not connected to IoT Central")
+            raise IoTError(self._not_connected_message)
 
-        if isinstance(patch, dict):
-            patch = json.dumps(patch)
+        if not isinstance(patch, dict):
+            patch = json.loads(patch if isinstance(patch, str) else str(patch, "utf-8"))
 
-        self._mqtt.send_twin_patch(patch)
+        self._mqtt.update_reported_properties(patch)
@@ -0,0 +1,102 @@
+"""Opt-in measurement of the heap each kind of operation uses, to find which one runs out of memory
+"""
+
+import gc
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class MemoryStats:
+    """Records, for each kind of operation such as connect or publish, how much it allocated and the most heap
+    that was in use while it ran. Operations can be nested, a twin parse while connecting counts towards both.
+
+    On CircuitPython this uses gc.mem_alloc and gc.mem_free. Nothing is freed during an operation unless the
+    garbage collector runs, so the growth of the heap is everything the operation allocated, garbage included,
+    and the high water mark is the heap in use when it finished. On CPython it uses tracemalloc, starting it if
+    it isn't already tracing, so the same numbers can be collected off the device. There the allocation is the
+    net growth and the high water mark is the true peak.
+    """
+
+    def __init__(self):
+        # operation name -> [count, last allocation, largest allocation, high water mark, lowest free heap]
+        self._stats = {}
+        # the operations running, as [name, heap in use at the start, high water mark so far]
+        self._running = []
+        self._tracing = not hasattr(gc, "mem_alloc") and tracemalloc is not None
+        if self._tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _used(self) -> int:
+        if self._tracing:
+            return tracemalloc.get_traced_memory()[0]
+        return gc.mem_alloc()
+
+    def start(self, operation: str) -> None:
+        """Starts measuring an operation, call end when it finishes
+        :param str operation: The kind of operation
+        """
+        used = self._used()
+
+        if self._tracing:
+            # the peak is reset for this operation, so pass what it was on to the one this is nested in first
+            if self._running:
+                parent = self._running[-1]
+                parent[2] = max(parent[2], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        self._running.append([operation, used, used])
+
+    def end(self) -> None:
+        """Finishes measuring the most recently started operation
+        """
+        operation, start_used, high_water = self._running.pop()
+        used = self._used()
+        high_water = max(high_water, used, tracemalloc.get_traced_memory()[1] if self._tracing else 0)
+        free = gc.mem_free() if hasattr(gc, "mem_free") else None
+
+        if self._running:
+            parent = self._running[-1]
+            parent[2] = max(parent[2], high_water)
+
+        allocated = used - start_used
+        stats = self._stats.get(operation)
+        if stats is None:
+            self._stats[operation] = [1, allocated, allocated, high_water, free]
+            return
+
+        stats[0] += 1
+        stats[1] = allocated
+        stats[2] = max(stats[2], allocated)
+        stats[3] = max(stats[3], high_water)
+        if free is not None:
+            stats[4] = free if stats[4] is None else min(stats[4], free)
+
+    def measure(self, operation: str, function, *args):
+        """Calls a function, measuring it as an operation
+        :param str operation: The kind of operation
+        :param function: The function to call
+        :returns: What the function returns
+        """
+        self.start(operation)
+        try:
+            return function(*args)
+        finally:
+            self.end()
+
+    def get_stats(self) -> dict:
+        """Gets the measurements for each kind of operation. Each is a dictionary of count, the number of times it ran,
+        last, the bytes allocated the last time, max, the most bytes allocated in one run, high_water, the most bytes
+        of heap in use while it ran, and min_free, the least free heap after it ran, which is None on CPython
+        """
+        return {
+            operation: {"count": stats[0], "last": stats[1], "max": stats[2], "high_water": stats[3], "min_free": stats[4]}
+            for operation, stats in self._stats.items()
+        }
+
+    def reset(self) -> None:
+        """Clears the measurements
+        """
+        self._stats = {}
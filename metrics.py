@@ -0,0 +1,157 @@
+"""Counters and latency histograms for the health of the client, sized when created so recording never allocates.
+Latencies are recorded as whole milliseconds, so recording one doesn't create a float
+"""
+
+# The content type of metrics sent as device to cloud messages, so they can be routed apart from telemetry
+CONTENT_TYPE = "application/vnd.client-metrics+json"
+
+# The upper bounds of the latency buckets in milliseconds, with a final bucket for anything slower
+DEFAULT_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+COUNTERS = (
+    "messages_sent",
+    "messages_failed",
+    "messages_received",
+    "bytes_out",
+    "bytes_in",
+    "connects",
+    "connect_failures",
+    "reconnects",
+    "methods",
+    "c2d_messages",
+    "twin_requests",
+    "twin_failures",
+)
+
+HISTOGRAMS = ("publish", "dispatch", "twin", "connect", "subscribe", "twin_sync", "outage")
+
+
+class LatencyHistogram:
+    """Counts latencies in fixed buckets, and keeps their count, sum and maximum
+    """
+
+    def __init__(self, bounds: tuple = DEFAULT_BOUNDS_MS):
+        """Create the histogram
+        :param tuple bounds: The increasing upper bounds of the buckets in milliseconds
+        """
+        self._bounds = bounds
+        self._buckets = [0] * (len(bounds) + 1)
+        self._count = 0
+        self._sum = 0
+        self._max = 0
+
+    @property
+    def count(self) -> int:
+        """The number of latencies recorded
+        """
+        return self._count
+
+    def record(self, milliseconds: int) -> None:
+        """Records a latency
+        :param int milliseconds: The latency in whole milliseconds, such as a time.monotonic_ns() delta // 1000000
+        """
+        index = 0
+        bounds = self._bounds
+        while index < len(bounds) and milliseconds > bounds[index]:
+            index += 1
+
+        self._buckets[index] += 1
+        self._count += 1
+        self._sum += milliseconds
+        if milliseconds > self._max:
+            self._max = milliseconds
+
+    def percentile(self, percent: float) -> float:
+        """Gets an estimate of a percentile, the upper bound of the bucket it falls in, or the maximum for the last bucket
+        :param float percent: The percentile, from 0 to 100
+        :returns: The latency in milliseconds, 0 if nothing has been recorded
+        """
+        if self._count == 0:
+            return 0
+
+        rank = max(1, -(-percent * self._count // 100))
+        seen = 0
+        for index, bucket in enumerate(self._buckets):
+            seen += bucket
+            if seen >= rank:
+                return min(self._bounds[index], self._max) if index < len(self._bounds) else self._max
+
+        return self._max
+
+    def snapshot(self) -> dict:
+        """Gets the count, the sum and maximum in milliseconds, and the count in each bucket. Buckets from many devices
+        can be added together, unlike percentiles
+        """
+        return {"count": self._count, "sum_ms": self._sum, "max_ms": self._max, "buckets": list(self._buckets)}
+
+    def reset(self) -> None:
+        """Clears the histogram
+        """
+        for index in range(len(self._buckets)):
+            self._buckets[index] = 0
+        self._count = 0
+        self._sum = 0
+        self._max = 0
+
+
+class Metrics:
+    """The counters and latency histograms for one device. The set of names is fixed when it is created,
+    so recording a value only updates what is already there.
+
+    Counters are messages_sent, messages_failed, messages_received, bytes_out, bytes_in, connects, connect_failures,
+    reconnects, methods, c2d_messages, twin_requests and twin_failures. Histograms are publish, dispatch, twin for
+    twin round trips, connect, subscribe and twin_sync for the phases of connecting, and outage for how long the
+    connection was lost before a reconnect supervisor restored it.
+    """
+
+    def __init__(self, bounds: tuple = DEFAULT_BOUNDS_MS):
+        """Create the registry
+        :param tuple bounds: The increasing upper bounds of the latency buckets in milliseconds
+        """
+        self._bounds = bounds
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._histograms = {name: LatencyHistogram(bounds) for name in HISTOGRAMS}
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        """Adds to a counter
+        :param str name: The name of the counter
+        :param int amount: The amount to add
+        """
+        self._counters[name] += amount
+
+    def record(self, name: str, milliseconds: int) -> None:
+        """Records a latency
+        :param str name: The name of the histogram
+        :param int milliseconds: The latency in whole milliseconds
+        """
+        self._histograms[name].record(milliseconds)
+
+    def counter(self, name: str) -> int:
+        """Gets the value of a counter
+        :param str name: The name of the counter
+        """
+        return self._counters[name]
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        """Gets a histogram
+        :param str name: The name of the histogram
+        """
+        return self._histograms[name]
+
+    def snapshot(self) -> dict:
+        """Gets a compact copy of the metrics to send to the cloud: the counters, the bucket bounds in milliseconds,
+        and the histograms that have recorded anything
+        """
+        return {
+            "counters": dict(self._counters),
+            "bounds_ms": list(self._bounds),
+            "latency": {name: histogram.snapshot() for name, histogram in self._histograms.items() if histogram.count},
+        }
+
+    def reset(self) -> None:
+        """Sets all the counters to zero and clears the histograms
+        """
+        for name in self._counters:
+            self._counters[name] = 0
+        for histogram in self._histograms.values():
+            histogram.reset()
@@ -0,0 +1,280 @@
+"""Store and forward queue for device to cloud messages
+"""
+
+import json
+import os
+
+
+class _Filesystem:
+    """The filesystem used to store queue segments, this is the CIRCUITPY drive on a device
+    """
+
+    @staticmethod
+    def open(path: str, mode: str):
+        """Opens a file
+        """
+        return open(path, mode)
+
+    @staticmethod
+    def remove(path: str) -> None:
+        """Deletes a file
+        """
+        os.remove(path)
+
+    @staticmethod
+    def listdir(path: str) -> list:
+        """Lists the files in a directory
+        """
+        return os.listdir(path)
+
+    @staticmethod
+    def mkdir(path: str) -> None:
+        """Creates a directory
+        """
+        os.mkdir(path)
+
+
+# pylint: disable=R0902
+class OfflineQueue:
+    """A bounded queue of device to cloud messages that could not be sent.
+
+    Messages are held in a fixed size ring buffer in RAM. Once that is full, new messages are appended to
+    segment files on the filesystem, and when all the segments are full the oldest segment is deleted.
+    Messages are always returned oldest first.
+
+    The filesystem must be writable from code to spill to it, on CircuitPython this means remounting
+    the CIRCUITPY drive in boot.py. Segments left over from a previous boot are picked up and replayed from
+    where reading them had got to, so messages already sent aren't sent again.
+    """
+
+    _segment_prefix = "seg"
+    _segment_suffix = ".q"
+    # the sequence number of the oldest segment, the offset to read it from, and how many of its messages were read
+    _position_file = "read.pos"
+
+    # pylint: disable=R0913
+    def __init__(self, ram_size: int = 16, directory: str = None, segment_size: int = 64, max_segments: int = 4, fs=None):
+        """Create the queue
+        :param int ram_size: The number of messages held in RAM
+        :param str directory: The directory to spill messages to when RAM is full, if this is None messages are only held in RAM
+        :param int segment_size: The number of messages stored in each segment file
+        :param int max_segments: The number of segment files to keep before dropping the oldest
+        :param fs: The filesystem to store segments on, an object with open, remove, listdir and mkdir methods
+        """
+        if ram_size < 1:
+            raise ValueError("ram_size must be at least 1")
+
+        self._ram = [None] * ram_size
+        self._ram_head = 0
+        self._ram_count = 0
+
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_segments = max_segments
+        self._fs = fs if fs is not None else _Filesystem()
+
+        # [sequence number, unread message count, written message count] for each segment file, oldest first
+        self._segments = []
+        self._segment_count = 0
+        self._read_offset = 0
+        self._peeked = None
+        self._peeked_offset = 0
+        # set when the filesystem couldn't be written, so new messages are held in RAM after the spilled ones
+        self._ram_after_segments = False
+
+        self._dropped = 0
+
+        if directory is not None:
+            self._load_segments()
+
+    @property
+    def depth(self) -> int:
+        """The number of messages waiting in the queue
+        """
+        return self._ram_count + self._segment_count
+
+    @property
+    def dropped(self) -> int:
+        """The number of messages dropped because the queue was full
+        """
+        return self._dropped
+
+    def put(self, topic: str, data) -> None:
+        """Adds a message to the end of the queue, dropping the oldest messages if the queue is full
+        :param str topic: The topic to publish the message on
+        :param data: The message
+        """
+        # once messages have spilled to the filesystem new ones have to go after them to keep the order
+        if (not self._segments or self._ram_after_segments) and self._ram_count < len(self._ram):
+            self._ram[(self._ram_head + self._ram_count) % len(self._ram)] = (topic, data)
+            self._ram_count += 1
+            return
+
+        if self._directory is not None and self._max_segments > 0 and not self._ram_after_segments:
+            try:
+                self._append(topic, data)
+                return
+            except OSError:
+                # the filesystem is read-only or full, such as with segments left over from a previous boot.
+                # An empty RAM buffer can hold new messages to send after the spilled ones, but messages already
+                # in RAM are older than the spilled ones, so dropping one would put this message ahead of them
+                if self._segments:
+                    if self._ram_count > 0:
+                        self._dropped += 1
+                        return
+
+                    self._ram_after_segments = True
+                    self._ram[self._ram_head] = (topic, data)
+                    self._ram_count = 1
+                    return
+
+        self._ram[self._ram_head] = (topic, data)
+        self._ram_head = (self._ram_head + 1) % len(self._ram)
+        self._dropped += 1
+
+    def peek(self):
+        """Gets the oldest message in the queue without removing it
+        :returns: A tuple of the topic and the message, or None if the queue is empty
+        """
+        if self._ram_count > 0 and not self._ram_after_segments:
+            return self._ram[self._ram_head]
+
+        if not self._segments:
+            return None
+
+        if self._peeked is None:
+            with self._fs.open(self._segment_path(self._segments[0][0]), "r") as segment:
+                segment.seek(self._read_offset)
+                line = segment.readline()
+                self._peeked_offset = segment.tell()
+
+            self._peeked = tuple(json.loads(line))
+
+        return self._peeked
+
+    def pop(self) -> None:
+        """Removes the oldest message from the queue
+        """
+        if self._ram_count > 0 and not self._ram_after_segments:
+            self._ram[self._ram_head] = None
+            self._ram_head = (self._ram_head + 1) % len(self._ram)
+            self._ram_count -= 1
+            return
+
+        if not self._segments:
+            return
+
+        if self._peeked is None:
+            self.peek()
+
+        self._peeked = None
+        self._read_offset = self._peeked_offset
+        self._segments[0][1] -= 1
+        self._segment_count -= 1
+
+        if self._segments[0][1] == 0:
+            self._remove_oldest_segment()
+        else:
+            self._save_position()
+
+    def _is_full(self, segment) -> bool:
+        return segment[2] >= self._segment_size
+
+    def _append(self, topic: str, data) -> None:
+        new_segment = not self._segments or self._is_full(self._segments[-1])
+        sequence = self._segments[-1][0] if self._segments else -1
+        if new_segment:
+            sequence += 1
+
+        # a segment is only recorded once a message has been written to it, so a failed write leaves the queue as it was
+        with self._fs.open(self._segment_path(sequence), "a") as file:
+            file.write(json.dumps([topic, data]) + "\n")
+
+        if new_segment:
+            self._segments.append([sequence, 0, 0])
+
+            if len(self._segments) > self._max_segments:
+                self._dropped += self._segments[0][1]
+                self._remove_oldest_segment()
+
+        segment = self._segments[-1]
+        segment[1] += 1
+        segment[2] += 1
+        self._segment_count += 1
+
+    def _remove_oldest_segment(self) -> None:
+        sequence, unread, _ = self._segments.pop(0)
+        self._segment_count -= unread
+        self._read_offset = 0
+        self._peeked = None
+
+        if not self._segments:
+            self._ram_after_segments = False
+
+        try:
+            self._fs.remove(self._segment_path(sequence))
+        except OSError:
+            pass
+
+        # the position was in the removed segment, and its sequence number can be used again once the queue is empty
+        try:
+            self._fs.remove(self._position_path())
+        except OSError:
+            pass
+
+    def _save_position(self) -> None:
+        # written on every pop from a segment, so after a restart reading carries on after the last message sent
+        segment = self._segments[0]
+        try:
+            with self._fs.open(self._position_path(), "w") as position:
+                position.write("{} {} {}".format(segment[0], self._read_offset, segment[2] - segment[1]))
+        except OSError:
+            pass  # a read-only filesystem, the segment is read from the start after a restart
+
+    def _load_position(self) -> None:
+        try:
+            with self._fs.open(self._position_path(), "r") as position:
+                sequence, offset, read = (int(value) for value in position.read().split())
+        except (OSError, ValueError):
+            return
+
+        segment = self._segments[0]
+        if segment[0] == sequence and read < segment[1]:
+            self._read_offset = offset
+            segment[1] -= read
+            self._segment_count -= read
+
+    def _segment_path(self, sequence: int) -> str:
+        return "{}/{}{:05d}{}".format(self._directory, self._segment_prefix, sequence, self._segment_suffix)
+
+    def _position_path(self) -> str:
+        return "{}/{}".format(self._directory, self._position_file)
+
+    def _load_segments(self) -> None:
+        try:
+            names = self._fs.listdir(self._directory)
+        except OSError:
+            try:
+                self._fs.mkdir(self._directory)
+            except OSError:
+                pass  # a read-only filesystem, messages are only held in RAM
+            return
+
+        sequences = []
+        for name in names:
+            if name.startswith(self._segment_prefix) and name.endswith(self._segment_suffix):
+                sequences.append(int(name[len(self._segment_prefix) : -len(self._segment_suffix)]))
+        sequences.sort()
+
+        for sequence in sequences:
+            with self._fs.open(self._segment_path(sequence), "r") as segment:
+                count = 0
+                for line in segment:
+                    if line.strip():
+                        count += 1
+
+            self._segments.append([sequence, count, count])
+            self._segment_count += count
+
+        if self._segments:
+            self._load_position()
@@ -0,0 +1,147 @@
+"""Tracking of device to cloud messages sent at QoS 1 until the hub acknowledges them
+"""
+
+import time
+
+from iot_error import IoTError
+
+
+class PublishWindow:
+    """Holds device to cloud messages sent at QoS 1 until the hub acknowledges them with a PUBACK,
+    so a message is never lost silently.
+
+    Up to size messages can be held at once, either waiting to be sent or waiting for their PUBACK. Messages
+    are mapped from the packet ID they were sent with, and any still waiting for a PUBACK when the connection
+    is lost go back to the front of the queue to be sent again once reconnected. The time from sending each
+    message to its PUBACK is sampled, so the latency percentiles can be read.
+    """
+
+    def __init__(self, size: int = 4, samples: int = 64):
+        """Create the window
+        :param int size: The maximum number of messages waiting to be sent or acknowledged
+        :param int samples: The number of recent round trip times kept for the latency percentiles
+        """
+        if size < 1:
+            raise ValueError("size must be at least 1")
+
+        self._size = size
+        # each message is [topic, data, packet ID, time sent], the packet ID is None until it has been sent
+        self._queued = []
+        self._in_flight = {}
+        self._samples = samples
+        self._latencies = []
+        self._next_latency = 0
+
+    def __len__(self) -> int:
+        return len(self._queued) + len(self._in_flight)
+
+    @property
+    def size(self) -> int:
+        """The maximum number of messages waiting to be sent or acknowledged
+        """
+        return self._size
+
+    @property
+    def available(self) -> int:
+        """The number of messages that can be added before the window is full
+        """
+        return self._size - len(self._queued) - len(self._in_flight)
+
+    @property
+    def in_flight(self) -> int:
+        """The number of messages sent and waiting for a PUBACK
+        """
+        return len(self._in_flight)
+
+    @property
+    def queued(self) -> int:
+        """The number of messages waiting to be sent or sent again
+        """
+        return len(self._queued)
+
+    def add(self, topic: str, data) -> None:
+        """Adds a message to the back of the queue to send
+        :param str topic: The topic to publish the message on
+        :param data: The message
+        """
+        if not self.available:
+            raise IoTError("Too many messages waiting to be acknowledged")
+
+        # the caller may reuse a memoryview's buffer for the next message, so hold a copy
+        if isinstance(data, memoryview):
+            data = bytes(data)
+
+        self._queued.append([topic, data, None, 0])
+
+    def peek(self) -> list:
+        """Gets the next message to send without removing it from the queue
+        :returns: The message as [topic, data, packet ID, time sent], or None if the queue is empty
+        """
+        return self._queued[0] if self._queued else None
+
+    def sent(self, message: list, packet_id: int) -> None:
+        """Moves a message from the queue to waiting for its PUBACK
+        :param list message: The message from peek
+        :param int packet_id: The packet ID the message was published with
+        """
+        self._queued.remove(message)
+        message[2] = packet_id
+        message[3] = time.monotonic()
+        self._in_flight[packet_id] = message
+
+    def get(self, packet_id: int) -> list:
+        """Gets the message waiting for the PUBACK with a packet ID
+        :param int packet_id: The packet ID
+        :returns: The message as [topic, data, packet ID, time sent], or None if no message was sent with the packet ID
+        """
+        return self._in_flight.get(packet_id)
+
+    def acknowledge(self, packet_id: int) -> list:
+        """Removes a message once its PUBACK arrives, and records its round trip time
+        :param int packet_id: The packet ID from the PUBACK
+        :returns: The message as [topic, data, packet ID, time sent], or None if no message was sent with the packet ID
+        """
+        message = self._in_flight.pop(packet_id, None)
+        if message is None:
+            return None
+
+        latency = time.monotonic() - message[3]
+        if len(self._latencies) < self._samples:
+            self._latencies.append(latency)
+        else:
+            self._latencies[self._next_latency] = latency
+            self._next_latency = (self._next_latency + 1) % self._samples
+
+        return message
+
+    def requeue(self) -> None:
+        """Puts the messages waiting for a PUBACK back at the front of the queue in the order they were sent,
+        such as when the connection has been lost and their PUBACKs will never arrive
+        """
+        if not self._in_flight:
+            return
+
+        messages = sorted(self._in_flight.values(), key=lambda message: message[3])
+        self._in_flight = {}
+
+        for message in messages:
+            message[2] = None
+
+        self._queued = messages + self._queued
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)) -> dict:
+        """Gets percentiles of the recent round trip times from sending a message to its PUBACK
+        :param percentiles: The percentiles to get
+        :returns: A dictionary of each percentile to the round trip time in seconds, empty if no messages have been acknowledged
+        """
+        if not self._latencies:
+            return {}
+
+        latencies = sorted(self._latencies)
+        result = {}
+        for percentile in percentiles:
+            # nearest rank
+            rank = max(1, -(-percentile * len(latencies) // 100))
+            result[percentile] = latencies[min(rank, len(latencies)) - 1]
+
+        return result
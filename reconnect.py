@@ -0,0 +1,153 @@
+"""Reconnecting to the hub after the connection is lost, backing off so devices don't all reconnect at once
+"""
+
+import random
+import time
+
+
+class ExponentialBackoff:
+    """Capped exponential backoff with jitter. The delay before each attempt doubles from initial up to maximum,
+    and a random part of it is taken off, so devices that lost their connection at the same time, such as when
+    a Wi-Fi access point reboots, spread their reconnects out instead of all reaching the hub together
+    """
+
+    def __init__(self, initial: float = 1, maximum: float = 300, multiplier: float = 2, jitter: float = 1):
+        """Create the backoff
+        :param float initial: The delay before the first attempt in seconds, before jitter
+        :param float maximum: The longest delay in seconds, before jitter
+        :param float multiplier: How much the delay grows after each failed attempt
+        :param float jitter: The fraction of each delay that is random, 1 picks anywhere from 0 to the delay
+        """
+        if not 0 <= jitter <= 1:
+            raise ValueError("jitter must be between 0 and 1")
+
+        self._initial = initial
+        self._maximum = maximum
+        self._multiplier = multiplier
+        self._jitter = jitter
+        self._attempts = 0
+
+    @property
+    def attempts(self) -> int:
+        """The number of delays given since the last reset
+        """
+        return self._attempts
+
+    def next_delay(self) -> float:
+        """Gets the delay before the next attempt in seconds
+        """
+        delay = min(self._maximum, self._initial * self._multiplier ** self._attempts)
+        self._attempts += 1
+        return delay - random.uniform(0, delay * self._jitter)
+
+    def reset(self) -> None:
+        """Starts again from the initial delay, once an attempt has succeeded
+        """
+        self._attempts = 0
+
+
+class ReconnectSupervisor:
+    """Watches the connection from the application's main loop, and reconnects with backoff when it is lost.
+    Each call to poll does at most one step of connecting, so the main loop keeps running during an outage
+    """
+
+    def __init__(self, backoff: ExponentialBackoff = None, logger=None):
+        """Create the supervisor
+        :param ExponentialBackoff backoff: The delays between attempts, defaults to 1 second doubling up to 5 minutes
+        :param logger: The logger
+        """
+        self._backoff = backoff if backoff is not None else ExponentialBackoff()
+        self._logger = logger
+        self._outage_started = None
+        self._next_attempt = 0
+        self._attempts = 0
+        self._connecting = False
+
+    @property
+    def in_outage(self) -> bool:
+        """Gets if the connection has been lost and not yet restored
+        """
+        return self._outage_started is not None
+
+    @property
+    def attempts(self) -> int:
+        """The number of reconnect attempts made in the current outage
+        """
+        return self._attempts
+
+    @property
+    def outage_duration(self) -> float:
+        """How long the current outage has lasted in seconds, 0 if connected
+        """
+        if self._outage_started is None:
+            return 0
+        return time.monotonic() - self._outage_started
+
+    # pylint: disable=W0703
+    def poll(self, is_connected, connect_start, connect_poll) -> tuple:
+        """Moves reconnecting on by one step if the connection has been lost
+        :param is_connected: The function that gets if the connection is open
+        :param connect_start: The function that starts connecting
+        :param connect_poll: The function that moves connecting on by one step, and returns True when it has finished
+        :returns: The outage duration in seconds and the number of attempts when the connection has just been restored, otherwise None
+        """
+        now = time.monotonic()
+
+        if self._connecting:
+            # only a connect that completed ends the outage, not one that failed part way through
+            try:
+                if not connect_poll():
+                    return None
+                completed = is_connected()
+            except Exception as connect_error:
+                self._log("Reconnect attempt %s failed: %s", self._attempts, connect_error)
+                completed = False
+
+            self._connecting = False
+            if completed:
+                return self._restored(now)
+
+            self._schedule(now)
+            return None
+
+        if is_connected():
+            return None
+
+        if self._outage_started is None:
+            # the first attempt waits too, so devices that lost the connection together don't reconnect together
+            self._outage_started = now
+            self._attempts = 0
+            self._backoff.reset()
+            self._schedule(now)
+            return None
+
+        if now < self._next_attempt:
+            return None
+
+        self._attempts += 1
+        try:
+            connect_start()
+            self._connecting = True
+        except Exception as connect_error:
+            self._log("Reconnect attempt %s failed: %s", self._attempts, connect_error)
+            self._schedule(now)
+
+        return None
+
+    def _schedule(self, now: float) -> None:
+        delay = self._backoff.next_delay()
+        self._next_attempt = now + delay
+        self._log("Connection lost, reconnecting in %ss", delay)
+
+    def _restored(self, now: float) -> tuple:
+        outage = now - self._outage_started
+        attempts = self._attempts
+        self._outage_started = None
+        self._attempts = 0
+        self._backoff.reset()
+        self._log("Reconnected after %ss and %s attempts", outage, attempts)
+        return outage, attempts
+
+    def _log(self, message: str, *args) -> None:
+        if self._logger is not None:
+            self._logger.info(message, *args)
@@ -0,0 +1,103 @@
+"""Coalescing of reported property updates into twin patches
+"""
+
+import time
+
+_MISSING = object()
+
+
+def _merge(target: dict, patch: dict, overwrite: bool = True) -> None:
+    """Merges updates into a pending patch the way the hub applies them: objects, such as components, are merged,
+    and other values replace the pending value, or are only added where there isn't one if overwrite is False.
+    Unlike TwinMirror, null values are kept, as they remove the property when the hub applies the patch
+    """
+    for name, value in patch.items():
+        pending = target.get(name, _MISSING)
+
+        if isinstance(value, dict) and isinstance(pending, dict):
+            _merge(pending, value, overwrite)
+        elif overwrite or pending is _MISSING:
+            if isinstance(value, dict):
+                # copied, so merging later updates into it doesn't change the caller's dictionary
+                target[name] = {}
+                _merge(target[name], value)
+            else:
+                target[name] = value
+
+
+class ReportedPropertyCoalescer:
+    """Merges reported property updates into a single twin patch, so updating many properties together
+    makes one PATCH request instead of one per property.
+
+    The patch is sent once the oldest pending update is older than the window, or when flush is called.
+    A later update to a property replaces the pending value, except that objects such as components are merged
+    property by property, and an update that sets a property to the value the hub has already acknowledged is dropped.
+    """
+
+    def __init__(self, send, window: float = 0.5, acknowledged=None):
+        """Create the coalescer
+        :param send: The function called with the patch to send, a dictionary of the properties
+        :param float window: How long in seconds to collect updates before sending them, 0 sends on the next poll
+        :param acknowledged: A function called with a property name and a default, returning the value the hub has
+        acknowledged for the property or the default, such as TwinMirror.get_reported
+        """
+        self._send = send
+        self._window = window
+        self._acknowledged = acknowledged
+        self._pending = {}
+        self._oldest = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def window(self) -> float:
+        """How long in seconds updates are collected before they are sent
+        """
+        return self._window
+
+    @window.setter
+    def window(self, window: float) -> None:
+        self._window = window
+
+    def update(self, patch: dict) -> None:
+        """Adds property updates to the pending patch
+        :param dict patch: The properties to update
+        """
+        for name, value in patch.items():
+            if self._acknowledged is not None and self._acknowledged(name, _MISSING) == value:
+                # pending updates inside an object are still to be sent, the rest of it is already on the hub
+                if not (isinstance(value, dict) and isinstance(self._pending.get(name), dict)):
+                    self._pending.pop(name, None)
+                    continue
+
+            if not self._pending:
+                self._oldest = time.monotonic()
+            _merge(self._pending, {name: value})
+
+    def poll(self) -> None:
+        """Sends the pending patch if the window has passed since the oldest update
+        """
+        if self._pending and time.monotonic() - self._oldest >= self._window:
+            self.flush()
+
+    def flush(self) -> None:
+        """Sends the pending patch straight away
+        """
+        if not self._pending:
+            return
+
+        # only cleared once sent, so the updates are sent next time if this fails
+        self._send(self._pending)
+        self._pending = {}
+
+    def retry(self, patch: dict) -> None:
+        """Adds the updates from a patch that the hub didn't accept back to the pending patch,
+        unless they have been updated again since
+        :param dict patch: The patch that was sent
+        """
+        for name, value in patch.items():
+            if name not in self._pending:
+                self.update({name: value})
+            elif isinstance(value, dict) and isinstance(self._pending[name], dict):
+                _merge(self._pending[name], value, False)
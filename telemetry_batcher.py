@@ -0,0 +1,95 @@
+"""Batching of device to cloud telemetry
+"""
+
+import json
+import time
+
+# IoT Hub rejects device to cloud messages larger than 256 KB
+MAX_MESSAGE_SIZE = 262144
+
+
+class TelemetryBatcher:
+    """Coalesces telemetry readings into a single JSON array device to cloud message.
+
+    Each reading is stored as ``{"timestamp": ..., "data": ...}`` so it keeps the time it was taken,
+    and the batch is sent as one message when it reaches the maximum count, size or age. A full batch is sent
+    from the next poll, or before the next reading is added, so a reading is never kept in a batch that failed
+    to send while add raises.
+    """
+
+    def __init__(self, send, max_count: int = 10, max_bytes: int = 4096, max_age: float = 5):
+        """Create the batcher
+        :param send: The function called with the JSON array payload when the batch is flushed, this is the send attribute
+        so it can be changed, such as to a new client after reconnecting
+        :param int max_count: The number of readings that triggers a flush
+        :param int max_bytes: The payload size in bytes that triggers a flush, this must be under the 256 KB IoT Hub limit
+        :param float max_age: The age in seconds of the oldest reading that triggers a flush
+        """
+        if max_count < 1:
+            raise ValueError("max_count must be at least 1")
+        if max_bytes > MAX_MESSAGE_SIZE:
+            raise ValueError("max_bytes must not be larger than the IoT Hub message size limit of " + str(MAX_MESSAGE_SIZE))
+
+        self.send = send
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._entries = []
+        self._size = 2  # the surrounding []
+        self._oldest = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _full(self) -> bool:
+        return len(self._entries) >= self._max_count
+
+    def add(self, data, timestamp=None) -> None:
+        """Adds a reading to the batch, flushing the batch first if the reading doesn't fit.
+        If that flush fails the error is raised and the reading isn't added
+        :param data: The reading, either a dictionary, or a JSON string, bytes, bytearray or memoryview
+        :param timestamp: The time the reading was taken, defaults to the current time
+        """
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode("utf-8")
+        if timestamp is None:
+            timestamp = time.time()
+
+        entry = '{"timestamp":' + json.dumps(timestamp) + ',"data":' + data + "}"
+        entry_size = len(entry.encode("utf-8"))
+
+        if self._size + entry_size + 1 > self._max_bytes:
+            if not self._entries:
+                raise ValueError("The reading is larger than max_bytes")
+            self.flush()
+        elif self._full():
+            self.flush()
+
+        if not self._entries:
+            self._oldest = time.monotonic()
+        else:
+            self._size += 1  # the separating comma
+
+        self._entries.append(entry)
+        self._size += entry_size
+
+    def poll(self) -> None:
+        """Flushes the batch if it has reached the maximum count, or the oldest reading has reached the maximum age
+        """
+        if self._entries and (self._full() or time.monotonic() - self._oldest >= self._max_age):
+            self.flush()
+
+    def flush(self) -> None:
+        """Sends all the queued readings as a single message
+        """
+        if not self._entries:
+            return
+
+        payload = "[" + ",".join(self._entries) + "]"
+
+        # only cleared once sent, so the readings are sent with the next flush if this fails
+        self.send(payload)
+        self._entries = []
+        self._size = 2
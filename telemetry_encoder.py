@@ -0,0 +1,133 @@
+"""Encoding of fixed schema telemetry to JSON without building a new string for each message
+"""
+
+import json
+
+
+class TelemetryEncoder:
+    """Encodes telemetry with a fixed set of keys to a JSON object, writing into a buffer that is allocated once.
+
+    The JSON for each key, such as ``,"Temperature":``, is built when the encoder is created, and
+    numbers are written digit by digit, with floats rounded to a fixed number of decimal places.
+    encode returns a memoryview of the buffer that can be passed straight to send_telemetry,
+    send_device_to_cloud_message or update_twin. It is only valid until the next call to encode.
+
+    Strings and nested values are encoded with json.dumps, so only numbers, booleans and None avoid allocating.
+    """
+
+    _true = b"true"
+    _false = b"false"
+    _null = b"null"
+    _infinity = float("inf")
+    _negative_infinity = float("-inf")
+
+    def __init__(self, keys, precision: int = 2, size: int = 256):
+        """Create the encoder
+        :param keys: The keys of the telemetry, in the order they are written
+        :param int precision: The number of decimal places floats are written with
+        :param int size: The size of the buffer in bytes, this must fit the largest message
+        """
+        if not keys:
+            raise ValueError("At least one key is required")
+        if precision < 0:
+            raise ValueError("precision must not be negative")
+
+        self._keys = tuple(keys)
+        self._fragments = []
+        for index, key in enumerate(self._keys):
+            self._fragments.append(("{" if index == 0 else ",").encode("utf-8") + json.dumps(key).encode("utf-8") + b":")
+
+        self._precision = precision
+        self._scale = 10 ** precision
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    @property
+    def keys(self) -> tuple:
+        """The keys of the telemetry
+        """
+        return self._keys
+
+    def encode(self, values) -> memoryview:
+        """Encodes the values of the telemetry
+        :param values: The values, either a dictionary with all the keys, or a list or tuple in the order of the keys
+        :returns: A memoryview of the JSON, valid until the next call to encode
+        """
+        is_dict = isinstance(values, dict)
+        position = 0
+        index = 0
+
+        # a while loop, as iterating with enumerate or range allocates on CircuitPython
+        while index < len(self._keys):
+            position = self._write_bytes(position, self._fragments[index])
+            position = self._write_value(position, values[self._keys[index]] if is_dict else values[index])
+            index += 1
+
+        position = self._write_bytes(position, b"}")
+        return self._view[:position]
+
+    def _buffer_full(self) -> None:
+        raise ValueError("The telemetry is larger than the encoder buffer of " + str(len(self._buffer)) + " bytes")
+
+    def _write_bytes(self, position: int, data: bytes) -> int:
+        end = position + len(data)
+        if end > len(self._buffer):
+            self._buffer_full()
+
+        self._buffer[position:end] = data
+        return end
+
+    def _write_value(self, position: int, value) -> int:
+        # bool has to be checked before int, as it is a subclass of int
+        if value is True:
+            return self._write_bytes(position, self._true)
+        if value is False:
+            return self._write_bytes(position, self._false)
+        if value is None:
+            return self._write_bytes(position, self._null)
+        if isinstance(value, int):
+            return self._write_int(position, value)
+        if isinstance(value, float):
+            return self._write_float(position, value)
+
+        return self._write_bytes(position, json.dumps(value).encode("utf-8"))
+
+    def _write_int(self, position: int, value: int, min_digits: int = 1) -> int:
+        buffer = self._buffer
+
+        if value < 0:
+            position = self._write_bytes(position, b"-")
+            value = -value
+
+        # write the digits least significant first, then reverse them in place
+        start = position
+        while value > 0 or position - start < min_digits:
+            if position >= len(buffer):
+                self._buffer_full()
+            buffer[position] = 48 + value % 10
+            value //= 10
+            position += 1
+
+        end = position - 1
+        while start < end:
+            buffer[start], buffer[end] = buffer[end], buffer[start]
+            start += 1
+            end -= 1
+
+        return position
+
+    def _write_float(self, position: int, value: float) -> int:
+        # JSON has no NaN or infinity
+        if value != value or value == self._infinity or value == self._negative_infinity:
+            return self._write_bytes(position, self._null)
+
+        scaled = int(round(abs(value) * self._scale))
+        if value < 0 and scaled != 0:
+            position = self._write_bytes(position, b"-")
+
+        position = self._write_int(position, scaled // self._scale)
+        if self._precision > 0:
+            position = self._write_bytes(position, b".")
+            position = self._write_int(position, scaled % self._scale, self._precision)
+
+        return position
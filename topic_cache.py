@@ -0,0 +1,83 @@
+"""Cache of the topics used to send device to cloud messages
+"""
+
+import circuitpython_parse as parse
+
+
+def encode_properties(properties: dict) -> str:
+    """Encodes a property bag for a topic, percent-encoding the names and values
+    :param dict properties: The properties
+    :returns: The properties joined with &, such as a=1&b=2
+    """
+    parts = []
+    for name, value in properties.items():
+        parts.append(parse.quote(str(name), "$") + "=" + parse.quote(str(value), ""))
+
+    return "&".join(parts)
+
+
+class TopicCache:
+    """Builds the topic for device to cloud messages with a set of properties, and keeps the most recently
+    used topics so sending with the same properties again reuses the topic instead of building a new one.
+
+    Looking up a topic compares the properties with the cached ones in place, so a cache hit doesn't allocate.
+    The properties are copied into the cache, so changing a dictionary after sending with it is safe.
+    """
+
+    def __init__(self, device_id: str, max_size: int = 8):
+        """Create the cache
+        :param str device_id: The device ID, used to build the topic
+        :param int max_size: The number of topics to keep, the least recently used is dropped when this is exceeded
+        """
+        self._base = "devices/{}/messages/events/".format(device_id)
+        self._max_size = max_size
+        # [content type, content encoding, properties, topic] for each topic, most recently used first
+        self._entries = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, properties: dict = None, content_type: str = None, content_encoding: str = None) -> str:
+        """Gets the topic for a message
+        :param dict properties: The system and application properties of the message, such as $.mid or a custom property
+        :param str content_type: The content type, sent as the $.ct property, such as application/json
+        :param str content_encoding: The content encoding, sent as the $.ce property, such as utf-8
+        :returns: The topic
+        """
+        if not properties:
+            properties = None
+
+        # a while loop, as iterating with enumerate or range allocates on CircuitPython
+        entries = self._entries
+        index = 0
+        while index < len(entries):
+            entry = entries[index]
+            if entry[0] == content_type and entry[1] == content_encoding and entry[2] == properties:
+                if index > 0:
+                    entries.insert(0, entries.pop(index))
+                return entry[3]
+            index += 1
+
+        topic = self._build(properties, content_type, content_encoding)
+
+        entries.insert(0, [content_type, content_encoding, dict(properties) if properties is not None else None, topic])
+        if len(entries) > self._max_size:
+            entries.pop()
+
+        return topic
+
+    def clear(self) -> None:
+        """Removes all the cached topics
+        """
+        self._entries = []
+
+    def _build(self, properties: dict, content_type: str, content_encoding: str) -> str:
+        parts = []
+        if content_type is not None:
+            parts.append("$.ct=" + parse.quote(content_type, ""))
+        if content_encoding is not None:
+            parts.append("$.ce=" + parse.quote(content_encoding, ""))
+        if properties is not None:
+            parts.append(encode_properties(properties))
+
+        return self._base + "&".join(parts)
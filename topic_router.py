@@ -0,0 +1,154 @@
+"""Routing of incoming MQTT messages to handlers by topic prefix
+"""
+
+
+def get_request_id(topic):
+    """Gets the $rid field from a topic
+    :param topic: The topic, as a str or bytes
+    :returns: The request id as a str, or None if the topic doesn't have one
+    """
+    is_bytes = isinstance(topic, bytes)
+    index = topic.find(b"$rid=" if is_bytes else "$rid=")
+    if index == -1:
+        return None
+
+    end = topic.find(b"&" if is_bytes else "&", index)
+    request_id = topic[index + 5 :] if end == -1 else topic[index + 5 : end]
+
+    return request_id.decode("utf-8") if is_bytes else request_id
+
+
+def get_properties(topic, start: int = 0) -> dict:
+    """Gets the property bag from a topic, such as the properties of a cloud to device message
+    :param topic: The topic, as a str or bytes
+    :param int start: The index in the topic where the property bag starts
+    :returns: A dictionary of the URL decoded properties
+    """
+    # only loaded once a message's properties are read
+    import circuitpython_parse as parse  # pylint: disable=C0415
+
+    if isinstance(topic, bytes):
+        topic = topic.decode("utf-8")
+
+    properties = {}
+    for part in topic[start:].split("&"):
+        if not part:
+            continue
+
+        key_value = part.split("=", 1)
+        properties[parse.unquote(key_value[0])] = parse.unquote(key_value[1]) if len(key_value) > 1 else ""
+
+    return properties
+
+
+class MessageProperties:
+    """The property bag of a message, such as a cloud to device message, read from its topic when it is first used.
+
+    It holds the topic as it was received, and only decodes and URL decodes the properties the first time one of them
+    is read, so a message whose properties are never looked at costs no parsing. It can be read like a dictionary,
+    and to_dict gets a copy as one, such as to pass to json.dumps
+    """
+
+    def __init__(self, topic, start: int = 0):
+        """Create the properties
+        :param topic: The topic, as a str or bytes
+        :param int start: The index in the topic where the property bag starts
+        """
+        self.topic = topic
+        self._start = start
+        self._properties = None
+
+    def _parsed(self) -> dict:
+        if self._properties is None:
+            self._properties = get_properties(self.topic, self._start)
+        return self._properties
+
+    def __getitem__(self, name: str) -> str:
+        return self._parsed()[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._parsed()
+
+    def __iter__(self):
+        return iter(self._parsed())
+
+    def __len__(self) -> int:
+        return len(self._parsed())
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, MessageProperties):
+            other = other.to_dict()
+        return self._parsed() == other
+
+    def __repr__(self) -> str:
+        return repr(self._parsed())
+
+    def get(self, name: str, default=None):
+        """Gets the value of a property
+        :param str name: The name of the property
+        :param default: The value to return if the message doesn't have the property
+        """
+        return self._parsed().get(name, default)
+
+    def keys(self):
+        """Gets the names of the properties
+        """
+        return self._parsed().keys()
+
+    def values(self):
+        """Gets the values of the properties
+        """
+        return self._parsed().values()
+
+    def items(self):
+        """Gets the name and value of each property
+        """
+        return self._parsed().items()
+
+    def to_dict(self) -> dict:
+        """Gets a copy of the properties as a dictionary
+        """
+        return dict(self._parsed())
+
+
+class TopicRouter:
+    """Dispatches incoming messages to the handler for the first route whose prefix matches the topic.
+
+    Prefixes are stored as both str and bytes when the route is added, so topics can be matched
+    in whichever form the MQTT client delivers them without decoding them first.
+    Handlers are called with the topic and payload exactly as they were received.
+    """
+
+    def __init__(self):
+        self._routes = []
+
+    def add_route(self, prefix, handler, first: bool = False) -> None:
+        """Adds a route
+        :param prefix: The topic prefix to match, as a str or bytes
+        :param handler: The function to call with the topic and payload of matching messages
+        :param bool first: Whether to check this route before the existing ones
+        """
+        if isinstance(prefix, bytes):
+            route = (prefix, prefix.decode("utf-8"), handler)
+        else:
+            route = (prefix.encode("utf-8"), prefix, handler)
+
+        if first:
+            self._routes.insert(0, route)
+        else:
+            self._routes.append(route)
+
+    def dispatch(self, topic, payload) -> bool:
+        """Calls the handler for the first route that matches the topic
+        :param topic: The topic, as a str or bytes
+        :param payload: The message payload
+        :returns: True if a route matched, otherwise False
+        """
+        index = 1 if isinstance(topic, str) else 0
+
+        for route in self._routes:
+            if topic.startswith(route[index]):
+                route[2](topic, payload)
+                return True
+
+        return False
@@ -0,0 +1,138 @@
+"""A local copy of the device twin
+"""
+
+
+def _merge(target: dict, patch: dict) -> None:
+    """Applies a twin patch to a dictionary: objects are merged, and properties set to null are removed
+    """
+    for name, value in patch.items():
+        if value is None:
+            target.pop(name, None)
+        elif isinstance(value, dict) and isinstance(target.get(name), dict):
+            _merge(target[name], value)
+        else:
+            target[name] = value
+
+
+class TwinMirror:
+    """Holds the desired and reported properties of the device twin, so they can be read without asking the hub.
+
+    Desired property patches carry the version of the desired properties after the change, which goes up by one
+    with each change. A patch with a version that has already been applied is stale and is dropped, and a patch
+    that skips versions shows changes have been missed, so the mirror is marked as needing a resync from the full twin.
+    """
+
+    # the results of applying a desired property patch
+    APPLIED = 0
+    STALE = 1
+    GAP = 2
+
+    def __init__(self):
+        self._desired = {}
+        self._reported = {}
+        self._desired_version = None
+        self._reported_version = None
+        self._resync_needed = False
+
+    @property
+    def desired_version(self) -> int:
+        """The version of the desired properties, or None if the twin hasn't been received
+        """
+        return self._desired_version
+
+    @property
+    def reported_version(self) -> int:
+        """The version of the reported properties, or None if the twin hasn't been received
+        """
+        return self._reported_version
+
+    @property
+    def is_synced(self) -> bool:
+        """Gets if the full twin has been received and no desired property changes are known to be missing
+        """
+        return self._desired_version is not None and not self._resync_needed
+
+    @property
+    def resync_needed(self) -> bool:
+        """Gets if desired property changes have been missed and the full twin should be requested
+        """
+        return self._resync_needed
+
+    def get_desired(self, name: str, default=None):
+        """Gets the value of a desired property
+        :param str name: The name of the property
+        :param default: The value to return if the property isn't set
+        """
+        return self._desired.get(name, default)
+
+    def get_reported(self, name: str, default=None):
+        """Gets the value of a reported property
+        :param str name: The name of the property
+        :param default: The value to return if the property isn't set
+        """
+        return self._reported.get(name, default)
+
+    def apply_twin(self, twin: dict) -> tuple:
+        """Replaces the mirror with the full twin from a twin GET response. Either section is ignored if it
+        is older than what is already held, as a patch can arrive before the response to an earlier GET
+        :param dict twin: The twin, with desired and reported sections that each have a $version
+        :returns: A tuple of two dictionaries, the desired and the reported properties that changed
+        """
+        desired_changes = self._replace(twin.get("desired"), True)
+        reported_changes = self._replace(twin.get("reported"), False)
+        return desired_changes, reported_changes
+
+    def _replace(self, section: dict, desired: bool) -> dict:
+        if section is None or "$version" not in section:
+            return {}
+
+        section = dict(section)
+        version = section.pop("$version")
+        current = self._desired if desired else self._reported
+        current_version = self._desired_version if desired else self._reported_version
+
+        if current_version is not None and version < current_version:
+            return {}
+
+        changes = {}
+        for name, value in section.items():
+            if current.get(name) != value:
+                changes[name] = value
+
+        if desired:
+            self._desired = section
+            self._desired_version = version
+            self._resync_needed = False
+        else:
+            self._reported = section
+            self._reported_version = version
+
+        return changes
+
+    def apply_desired_patch(self, patch: dict, version: int) -> int:
+        """Applies a desired property patch
+        :param dict patch: The changed properties, without the $version
+        :param int version: The version of the desired properties after the patch
+        :returns: APPLIED, STALE if the patch is older than the mirror and was dropped,
+        or GAP if it was applied but earlier patches have been missed
+        """
+        if self._desired_version is not None and version <= self._desired_version:
+            return self.STALE
+
+        result = self.APPLIED
+        if self._desired_version is None or version > self._desired_version + 1:
+            self._resync_needed = True
+            result = self.GAP
+
+        _merge(self._desired, patch)
+        self._desired_version = version
+        return result
+
+    def apply_reported_patch(self, patch: dict, version: int = None) -> None:
+        """Applies a reported property patch once the hub has accepted it
+        :param dict patch: The changed properties
+        :param int version: The version of the reported properties after the patch, if the hub returned it
+        """
+        _merge(self._reported, patch)
+        if version is not None:
+            self._reported_version = version
@@ -0,0 +1,115 @@
+"""Correlation of device twin requests with their responses
+"""
+
+import time
+
+from iot_error import IoTError
+
+
+class TwinRequestTracker:
+    """Gives each device twin request a unique request ID, and matches the responses the hub sends on
+    $iothub/twin/res/{status}/?$rid={request ID} to the requests that caused them.
+
+    Each request has a deadline, and is completed with STATUS_TIMEOUT if no response arrives in time.
+    The number of requests waiting for a response is capped so writes can be pipelined without overrunning the hub.
+    """
+
+    # the status requests are completed with if the hub doesn't respond before the deadline
+    STATUS_TIMEOUT = 0
+
+    # request IDs wrap round before they stop being small ints on CircuitPython
+    _max_request_id = 0x3FFFFFFF
+
+    def __init__(self, max_in_flight: int = 4, timeout: float = 30):
+        """Create the tracker
+        :param int max_in_flight: The maximum number of requests waiting for a response
+        :param float timeout: The default number of seconds to wait for a response
+        """
+        self._max_in_flight = 0
+        self._timeout = 0
+        self.set_limits(max_in_flight, timeout)
+        self._last_request_id = 0
+        # request ID -> [deadline, start time, callback]
+        self._pending = {}
+
+    @property
+    def in_flight(self) -> int:
+        """The number of requests waiting for a response
+        """
+        return len(self._pending)
+
+    @property
+    def available(self) -> int:
+        """The number of requests that can be started before reaching the in flight limit
+        """
+        return self._max_in_flight - len(self._pending)
+
+    def set_limits(self, max_in_flight: int, timeout: float) -> None:
+        """Changes the limits, requests already in flight keep their deadlines
+        :param int max_in_flight: The maximum number of requests waiting for a response
+        :param float timeout: The default number of seconds to wait for a response
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+
+        self._max_in_flight = max_in_flight
+        self._timeout = timeout
+
+    def is_pending(self, request_id: str) -> bool:
+        """Gets if a request is waiting for a response
+        :param str request_id: The request ID
+        """
+        return request_id in self._pending
+
+    def start(self, callback=None, timeout: float = None) -> str:
+        """Starts tracking a request
+        :param callback: The function called with the request ID, the status code, the round trip time in seconds,
+        and the $version from the response or None, when the response arrives or the request times out
+        :param float timeout: The number of seconds to wait for a response, defaults to the tracker's timeout
+        :returns: The request ID to send with the request
+        """
+        if len(self._pending) >= self._max_in_flight:
+            raise IoTError("Too many device twin requests waiting for a response")
+
+        self._last_request_id = self._last_request_id % self._max_request_id + 1
+        request_id = str(self._last_request_id)
+
+        now = time.monotonic()
+        self._pending[request_id] = [now + (timeout if timeout is not None else self._timeout), now, callback]
+        return request_id
+
+    def cancel(self, request_id: str) -> None:
+        """Stops tracking a request without calling its callback, such as when sending it failed
+        :param str request_id: The request ID
+        """
+        self._pending.pop(request_id, None)
+
+    def complete(self, request_id: str, status: int, version: int = None) -> bool:
+        """Completes a request when its response arrives
+        :param str request_id: The request ID from the response
+        :param int status: The status code from the response
+        :param int version: The $version from the response, if it has one
+        :returns: True if the request was being tracked, False if it is unknown or had already timed out
+        """
+        request = self._pending.pop(request_id, None)
+        if request is None:
+            return False
+
+        if request[2] is not None:
+            request[2](request_id, status, time.monotonic() - request[1], version)
+
+        return True
+
+    def expire(self, expire_all: bool = False) -> None:
+        """Completes the requests whose deadline has passed with STATUS_TIMEOUT
+        :param bool expire_all: Whether to complete all the requests, such as when the connection has been lost
+        and the responses will never arrive
+        """
+        if not self._pending:
+            return
+
+        now = time.monotonic()
+        expired = [request_id for request_id, request in self._pending.items() if expire_all or request[0] <= now]
+
+        for request_id in expired:
+            self.complete(request_id, self.STATUS_TIMEOUT)